@@ -2,36 +2,7 @@
 #
 # Maintainer: Andrea F. Daniele
 
-from os.path import (
-    exists as _exists,
-    dirname as _dirname,
-    basename as _basename,
-    isdir as _isdir,
-    isfile as _isfile,
-    join as _join,
-)
-import glob as _glob
+# commands are loaded lazily, `command.py` and subcommands are imported only when used
+from utils.commands_utils import lazy_commands_package as _lazy_commands_package
 
-# constants
-_this_dir = _dirname(__file__)
-_command_file = "command.py"
-
-# import current command
-if _exists(_join(_this_dir, _command_file)):
-    # noinspection PyUnresolvedReferences
-    from .command import *
-
-# find all modules
-_modules = [m for m in _glob.glob(_join(_this_dir, "*")) if _isdir(m)]
-# this is important to avoid name clashing with commands at lower levels
-_modules.sort(key=lambda p: int(_isfile(_join(p, _command_file))))
-
-# load submodules
-for _mod in _modules:
-    try:
-        exec("from .%s import *" % _basename(_mod))
-    except ImportError as e:
-        if _exists(_join(_mod, _command_file)):
-            raise EnvironmentError(e)
-    except EnvironmentError as e:
-        raise e
+__getattr__, __dir__ = _lazy_commands_package(__name__, __file__)
@@ -5,7 +5,7 @@ import os
 import sys
 import time
 import datetime
-from shutil import which
+import threading
 from pathlib import Path
 from termcolor import colored
 from docker.errors import ImageNotFound, ContainerError, APIError
@@ -16,6 +16,7 @@ from utils.docker_utils import \
     DEFAULT_MACHINE, \
     DOCKER_INFO, \
     get_endpoint_architecture, \
+    get_endpoint_info, \
     get_client, \
     pull_image
 from utils.dtproject_utils import \
@@ -26,23 +27,31 @@ from utils.dtproject_utils import \
     dtlabel, \
     DISTRO_KEY
 from utils.misc_utils import human_time, human_size
-from utils.cli_utils import start_command_in_subprocess
+from utils.cli_utils import prefixed_output, set_output_prefix
+
+from utils.transfer_utils import transfer_image, TransferError
 
 from .image_analyzer import ImageAnalyzer, EXTRA_INFO_SEPARATOR
 
+_multiarch_lock = threading.Lock()
+_docker_config_lock = threading.Lock()
+
 
 class DTCommand(DTCommandAbs):
 
     help = 'Builds the current project'
 
     @staticmethod
-    def command(shell, args):
+    def command(shell, args, **kwargs):
         # configure arguments
         parser = argparse.ArgumentParser()
         parser.add_argument('-C', '--workdir', default=os.getcwd(),
                             help="Directory containing the project to build")
-        parser.add_argument('-a', '--arch', default=None, choices=set(CANONICAL_ARCH.values()),
-                            help="Target architecture for the image to build")
+        parser.add_argument('-a', '--arch', default=None,
+                            help="Target architecture(s) for the image to build. Multiple "
+                                 "architectures (comma-separated) are built in parallel")
+        parser.add_argument('--all-archs', default=False, action='store_true',
+                            help="Build the image for all the supported architectures in parallel")
         parser.add_argument('-H', '--machine', default=None,
                             help="Docker socket or hostname where to build the image")
         parser.add_argument('--pull', default=False, action='store_true',
@@ -80,16 +89,35 @@ class DTCommand(DTCommandAbs):
                             help="Docker socket or hostname where to deliver the image")
         parser.add_argument('--docs', default=False, action='store_true',
                             help="Build the code documentation as well")
+        parser.add_argument('--metrics-out', default=None,
+                            help="File where to write the build metrics (JSON)")
         parser.add_argument('-v', '--verbose', default=False, action='store_true',
                             help="Be verbose")
         parsed, _ = parser.parse_known_args(args=args)
         # ---
         stime = time.time()
+        # time spent (in seconds) in each phase, None for phases that were skipped
+        timings = {
+            'cache_pull': None,
+            'build': None,
+            'transfer': None,
+            'push': None
+        }
         parsed.workdir = os.path.abspath(parsed.workdir)
-        dtslogger.info('Project workspace: {}'.format(parsed.workdir))
-        # show info about project
-        shell.include.devel.info.command(shell, args)
-        project = DTProject(parsed.workdir)
+        # builds that are part of a build matrix receive their architecture from the matrix
+        matrix = kwargs.get('matrix', None)
+        if matrix is not None:
+            parsed.arch = kwargs['arch']
+        else:
+            dtslogger.info('Project workspace: {}'.format(parsed.workdir))
+            archs = _parse_archs(parsed)
+            if len(archs) > 1:
+                _build_matrix(shell, args, parsed, archs)
+                return
+            parsed.arch = archs[0] if archs else None
+            # show info about project
+            shell.include.devel.info.command(shell, args)
+        project = DTProject.load(parsed.workdir)
         try:
             project_template_ver = int(project.type_version)
         except ValueError:
@@ -120,7 +148,8 @@ class DTCommand(DTCommandAbs):
                     )
                     exit(5)
             # set configuration
-            parsed.arch = os.environ['DUCKIETOWN_CI_ARCH']
+            if matrix is None:
+                parsed.arch = os.environ['DUCKIETOWN_CI_ARCH']
             buildargs['labels'][dtlabel('image.authoritative')] = '1'
         # cloud build
         if parsed.cloud:
@@ -197,7 +226,7 @@ class DTCommand(DTCommandAbs):
         docker = get_client(parsed.machine)
         # get info about docker endpoint
         dtslogger.info('Retrieving info about Docker endpoint...')
-        epoint = docker.info()
+        epoint = get_endpoint_info(parsed.machine)
         if 'ServerErrors' in epoint:
             dtslogger.error('\n'.join(epoint['ServerErrors']))
             return
@@ -238,13 +267,15 @@ class DTCommand(DTCommandAbs):
             if parsed.arch not in compatible_archs:
                 dtslogger.info('Configuring machine for multiarch builds...')
                 try:
-                    docker.containers.run(
-                        'multiarch/qemu-user-static:register',
-                        remove=True,
-                        auto_remove=True,
-                        privileged=True,
-                        command='--reset'
-                    )
+                    # builds running in parallel share the same endpoint(s)
+                    with _multiarch_lock:
+                        docker.containers.run(
+                            'multiarch/qemu-user-static:register',
+                            remove=True,
+                            auto_remove=True,
+                            privileged=True,
+                            command='--reset'
+                        )
                     dtslogger.info('Multiarch Enabled!')
                 except (ContainerError, ImageNotFound, APIError) as e:
                     msg = 'Multiarch cannot be enabled on the target machine. ' \
@@ -284,9 +315,12 @@ class DTCommand(DTCommandAbs):
             if not is_present:
                 # try to pull the same image so Docker can use it as cache source
                 dtslogger.info('Pulling image "%s" to use as cache...' % image)
+                pull_stime = time.time()
                 try:
-                    pull_image(image, endpoint=docker, progress=not parsed.ci)
+                    pull_image(image, endpoint=docker,
+                               progress=not parsed.ci and matrix is None)
                     is_present = True
+                    timings['cache_pull'] = time.time() - pull_stime
                 except KeyboardInterrupt:
                     dtslogger.info('Aborting.')
                     return
@@ -343,7 +377,8 @@ class DTCommand(DTCommandAbs):
         dtslogger.debug('Build arguments:\n%s\n' % json.dumps(buildargs, sort_keys=True, indent=4))
 
         # build image
-        buildlog = []
+        analyzer = ImageAnalyzer()
+        build_stime = time.time()
         try:
             for line in docker.api.build(**buildargs, decode=True):
                 line = _build_line(line)
@@ -351,7 +386,7 @@ class DTCommand(DTCommandAbs):
                     continue
                 try:
                     sys.stdout.write(line)
-                    buildlog.append(line)
+                    analyzer.feed(line)
                 except UnicodeEncodeError:
                     pass
                 sys.stdout.flush()
@@ -362,6 +397,7 @@ class DTCommand(DTCommandAbs):
         except ProjectBuildError:
             dtslogger.error(f'An error occurred while building the project image.')
             exit(2)
+        timings['build'] = time.time() - build_stime
         dimage = docker.images.get(image)
 
         # tag release images
@@ -369,11 +405,11 @@ class DTCommand(DTCommandAbs):
             rimage = project.image_release(parsed.arch, owner=parsed.username)
             dimage.tag(*rimage.split(':'))
             msg = f'Successfully tagged {rimage}'
-            buildlog.append(msg)
+            analyzer.feed(msg)
             print(msg)
 
-        # build code docs
-        if parsed.docs:
+        # build code docs (build matrices build them once, at the end)
+        if parsed.docs and matrix is None:
             docs_args = ['--quiet'] * int(not parsed.verbose)
             # build docs
             dtslogger.info('Building documentation...')
@@ -399,23 +435,32 @@ class DTCommand(DTCommandAbs):
         ))
         # compile extra info
         extra_info = '\n'.join(extra_info)
-        # run docker image analysis
-        _, _, final_image_size = ImageAnalyzer.process(
-            buildlog, historylog, codens=100, extra_info=extra_info, nocolor=parsed.ci
-        )
+        # run docker image analysis (build matrices show all the reports at the end)
+        if matrix is None:
+            analyzer.report(historylog, codens=100, extra_info=extra_info, nocolor=parsed.ci)
+        else:
+            matrix['analysis'] = {
+                'analyzer': analyzer,
+                'historylog': historylog,
+                'extra_info': extra_info
+            }
         # pull image (if the destination is different from the builder machine)
         if parsed.destination and parsed.machine != parsed.destination:
+            transfer_stime = time.time()
             _transfer_image(
                 origin=parsed.machine,
                 destination=parsed.destination,
                 image=image,
-                image_size=final_image_size
+                progress=not parsed.ci and matrix is None
             )
+            timings['transfer'] = time.time() - transfer_stime
         # perform push (if needed)
         if parsed.push:
             if not parsed.loop:
                 # call devel/push
+                push_stime = time.time()
                 shell.include.devel.push.command(shell, [], parsed=copy.deepcopy(parsed))
+                timings['push'] = time.time() - push_stime
             else:
                 msg = "Forbidden: You cannot push an image when using the flag `--loop`."
                 dtslogger.warn(msg)
@@ -430,6 +475,14 @@ class DTCommand(DTCommandAbs):
                         parsed.machine
                     ) + ". Just a heads up!"
                 )
+        # export build metrics
+        if parsed.metrics_out or matrix is not None:
+            timings['total'] = time.time() - stime
+            metrics = _build_metrics(parsed, project, image, analyzer.analyze(historylog), timings)
+            if matrix is not None:
+                matrix['metrics'] = metrics
+            else:
+                _write_metrics(parsed.metrics_out, metrics)
 
     @staticmethod
     def complete(shell, word, line):
@@ -440,14 +493,123 @@ class ProjectBuildError(Exception):
     pass
 
 
-def _transfer_image(origin, destination, image, image_size):
-    monitor_info = '' if which('pv') else ' (install `pv` to see the progress)'
-    dtslogger.info(f'Transferring image "{image}": [{origin}] -> [{destination}]{monitor_info}...')
-    data_source = ['docker', '-H=%s' % origin, 'save', image]
-    data_destination = ['docker', '-H=%s' % destination, 'load']
-    progress_monitor = ['|', 'pv', '-cN', 'image', '-s', image_size] if which('pv') else []
-    cmd = data_source + progress_monitor + data_destination
-    start_command_in_subprocess(cmd, nostdout=True)
+def _parse_archs(parsed):
+    if parsed.all_archs:
+        return sorted(set(CANONICAL_ARCH.values()))
+    archs = parsed.arch
+    if parsed.ci and 'DUCKIETOWN_CI_ARCH' in os.environ:
+        archs = os.environ['DUCKIETOWN_CI_ARCH']
+    if archs is None:
+        return []
+    archs = [a.strip() for a in archs.split(',') if a.strip()]
+    for arch in archs:
+        if arch not in CANONICAL_ARCH.values():
+            dtslogger.error(f"Architecture '{arch}' not supported. Valid choices are: "
+                            f"{', '.join(sorted(set(CANONICAL_ARCH.values())))}")
+            exit(9)
+    # remove duplicates, keep the order
+    return list(dict.fromkeys(archs))
+
+
+def _build_matrix(shell, args, parsed, archs):
+    # show info about project (once)
+    shell.include.devel.info.command(shell, args)
+    project = DTProject.load(parsed.workdir)
+    # check if the index is clean (once)
+    if project.is_dirty() and not parsed.force:
+        dtslogger.warning('Your index is not clean (some files are not committed).')
+        dtslogger.warning('If you know what you are doing, use --force (-f) to ' +
+                          'force the execution of the command.')
+        exit(1)
+    dtslogger.info(f"Building for {len(archs)} architectures in parallel: {', '.join(archs)}")
+    results = {arch: {} for arch in archs}
+    width = max(map(len, archs))
+
+    def _worker(arch):
+        set_output_prefix(colored(f'[{arch.ljust(width)}] ', 'cyan') if not parsed.ci
+                          else f'[{arch.ljust(width)}] ')
+        try:
+            DTCommand.command(shell, args, arch=arch, matrix=results[arch])
+            results[arch]['success'] = 'analysis' in results[arch]
+        except SystemExit as e:
+            results[arch]['success'] = e.code in [None, 0] and 'analysis' in results[arch]
+        except BaseException as e:
+            dtslogger.error(f'An error occurred while building the image: {str(e)}')
+            results[arch]['success'] = False
+        finally:
+            sys.stdout.flush()
+            set_output_prefix(None)
+
+    # run one build per architecture
+    with prefixed_output():
+        workers = [threading.Thread(target=_worker, args=(arch,), daemon=True) for arch in archs]
+        for worker in workers:
+            worker.start()
+        try:
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            dtslogger.info('Aborting.')
+            exit(1)
+    # show the analysis of each image
+    for arch in archs:
+        if 'analysis' not in results[arch]:
+            continue
+        print('\n' + '=' * 30)
+        print(f'Architecture: {arch}')
+        analysis = results[arch]['analysis']
+        analysis['analyzer'].report(
+            analysis['historylog'], codens=100, extra_info=analysis['extra_info'], nocolor=parsed.ci
+        )
+    # build code docs
+    if parsed.docs:
+        docs_args = ['--quiet'] * int(not parsed.verbose)
+        dtslogger.info('Building documentation...')
+        shell.include.devel.docs.build.command(shell, args + docs_args)
+    # export build metrics
+    if parsed.metrics_out:
+        _write_metrics(parsed.metrics_out, {
+            arch: results[arch]['metrics'] for arch in archs if 'metrics' in results[arch]
+        })
+    # summary
+    failed = [arch for arch in archs if not results[arch].get('success', False)]
+    for arch in archs:
+        status = colored('Failed', 'red') if arch in failed else colored('Success', 'green')
+        dtslogger.info(f'Build for {arch}: {status}')
+    if failed:
+        exit(1)
+
+
+def _build_metrics(parsed, project, image, analysis, timings):
+    return {
+        'image': image,
+        'arch': parsed.arch,
+        'machine': parsed.machine or DEFAULT_MACHINE,
+        'project': {
+            'name': project.name,
+            'version': project.version_name,
+            'sha': project.sha,
+            'clean': project.is_clean()
+        },
+        'time': timings,
+        **analysis
+    }
+
+
+def _write_metrics(fpath, metrics):
+    fpath = os.path.abspath(fpath)
+    dtslogger.info(f'Writing build metrics to {fpath}')
+    with open(fpath, 'wt') as fout:
+        json.dump(metrics, fout, indent=4, sort_keys=True)
+
+
+def _transfer_image(origin, destination, image, progress=True):
+    dtslogger.info(f'Transferring image "{image}": [{origin}] -> [{destination}]...')
+    try:
+        transfer_image(origin, destination, image, progress=progress)
+    except (TransferError, APIError, OSError) as e:
+        dtslogger.error(f'An error occurred while transferring the image: {str(e)}')
+        exit(10)
 
 
 def _build_line(line):
@@ -470,14 +632,16 @@ def _build_line(line):
 def _add_token_to_docker_config(token):
     config = {}
     config_file = os.path.expanduser('~/.docker/config.json')
-    if os.path.isfile(config_file):
-        config = json.load(open(config_file, 'r')) if os.path.exists(config_file) else {}
-    else:
-        docker_config_dir = os.path.dirname(config_file)
-        dtslogger.info('Creating directory "{:s}"'.format(docker_config_dir))
-        os.makedirs(docker_config_dir)
-    if 'HttpHeaders' not in config:
-        config['HttpHeaders'] = {}
-    if 'X-Duckietown-Token' not in config['HttpHeaders']:
-        config['HttpHeaders']['X-Duckietown-Token'] = token
-        json.dump(config, open(config_file, 'w'), indent=2)
+    # builds running in parallel might try to update the config at the same time
+    with _docker_config_lock:
+        if os.path.isfile(config_file):
+            config = json.load(open(config_file, 'r')) if os.path.exists(config_file) else {}
+        else:
+            docker_config_dir = os.path.dirname(config_file)
+            dtslogger.info('Creating directory "{:s}"'.format(docker_config_dir))
+            os.makedirs(docker_config_dir)
+        if 'HttpHeaders' not in config:
+            config['HttpHeaders'] = {}
+        if 'X-Duckietown-Token' not in config['HttpHeaders']:
+            config['HttpHeaders']['X-Duckietown-Token'] = token
+            json.dump(config, open(config_file, 'w'), indent=2)
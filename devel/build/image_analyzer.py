@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import re
+import time
 import termcolor as tc
 
 LAYER_SIZE_YELLOW = 20 * 1024 ** 2  # 20 MB
@@ -10,8 +11,29 @@ SEPARATORS_LENGTH_HALF = 25
 
 EXTRA_INFO_SEPARATOR = '-' * SEPARATORS_LENGTH_HALF
 
+# RegEx patterns
+STEP_PATTERN = re.compile("Step ([0-9]+)/([0-9]+) : (.*)")
+LAYER_PATTERN = re.compile(" ---> ([0-9a-z]{12})")
+CACHE_STRING = ' ---> Using cache'
+FINAL_LAYER_PATTERN = re.compile("Successfully tagged (.*)")
+
 
 class ImageAnalyzer(object):
+    """
+    Incremental analyzer of Docker build logs.
+
+    Lines are consumed one at a time (see `feed`) as they stream out of the Docker engine,
+    only a constant amount of information per build step is retained, so the memory used
+    does not depend on the length of the build log.
+    """
+
+    def __init__(self):
+        self._num_lines = 0
+        # [stepno, steptot, stepcmd, layerid, num_cache_lines, start_time]
+        self._steps = []
+        self._last_time = None
+        # trailing lines of the log reporting the names of the final image
+        self._tail_image_names = []
 
     @staticmethod
     def about():
@@ -30,101 +52,155 @@ class ImageAnalyzer(object):
             num /= 1024.0
         return f"%.{precision}f%s%s".format(num, 'Yi', suffix)
 
-    @staticmethod
-    def process(buildlog, historylog, codens=0, extra_info=None, nocolor=False):
-        lines = buildlog
-        size_fmt = ImageAnalyzer.size_fmt
+    @property
+    def num_lines(self):
+        return self._num_lines
 
-        # return if the log is empty
-        if not lines:
-            raise ValueError('The build log is empty')
+    @property
+    def num_steps(self):
+        return len(self._steps)
 
-        # return if the image history is empty
-        if not historylog:
-            raise ValueError('The image history is empty')
-
-        if nocolor:
-            tc.colored = lambda s, *_: s
-
-        # define RegEx patterns
-        step_pattern = re.compile("Step ([0-9]+)/([0-9]+) : (.*)")
-        layer_pattern = re.compile(" ---> ([0-9a-z]{12})")
-        cache_string = ' ---> Using cache'
-        final_layer_pattern = re.compile("Successfully tagged (.*)")
-
-        # sanitize log
-        lines = list(map(lambda s: s.strip('\n'), lines))
-
-        # check if the build process succeded
-        if not final_layer_pattern.match(lines[-1]):
-            exit(codens + 2)
-        image_names = []
-        for line in reversed(lines):
-            match = final_layer_pattern.match(line)
+    def feed(self, line, timestamp=None):
+        line = line.strip('\n')
+        self._num_lines += 1
+        self._last_time = timestamp if timestamp is not None else time.time()
+        # keep track of the trailing "Successfully tagged" lines
+        match = FINAL_LAYER_PATTERN.match(line)
+        if match:
+            self._tail_image_names.append(match.group(1))
+        else:
+            self._tail_image_names = []
+        # new step
+        match = STEP_PATTERN.match(line)
+        if match:
+            stepno, steptot, stepcmd = match.groups()
+            self._steps.append(
+                [stepno, steptot, re.sub(' +', ' ', stepcmd), None, 0, self._last_time]
+            )
+            return
+        # lines before the first step are not interesting
+        if not self._steps:
+            return
+        step = self._steps[-1]
+        if line == CACHE_STRING:
+            step[4] += 1
+        elif step[3] is None:
+            match = LAYER_PATTERN.match(line)
             if match:
-                image_names.append(match.group(1))
-            else:
-                break
+                step[3] = match.group(1)
 
-        print()
-        ImageAnalyzer.about()
+    def analyze(self, historylog):
+        """
+        Combines the information extracted from the build log with the image history.
 
-        # find "Step XY/TOT" lines
-        steps_idx = [i for i in range(len(lines)) if step_pattern.match(lines[i])] + [len(lines)]
+        Args:
+            historylog: list of pairs (layer_id, layer_size) as returned by the image history
 
+        Returns:
+            a JSON-serializable dictionary describing the image and its build steps
+        """
+        # return if the log is empty
+        if self._num_lines == 0:
+            raise ValueError('The build log is empty')
+        # return if the image history is empty
+        if not historylog:
+            raise ValueError('The image history is empty')
         # sanitize history log
         historylog = [
             (lid[7:19] if lid.startswith('sha256:') else lid, size) for (lid, size) in historylog
         ]
-
         # create map {layerid: size_bytes}
         layer_to_size_bytes = dict()
         for layerid, layersize in historylog:
             if 'missing' in layerid:
                 continue
             layer_to_size_bytes[layerid] = int(layersize)
-
         # for each Step, find the layer ID
         first_layer = None
         cached_layers = 0
-        for i, j in zip(steps_idx, steps_idx[1:]):
+        steps = []
+        # a step ends when the next one starts, the last one ends with the log
+        end_times = [step[5] for step in self._steps[1:]] + [self._last_time]
+        for (stepno, steptot, stepcmd, layerid, num_cache_lines, stime), etime in \
+                zip(self._steps, end_times):
+            # check for cached layers
+            cached = first_layer is None or num_cache_lines == 1
+            if cached:
+                cached_layers += 1
+            if layerid is not None and stepcmd.startswith('FROM'):
+                first_layer = layerid
+                cached_layers += 1
+            steps.append({
+                'step': int(stepno),
+                'total': int(steptot),
+                'command': stepcmd,
+                'layer': layerid,
+                'size': layer_to_size_bytes.get(layerid, None),
+                'cached': cached,
+                'duration': etime - stime,
+            })
+        # get info about layers
+        tot_layers = len(self._steps)
+        cached_layers = min(tot_layers, cached_layers)
+        # compute size of base and final image
+        first_layer_idx = [
+            i for i in range(len(historylog)) if historylog[i][0] == first_layer
+        ][0]
+        base_image_size = sum([int(line[1]) for line in historylog[first_layer_idx:]])
+        final_image_size = sum([int(line[1]) for line in historylog])
+        # ---
+        return {
+            'image_names': list(reversed(self._tail_image_names)),
+            'steps': steps,
+            'layers': {
+                'total': tot_layers,
+                'built': tot_layers - cached_layers,
+                'cached': cached_layers,
+            },
+            'base_image_size': base_image_size,
+            'final_image_size': final_image_size,
+            'added_size': final_image_size - base_image_size,
+        }
+
+    def report(self, historylog, codens=0, extra_info=None, nocolor=False):
+        size_fmt = ImageAnalyzer.size_fmt
+
+        # return if the log is empty
+        if self._num_lines == 0:
+            raise ValueError('The build log is empty')
+
+        # return if the image history is empty
+        if not historylog:
+            raise ValueError('The image history is empty')
+
+        if nocolor:
+            tc.colored = lambda s, *_: s
+
+        # check if the build process succeded
+        if not self._tail_image_names:
+            exit(codens + 2)
+
+        analysis = self.analyze(historylog)
+
+        print()
+        ImageAnalyzer.about()
+
+        for step in analysis['steps']:
             indent_str = '|'
             layerid_str = 'Layer ID:'
             size_str = 'Size:'
-            cur_step_lines = lines[i:j]
-            open_layers = [
-                layer_pattern.match(line) for line in cur_step_lines if layer_pattern.match(line)
-            ]
-            # check for cached layers
-            step_cache = tc.colored('No', 'red')
-            if first_layer is None or \
-                    len(list(filter(lambda s: s == cache_string, cur_step_lines))) == 1:
-                cached_layers += 1
-                step_cache = tc.colored('Yes', 'green')
-            # get Step info
+            step_cache = tc.colored('Yes', 'green') if step['cached'] else tc.colored('No', 'red')
             print('-' * SEPARATORS_LENGTH)
-            stepline = lines[i]
-            stepno = step_pattern.match(stepline).group(1)
-            steptot = step_pattern.match(stepline).group(2)
-            stepcmd = re.sub(' +', ' ', step_pattern.match(stepline).group(3))
             # get info about layer ID and size
-            layerid = None
             layersize = 'ND'
             bg_color = 'white'
             fg_color = 'grey'
-            if len(open_layers) > 0:
-                layerid = open_layers[0].group(1)
-                if stepcmd.startswith('FROM'):
-                    first_layer = layerid
-                    cached_layers += 1
-            # ---
-            if layerid in layer_to_size_bytes:
-                layersize = size_fmt(layer_to_size_bytes[layerid])
+            if step['size'] is not None:
+                layersize = size_fmt(step['size'])
                 fg_color = 'white'
-                bg_color = 'yellow' if layer_to_size_bytes[layerid] > LAYER_SIZE_YELLOW \
-                    else 'green'
-                bg_color = 'red' if layer_to_size_bytes[layerid] > LAYER_SIZE_RED else bg_color
-                bg_color = 'blue' if stepcmd.startswith('FROM') else bg_color
+                bg_color = 'yellow' if step['size'] > LAYER_SIZE_YELLOW else 'green'
+                bg_color = 'red' if step['size'] > LAYER_SIZE_RED else bg_color
+                bg_color = 'blue' if step['command'].startswith('FROM') else bg_color
 
             indent_str = tc.colored(indent_str, fg_color, 'on_' + bg_color)
             size_str = tc.colored(size_str, fg_color, 'on_' + bg_color)
@@ -132,26 +208,15 @@ class ImageAnalyzer(object):
             # print info about the current layer
             print(
                 '%s %s\n%sStep: %s/%s\n%sCached: %s\n%sCommand: \n%s\t%s\n%s%s %s' % (
-                    layerid_str, layerid,
-                    indent_str, stepno, steptot,
+                    layerid_str, step['layer'],
+                    indent_str, step['step'], step['total'],
                     indent_str, step_cache,
-                    indent_str, indent_str, stepcmd,
+                    indent_str, indent_str, step['command'],
                     indent_str, size_str, layersize
                 )
             )
             print()
 
-        # get info about layers
-        tot_layers = len(steps_idx) - 1
-        cached_layers = min(tot_layers, cached_layers)
-
-        # compute size of base and final image
-        first_layer_idx = [
-            i for i in range(len(historylog)) if historylog[i][0] == first_layer
-        ][0]
-        base_image_size = sum([int(line[1]) for line in historylog[first_layer_idx:]])
-        final_image_size = sum([int(line[1]) for line in historylog])
-
         # print info about the whole image
         print()
         print(
@@ -165,15 +230,14 @@ class ImageAnalyzer(object):
         )
         print()
         print('=' * SEPARATORS_LENGTH)
-        print('Final image name: %s' % ('\n' + ' ' * 18).join(image_names))
-        print('Base image size: %s' % size_fmt(base_image_size))
-        print('Final image size: %s' % size_fmt(final_image_size))
-        print('Your image added %s to the base image.' % size_fmt(
-            final_image_size - base_image_size))
+        print('Final image name: %s' % ('\n' + ' ' * 18).join(analysis['image_names']))
+        print('Base image size: %s' % size_fmt(analysis['base_image_size']))
+        print('Final image size: %s' % size_fmt(analysis['final_image_size']))
+        print('Your image added %s to the base image.' % size_fmt(analysis['added_size']))
         print(EXTRA_INFO_SEPARATOR)
-        print('Layers total: {:d}'.format(tot_layers))
-        print(' - Built: {:d}'.format(tot_layers - cached_layers))
-        print(' - Cached: {:d}'.format(cached_layers))
+        print('Layers total: {:d}'.format(analysis['layers']['total']))
+        print(' - Built: {:d}'.format(analysis['layers']['built']))
+        print(' - Cached: {:d}'.format(analysis['layers']['cached']))
         if extra_info is not None and len(extra_info) > 0:
             print(EXTRA_INFO_SEPARATOR)
             print(extra_info)
@@ -183,4 +247,11 @@ class ImageAnalyzer(object):
               ': Always ask yourself, can I do better than that? ;)')
         print()
         # ---
-        return image_names, base_image_size, final_image_size
+        return analysis['image_names'], analysis['base_image_size'], analysis['final_image_size']
+
+    @staticmethod
+    def process(buildlog, historylog, codens=0, extra_info=None, nocolor=False):
+        analyzer = ImageAnalyzer()
+        for line in buildlog:
+            analyzer.feed(line)
+        return analyzer.report(historylog, codens=codens, extra_info=extra_info, nocolor=nocolor)
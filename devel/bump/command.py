@@ -50,7 +50,7 @@ class DTCommand(DTCommandAbs):
         # show info about project
         dtslogger.info("Project workspace: {}".format(parsed.workdir))
         shell.include.devel.info.command(shell, args)
-        project = DTProject(parsed.workdir)
+        project = DTProject.load(parsed.workdir)
         # check if the index is clean
         if project.is_dirty():
             dtslogger.warning("Your index is not clean (some files are not committed).")
@@ -2,20 +2,7 @@
 #
 # Maintainer: Andrea F. Daniele
 
-# import current command
-try:
-    from .command import *
-except ImportError:
-    pass
+# commands are loaded lazily, `command.py` and subcommands are imported only when used
+from utils.commands_utils import lazy_commands_package as _lazy_commands_package
 
-import glob
-from os.path import dirname, basename, isdir
-
-modules = glob.glob(dirname(__file__) + "/*")
-
-# load submodules
-for mod in [m for m in modules if isdir(m)]:
-    try:
-        exec ('from .%s import *' % basename(mod))
-    except ImportError:
-        pass
+__getattr__, __dir__ = _lazy_commands_package(__name__, __file__)
@@ -57,7 +57,7 @@ class DTCommand(DTCommandAbs):
         # show info about project
         if not parsed.quiet:
             shell.include.devel.info.command(shell, args)
-        project = DTProject(parsed.workdir)
+        project = DTProject.load(parsed.workdir)
         # check if the index is clean
         if project.is_dirty():
             dtslogger.warning('Your index is not clean (some files are not committed).')
@@ -48,7 +48,7 @@ class DTCommand(DTCommandAbs):
             # disable coloring
             tc.colored = nocolor
         parsed.workdir = os.path.abspath(parsed.workdir)
-        project = DTProject(parsed.workdir)
+        project = DTProject.load(parsed.workdir)
         info = {
             "project": tc.colored("Project:", "grey", "on_white"),
             "name": project.name,
@@ -0,0 +1,8 @@
+# This is a default __init__ file for the Duckietown Shell commands
+#
+# Maintainer: Andrea F. Daniele
+
+# commands are loaded lazily, `command.py` and subcommands are imported only when used
+from utils.commands_utils import lazy_commands_package as _lazy_commands_package
+
+__getattr__, __dir__ = _lazy_commands_package(__name__, __file__)
@@ -0,0 +1,27 @@
+from dt_shell import DTCommandAbs, DTShell
+
+from utils.profiling_utils import main
+
+usage = """
+
+## Basic usage
+
+    Measures the time needed to import the commands (offline, against a stub of the shell)
+    and fails if the startup of the shell or any command exceeds its budget.
+
+        $ dts devel profile_startup [options]
+
+    The same check can run without the shell (e.g., in CI) with:
+
+        $ python3 -m utils.profiling_utils [options]
+
+"""
+
+
+class DTCommand(DTCommandAbs):
+
+    help = "Profiles the import time of the commands"
+
+    @staticmethod
+    def command(shell: DTShell, args):
+        exit(main(args, prog="dts devel profile_startup"))
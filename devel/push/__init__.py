@@ -2,22 +2,7 @@
 #
 # Maintainer: Andrea F. Daniele
 
-# import current command
-try:
-    # noinspection PyUnresolvedReferences
-    from .command import DTCommand
+# commands are loaded lazily, `command.py` and subcommands are imported only when used
+from utils.commands_utils import lazy_commands_package as _lazy_commands_package
 
-except ImportError:
-    pass
-
-import glob
-from os.path import basename, dirname, isdir
-
-modules = glob.glob(dirname(__file__) + "/*")
-
-# load submodules
-for mod in [m for m in modules if isdir(m)]:
-    try:
-        exec("from .%s import *" % basename(mod))
-    except ImportError:
-        pass
+__getattr__, __dir__ = _lazy_commands_package(__name__, __file__)
@@ -60,7 +60,7 @@ class DTCommand(DTCommandAbs):
         dtslogger.info("Project workspace: {}".format(parsed.workdir))
         # show info about project
         shell.include.devel.info.command(shell, [], parsed=parsed)
-        project = DTProject(parsed.workdir)
+        project = DTProject.load(parsed.workdir)
         # CI builds
         if parsed.ci:
             # check that the env variables are set
@@ -185,7 +185,7 @@ class DTCommand(DTCommandAbs):
         # show info about project
         shell.include.devel.info.command(shell, args)
         # get info about project
-        project = DTProject(parsed.workdir)
+        project = DTProject.load(parsed.workdir)
         # container name
         if not parsed.name:
             parsed.name = 'dts-run-{:s}'.format(project.name)
@@ -237,7 +237,7 @@ class DTCommand(DTCommandAbs):
                 if not os.path.isdir(project_path):
                     dtslogger.error('The path "{:s}" is not a Duckietown project'.format(project_path))
                 # get project info
-                proj = DTProject(project_path)
+                proj = DTProject.load(project_path)
                 # get local and remote paths to code and launchfile
                 local_src, destination_src = proj.code_paths()
                 local_launch, destination_launch = proj.launch_paths()
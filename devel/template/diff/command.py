@@ -36,7 +36,7 @@ class DTCommand(DTCommandAbs):
         # show info about project
         shell.include.devel.info.command(shell, args)
         # get info about current project
-        project = DTProject(code_dir)
+        project = DTProject.load(code_dir)
         # check if the index is clean
         if project.is_dirty():
             dtslogger.warning("Your index is not clean.")
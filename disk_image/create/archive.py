@@ -0,0 +1,178 @@
+import os
+import time
+import zlib
+import struct
+import hashlib
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Optional
+
+from init_sd_card.flasher import (
+    DEFAULT_BLOCK_SIZE,
+    MANIFEST_VERSION,
+    new_hasher,
+    save_manifest,
+)
+
+DEFAULT_COMPRESSION_LEVEL = 6
+PROGRESS_INTERVAL = 1.0
+# the block hashes shipped with the disk image are verified by the flasher, which runs as root
+# (whose Python might not have the fastest hash functions), use one that is always available
+SHIPPED_HASH_ALGORITHM = "blake2b"
+
+ZIP_LOCAL_HEADER = struct.Struct("<4sHHHHHIIIHH")
+ZIP_CENTRAL_HEADER = struct.Struct("<4sHHHHHHIIIHHHHHII")
+ZIP64_END_RECORD = struct.Struct("<4sQHHIIQQQQ")
+ZIP64_END_LOCATOR = struct.Struct("<4sIQI")
+ZIP_END_RECORD = struct.Struct("<4sHHHHIIH")
+ZIP64_EXTRA_ID = 0x0001
+ZIP64_VERSION = 45
+ZIP_DEFLATED = 8
+ZIP_MAX = 0xFFFFFFFF
+
+
+class ZipWriter:
+    """
+    Writes a ZIP archive (always ZIP64) to a seekable file. Files are read once and compressed
+    (deflate) in parallel, each chunk is compressed independently and flushed to a byte
+    boundary, so that the chunks can be concatenated into a single deflate stream (the same
+    technique used by `pigz`). Sizes and CRCs are stored in the local headers, so that the
+    archive can be read from a stream (see `init_sd_card/archive.py`).
+
+    Args:
+        fpath:      path to the archive to create
+        level:      compression level
+        workers:    number of threads compressing at the same time (default: number of CPUs)
+    """
+
+    def __init__(self, fpath: str, level: int = DEFAULT_COMPRESSION_LEVEL, workers: Optional[int] = None):
+        self._fout = open(fpath, "wb")
+        self._level = level
+        self._workers = workers or os.cpu_count() or 1
+        self._entries = []
+
+    def write_chunks(self, name: str, chunks: Iterable[bytes]):
+        """
+        Adds a file to the archive with the content given as an iterable of chunks.
+        """
+        fname = name.encode("utf-8")
+        offset = self._fout.tell()
+        mtime = _dos_time(time.time())
+        # the header is written again once the sizes and the CRC are known
+        self._fout.write(self._local_header(fname, mtime, 0, 0, 0))
+        crc, usize, csize = 0, 0, 0
+        pending = collections.deque()
+        with ThreadPoolExecutor(max_workers=self._workers) as executor:
+            for chunk in chunks:
+                crc = zlib.crc32(chunk, crc)
+                usize += len(chunk)
+                pending.append(executor.submit(self._deflate, chunk))
+                # keep a bounded number of chunks in memory
+                while len(pending) > 2 * self._workers:
+                    csize += self._fout.write(pending.popleft().result())
+            while pending:
+                csize += self._fout.write(pending.popleft().result())
+        # terminate the deflate stream with an empty final block
+        csize += self._fout.write(zlib.compressobj(self._level, zlib.DEFLATED, -zlib.MAX_WBITS).flush())
+        end = self._fout.tell()
+        self._fout.seek(offset)
+        self._fout.write(self._local_header(fname, mtime, crc, usize, csize))
+        self._fout.seek(end)
+        self._entries.append((fname, mtime, crc, usize, csize, offset))
+
+    def write_file(self, fpath: str, name: Optional[str] = None, block_size: int = DEFAULT_BLOCK_SIZE):
+        with open(fpath, "rb") as fin:
+            self.write_chunks(name or os.path.basename(fpath), iter(lambda: fin.read(block_size), b""))
+
+    def close(self):
+        start = self._fout.tell()
+        for fname, mtime, crc, usize, csize, offset in self._entries:
+            extra = struct.pack("<HHQQQ", ZIP64_EXTRA_ID, 24, usize, csize, offset)
+            self._fout.write(ZIP_CENTRAL_HEADER.pack(
+                b"PK\x01\x02", (3 << 8) | ZIP64_VERSION, ZIP64_VERSION, 0, ZIP_DEFLATED, mtime[0], mtime[1],
+                crc, ZIP_MAX, ZIP_MAX, len(fname), len(extra), 0, 0, 0, 0o100644 << 16, ZIP_MAX,
+            ))
+            self._fout.write(fname + extra)
+        end = self._fout.tell()
+        num = len(self._entries)
+        self._fout.write(ZIP64_END_RECORD.pack(
+            b"PK\x06\x06", ZIP64_END_RECORD.size - 12, ZIP64_VERSION, ZIP64_VERSION, 0, 0, num, num,
+            end - start, start,
+        ))
+        self._fout.write(ZIP64_END_LOCATOR.pack(b"PK\x06\x07", 0, end, 1))
+        self._fout.write(ZIP_END_RECORD.pack(
+            b"PK\x05\x06", 0, 0, min(num, 0xFFFF), min(num, 0xFFFF), ZIP_MAX, ZIP_MAX, 0
+        ))
+        self._fout.close()
+
+    def _deflate(self, chunk: bytes) -> bytes:
+        compressor = zlib.compressobj(self._level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    @staticmethod
+    def _local_header(fname, mtime, crc, usize, csize):
+        extra = struct.pack("<HHQQ", ZIP64_EXTRA_ID, 16, usize, csize)
+        return ZIP_LOCAL_HEADER.pack(
+            b"PK\x03\x04", ZIP64_VERSION, 0, ZIP_DEFLATED, mtime[0], mtime[1], crc, ZIP_MAX, ZIP_MAX,
+            len(fname), len(extra),
+        ) + fname + extra
+
+
+def digest_disk_image(disk_image: str, manifest_path: str, archive: Optional[ZipWriter] = None,
+                      block_size: int = DEFAULT_BLOCK_SIZE, callback: Optional[Callable] = None) -> str:
+    """
+    Reads a disk image once and, at the same time, computes its SHA256, stores the hashes of
+    its blocks in `manifest_path` (same format used by `init_sd_card/flasher.py`), and adds
+    it to the given archive (if any). Returns the SHA256 of the disk image.
+    `callback(done, total)` is called periodically with the progress in bytes.
+    """
+    size = os.path.getsize(disk_image)
+    algorithm = SHIPPED_HASH_ALGORITHM
+    sha256 = hashlib.sha256()
+    blocks, zeroed_blocks = [], []
+    zeros = bytes(block_size)
+    done, last_update = 0, 0
+
+    def _blocks():
+        nonlocal done, last_update
+        with open(disk_image, "rb") as fin:
+            for block in iter(lambda: fin.read(block_size), b""):
+                sha256.update(block)
+                hasher = new_hasher(algorithm)
+                hasher.update(block)
+                if block == zeros[: len(block)]:
+                    zeroed_blocks.append(len(blocks))
+                blocks.append(hasher.hexdigest())
+                done += len(block)
+                if callback is not None and time.time() - last_update > PROGRESS_INTERVAL:
+                    callback(done, size)
+                    last_update = time.time()
+                yield block
+
+    if archive is not None:
+        archive.write_chunks(os.path.basename(disk_image), _blocks())
+    else:
+        for _ in _blocks():
+            pass
+    if callback is not None:
+        callback(done, size)
+    save_manifest(
+        {
+            "version": MANIFEST_VERSION,
+            "algorithm": algorithm,
+            "block_size": block_size,
+            "size": size,
+            "blocks": blocks,
+            "zeroed_blocks": zeroed_blocks,
+        },
+        manifest_path,
+    )
+    return sha256.hexdigest()
+
+
+def _dos_time(timestamp):
+    t = time.localtime(timestamp)
+    return (
+        (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+        ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday,
+    )
@@ -34,9 +34,8 @@ CLI_TOOLS_NEEDED = [
     "sudo",
     "cp",
     "sha256sum",
-    "strings",
     "grep",
-    "stat",
+    "tar",
     "udevadm",
     "losetup",
     "parted",
@@ -15,8 +15,9 @@ import fnmatch
 import getpass
 from datetime import datetime
 
-from utils.cli_utils import ask_confirmation
+from utils.cli_utils import ask_confirmation, ProgressBar
 from utils.duckietown_utils import get_distro_version
+from utils.pull_utils import pull_images, DEFAULT_PULL_WORKERS
 from utils.misc_utils import human_time
 
 from disk_image.create.constants import \
@@ -28,14 +29,26 @@ from disk_image.create.constants import \
     MODULES_TO_LOAD, \
     DATA_STORAGE_DISK_IMAGE_DIR
 
+from disk_image.create.archive import ZipWriter, digest_disk_image
 from disk_image.create.utils import (
     VirtualSDCard,
+    StepCache,
+    AutoStepCache,
+    STEP_CACHE_DEFAULT_MAX_SIZE_GB,
+    STEP_CACHE_DEFAULT_UPGRADE_TTL_DAYS,
     check_cli_tools,
+    copy_disk_image,
+    directory_fingerprint,
+    file_sha256,
+    fingerprint_steps,
+    time_window,
+    resolve_image_digests,
     pull_docker_image,
-    disk_template_partitions,
-    disk_template_objects,
+    registry_mirror_args,
+    start_registry_mirror,
+    apply_disk_template,
+    disk_template_manifest,
     find_placeholders_on_disk,
-    get_file_first_line,
     get_file_length,
     run_cmd,
     run_cmd_in_partition,
@@ -97,6 +110,12 @@ MANDATORY_STEPS = [
     "mount",
     "unmount"
 ]
+# steps whose output is cached automatically
+AUTO_CACHED_STEPS = [
+    "upgrade",
+    "docker",
+    "setup",
+]
 
 APT_PACKAGES_TO_INSTALL = [
     'rsync',
@@ -107,6 +126,11 @@ APT_PACKAGES_TO_INSTALL = [
     # 'v4l2loopback-dkms',
     'v4l2loopback-utils'
 ]
+# files of the disk template used by the step 'upgrade'
+UPGRADE_TEMPLATE_FILES = [
+    ["usr", "bin", "qemu-aarch64-static"],
+    ["run", "resolvconf", "resolv.conf"],
+]
 
 
 class DTCommand(DTCommandAbs):
@@ -159,6 +183,42 @@ class DTCommand(DTCommandAbs):
             default=None,
             help="Step to cache",
         )
+        parser.add_argument(
+            "--no-auto-cache",
+            default=False,
+            action="store_true",
+            help="Do not cache the steps automatically and do not resume from cached steps",
+        )
+        parser.add_argument(
+            "--cache-max-size",
+            type=float,
+            default=STEP_CACHE_DEFAULT_MAX_SIZE_GB,
+            help="Maximum size (in GB) of the automatic steps cache",
+        )
+        parser.add_argument(
+            "--upgrade-cache-ttl",
+            type=float,
+            default=STEP_CACHE_DEFAULT_UPGRADE_TTL_DAYS,
+            help="Days a cached 'upgrade' step is reused for before upgrading the packages again",
+        )
+        parser.add_argument(
+            "--registry-mirror",
+            type=str,
+            default=None,
+            help="Docker Hub mirror to pull the modules from (by default, a local pull-through cache is used)",
+        )
+        parser.add_argument(
+            "--no-registry-mirror",
+            default=False,
+            action="store_true",
+            help="Pull the modules directly from Docker Hub",
+        )
+        parser.add_argument(
+            "--pull-workers",
+            type=int,
+            default=DEFAULT_PULL_WORKERS,
+            help="Number of modules to pull at the same time",
+        )
         parser.add_argument(
             "--push",
             default=False,
@@ -208,17 +268,22 @@ class DTCommand(DTCommandAbs):
         output_image_name = input_image_name.replace(JETPACK_VERSION, DISK_IMAGE_VERSION)
         out_file_name = lambda ex: f"dt-{output_image_name}.{ex}"
         out_file_path = lambda ex: os.path.join(parsed.output, out_file_name(ex))
-        cached_step_file_path = lambda step, ex: \
-            os.path.join(parsed.output, 'cache', out_file_name(ex) + f'.{step}')
+        step_cache = StepCache(os.path.join(parsed.output, 'cache'), out_file_name('img'))
+        auto_cache = AutoStepCache(
+            os.path.join(parsed.output, 'cache'), out_file_name('img'), int(parsed.cache_max_size * 1024 ** 3)
+        )
         # get version
         distro = get_distro_version(shell)
         # create a virtual SD card object
         sd_card = VirtualSDCard(out_file_path("img"), DISK_IMAGE_PARTITION_TABLE)
         # this is the surgey plan that will be performed by the init_sd_card command
         surgery_plan = []
+        # the archive is written by the steps 'finalize' and 'compress'
+        archive = None
         # define disk image origin (by default we use the official vanilla nVidia JetPack OS)
         disk_image_origin = in_file_path('img')
         using_cached_step = False
+        restore_cached_step = None
         # this holds the stats that will be stored in /data/stats/disk_image/build.json
         stats = {
             "steps": {step: bool(step in parsed.steps) for step in SUPPORTED_STEPS},
@@ -250,24 +315,67 @@ class DTCommand(DTCommandAbs):
 
         # create caching function
         def cache_step(step):
+            fprint = dict(step_fingerprints()).get(step) if step in AUTO_CACHED_STEPS else None
+            if fprint is not None:
+                dtslogger.info(f"Caching step '{step}' automatically...")
+                run_cmd(["sync"])
+                auto_cache.record(step, fprint, out_file_path('img'), state={"surgery_plan": surgery_plan})
             if step != parsed.cache_record:
                 return
             # cache step
             dtslogger.info(f"Caching step '{step}'...")
-            cache_file_path = cached_step_file_path(step, 'img')
-            _copy_file(out_file_path('img'), cache_file_path)
+            step_cache.record(step, out_file_path('img'))
             dtslogger.info(f"Step '{step}' cached.")
 
         # use cached step
         if parsed.cache_target is not None:
-            disk_image_origin = cached_step_file_path(parsed.cache_target, 'img')
-            if not os.path.isfile(disk_image_origin):
+            if not step_cache.has(parsed.cache_target):
                 dtslogger.error(f'No cached artifact found for step `{parsed.cache_target}`')
                 return
             for step in SUPPORTED_STEPS[:SUPPORTED_STEPS.index(parsed.cache_target)+1]:
                 if step in MANDATORY_STEPS:
                     continue
                 parsed.steps.remove(step)
+            restore_cached_step = lambda destination: step_cache.restore(parsed.cache_target, destination)
+            using_cached_step = True
+
+        # fingerprint the inputs of the steps that change the disk image
+        hashes_memo = os.path.join(parsed.output, 'cache', 'auto', 'hashes.json')
+        step_inputs = {
+            "create": lambda: [file_sha256(in_file_path("img"), hashes_memo), DISK_IMAGE_SIZE_GB],
+            "fix": lambda: [],
+            "resize": lambda: [DISK_IMAGE_PARTITION_TABLE, ROOT_PARTITION],
+            "upgrade": lambda: [APT_PACKAGES_TO_INSTALL] + [
+                file_sha256(os.path.join(DISK_TEMPLATE_DIR, ROOT_PARTITION, *location))
+                for location in UPGRADE_TEMPLATE_FILES
+            ] + [time_window(parsed.upgrade_cache_ttl)],
+            "docker": lambda: [distro, resolve_image_digests(stats["modules"])],
+            "setup": lambda: [DISK_IMAGE_VERSION, directory_fingerprint(DISK_TEMPLATE_DIR)],
+        }
+        step_inputs_known = {}
+        # the steps that are skipped when resuming from cache are part of the fingerprints
+        fingerprinted_steps = [s for s in SUPPORTED_STEPS if s in parsed.steps]
+
+        def step_fingerprints():
+            if parsed.no_auto_cache or parsed.cache_target is not None:
+                return []
+            # cached images are restored by the step 'create', and only a chain starting from it
+            # covers the base image, partial runs are not cached automatically
+            if "create" not in fingerprinted_steps:
+                return []
+            return fingerprint_steps(fingerprinted_steps, step_inputs, DISK_IMAGE_VERSION, step_inputs_known)
+
+        # resume from the latest step whose inputs did not change
+        hit = auto_cache.lookup([(s, f) for s, f in step_fingerprints() if s in AUTO_CACHED_STEPS])
+        if hit is not None:
+            cached_step, cached_fprint = hit
+            dtslogger.info(f"The inputs of the steps up to '{cached_step}' did not change, resuming from cache.")
+            for step in SUPPORTED_STEPS[:SUPPORTED_STEPS.index(cached_step)+1]:
+                if step in MANDATORY_STEPS or step not in parsed.steps:
+                    continue
+                parsed.steps.remove(step)
+            surgery_plan.extend(auto_cache.state(cached_fprint).get("surgery_plan", []))
+            restore_cached_step = lambda destination: auto_cache.restore(cached_fprint, destination)
             using_cached_step = True
 
         # ---
@@ -378,26 +486,16 @@ class DTCommand(DTCommandAbs):
                 if not granted:
                     dtslogger.info("Aborting.")
                     return
-            # create empty disk image
-            if not using_cached_step:
-                dtslogger.info(f"Creating empty disk image [{out_file_path('img')}]")
-                run_cmd([
-                    "dd",
-                    "if=/dev/zero",
-                    f"of={out_file_path('img')}",
-                    f"bs={1024 * 1024}",
-                    f"count={1024 * DISK_IMAGE_SIZE_GB}",
-                ])
-                dtslogger.info("Empty disk image created!")
-            # make copy of the disk image
-            dtslogger.info(f"Copying [{disk_image_origin}] -> [{out_file_path('img')}]")
-            run_cmd([
-                "dd",
-                f"if={disk_image_origin}",
-                f"of={out_file_path('img')}",
-                f"bs={1024 * 1024}",
-                "" if using_cached_step else "conv=notrunc"
-            ])
+            # make copy of the disk image (holes are preserved, the image is extended to its final size)
+            if using_cached_step:
+                dtslogger.info(f"Restoring cached step -> [{out_file_path('img')}]")
+                method = restore_cached_step(out_file_path('img'))
+            else:
+                dtslogger.info(f"Copying [{disk_image_origin}] -> [{out_file_path('img')}]")
+                method = copy_disk_image(
+                    disk_image_origin, out_file_path('img'), size=DISK_IMAGE_SIZE_GB * 1024 ** 3
+                )
+            dtslogger.info(f"Disk image created ({method} copy)!")
             # flush buffer
             dtslogger.info("Flushing I/O buffer...")
             run_cmd(["sync"])
@@ -624,6 +722,17 @@ class DTCommand(DTCommandAbs):
                 local_docker = docker.from_env()
                 # pull dind image
                 pull_docker_image(local_docker, "docker:dind")
+                # pull modules through a registry mirror (layers are downloaded only once across builds)
+                dockerd_args = ["dockerd", "--host=tcp://0.0.0.0:2375"]
+                registry_mirror = parsed.registry_mirror
+                if registry_mirror is None and not parsed.no_registry_mirror:
+                    try:
+                        registry_mirror = start_registry_mirror(local_docker)
+                    except Exception as e:
+                        dtslogger.warning(f"Could not start the local registry mirror: {str(e)}")
+                if registry_mirror:
+                    dtslogger.info(f"Using the registry mirror [{registry_mirror}]")
+                    dockerd_args += registry_mirror_args(registry_mirror)
                 # run auxiliary Docker engine
                 remote_docker_dir = os.path.join(
                     PARTITION_MOUNTPOINT(ROOT_PARTITION), "var", "lib", "docker")
@@ -636,7 +745,7 @@ class DTCommand(DTCommandAbs):
                     privileged=True,
                     name="dts-disk-image-aux-docker",
                     volumes={remote_docker_dir: {"bind": "/var/lib/docker", "mode": "rw"}},
-                    entrypoint=["dockerd", "--host=tcp://0.0.0.0:2375"],
+                    entrypoint=dockerd_args,
                 )
                 time.sleep(2)
                 # get IP address of the container
@@ -648,15 +757,17 @@ class DTCommand(DTCommandAbs):
                 # from this point on, if anything weird happens, stop container and unmount disk
                 try:
                     dtslogger.info("Transferring Docker images...")
-                    # pull images inside the disk image
-                    for module in MODULES_TO_LOAD:
-                        image = DOCKER_IMAGE_TEMPLATE(
+                    # pull images inside the disk image (concurrently, shared layers are pulled once)
+                    images = [
+                        DOCKER_IMAGE_TEMPLATE(
                             owner=module["owner"],
                             module=module["module"],
                             version=distro,
                             tag=module["tag"] if "tag" in module else None,
                         )
-                        pull_docker_image(remote_docker, image)
+                        for module in MODULES_TO_LOAD
+                    ]
+                    pull_images(remote_docker, images, workers=parsed.pull_workers)
                     # ---
                     dtslogger.info("Docker images successfully transferred!")
                 except Exception as e:
@@ -689,22 +800,13 @@ class DTCommand(DTCommandAbs):
                 if not sd_card.is_mounted():
                     dtslogger.error(f"The disk {out_file_path('img')} is not mounted.")
                     return
-                # find partitions to update
-                partitions = disk_template_partitions(DISK_TEMPLATE_DIR)
+                # find partitions to update (the disk template is walked only once)
+                template = disk_template_manifest(DISK_TEMPLATE_DIR)
+                partitions = list(template.keys())
                 # put template objects inside the stats object
                 for partition in partitions:
-                    stats["template"]["directories"] = list(
-                        map(
-                            lambda u: u["relative"],
-                            disk_template_objects(DISK_TEMPLATE_DIR, partition, "directory"),
-                        )
-                    )
-                    stats["template"]["files"] = list(
-                        map(
-                            lambda u: u["relative"],
-                            disk_template_objects(DISK_TEMPLATE_DIR, partition, "file"),
-                        )
-                    )
+                    stats["template"]["directories"] = [u["relative"] for u in template[partition]["directory"]]
+                    stats["template"]["files"] = [u["relative"] for u in template[partition]["file"]]
                 # make sure that all the partitions are there
                 for partition in partitions:
                     # check if the partition defined in the disk_template dir exists
@@ -719,35 +821,27 @@ class DTCommand(DTCommandAbs):
                     # from this point on, if anything weird happens, unmount the disk
                     try:
                         dtslogger.info(f'Updating partition "{partition}":')
-                        # create directory structure from disk template
-                        dirs = disk_template_objects(DISK_TEMPLATE_DIR, partition, "directory")
-                        for update in dirs:
-                            dtslogger.info(f"- Creating directory [{update['relative']}]")
-                            # create destination
-                            run_cmd(["sudo", "mkdir", "-p", update["destination"]])
-                        # apply changes from disk_template
-                        files = disk_template_objects(DISK_TEMPLATE_DIR, partition, "file")
-                        for update in files:
-                            # validate file
+                        # validate files
+                        for update in template[partition]["file"]:
                             validator = _get_validator_fcn(partition, update["relative"])
                             if validator:
                                 dtslogger.debug(f"Validating file {update['relative']}...")
                                 validator(shell, update["origin"], update["relative"])
-                            # create or modify file
+                        for update in template[partition]["directory"]:
+                            dtslogger.info(f"- Creating directory [{update['relative']}]")
+                        for update in template[partition]["file"]:
                             effect = "MODIFY" if os.path.exists(update["destination"]) else "NEW"
                             dtslogger.info(f"- Updating file ({effect}) [{update['relative']}]")
-                            # copy new file
-                            run_cmd(["sudo", "cp", update["origin"], update["destination"]])
-                            # get first line of file
-                            file_first_line = get_file_first_line(update["destination"])
-                            # only files containing a known placeholder will be part of the surgery
-                            if file_first_line.startswith(FILE_PLACEHOLDER_SIGNATURE):
-                                placeholder = file_first_line[len(FILE_PLACEHOLDER_SIGNATURE):]
+                        # create directory structure and apply changes from disk_template
+                        apply_disk_template(partition, template[partition])
+                        # only files containing a known placeholder will be part of the surgery
+                        for update in template[partition]["file"]:
+                            placeholder = update["placeholder"]
+                            if placeholder is not None:
                                 # get stats about file
                                 real_bytes, max_bytes = get_file_length(update["destination"])
                                 # saturate file so that it occupies the entire pagefile
-                                run_cmd(["sudo", "truncate",
-                                         f"--size={max_bytes}", update["destination"]])
+                                run_cmd(["sudo", "truncate", f"--size={max_bytes}", update["destination"]])
                                 # store preliminary info about the surgery
                                 surgery_plan.append(
                                     {
@@ -787,6 +881,15 @@ class DTCommand(DTCommandAbs):
                         # flush I/O buffer
                         dtslogger.info("Flushing I/O buffer...")
                         run_cmd(["sync"])
+                        # locate the files for surgery through the filesystem (when possible)
+                        for surgery_bit in surgery_plan:
+                            if surgery_bit["partition"] != partition:
+                                continue
+                            surgery_bit["offset_bytes"] = sd_card.locate_file(
+                                partition,
+                                os.path.join(PARTITION_MOUNTPOINT(partition), surgery_bit["path"].lstrip("/")),
+                                surgery_bit["length_bytes"],
+                            )
                         # ---
                         dtslogger.info(f"Partition {partition} updated!")
                     except Exception as e:
@@ -800,7 +903,13 @@ class DTCommand(DTCommandAbs):
                 raise e
             # finalize surgery plan
             dtslogger.info("Locating files for surgery in the disk image...")
-            placeholders = find_placeholders_on_disk(out_file_path("img"))
+            placeholders = find_placeholders_on_disk(
+                out_file_path("img"),
+                hints={
+                    f"{FILE_PLACEHOLDER_SIGNATURE}{bit['placeholder']}": bit["offset_bytes"]
+                    for bit in surgery_plan
+                },
+            )
             for i in range(len(surgery_plan)):
                 full_placeholder = f"{FILE_PLACEHOLDER_SIGNATURE}{surgery_plan[i]['placeholder']}"
                 # check if the placeholder was found
@@ -822,9 +931,12 @@ class DTCommand(DTCommandAbs):
         # Step: finalize
         if "finalize" in parsed.steps:
             dtslogger.info("Step BEGIN: finalize")
-            # compute image sha256
-            dtslogger.info(f"Computing SHA256 checksum of {out_file_path('img')}...")
-            disk_image_sha256 = sd_card.disk_image_sha()
+            # read the disk image once to compute its sha256 and the hashes of its blocks, and to
+            # compress it (if needed)
+            archive = ZipWriter(out_file_path("zip")) if "compress" in parsed.steps else None
+            dtslogger.info(f"Computing SHA256 checksum of {out_file_path('img')}" +
+                           (" and compressing it..." if archive else "..."))
+            disk_image_sha256 = _digest_disk_image(out_file_path("img"), out_file_path("blocks.json"), archive)
             dtslogger.info(f"SHA256: {disk_image_sha256}")
             # store surgery plan and other info
             dtslogger.info(f"Storing metadata in {out_file_path('json')}...")
@@ -857,9 +969,14 @@ class DTCommand(DTCommandAbs):
         # Step: compress
         if "compress" in parsed.steps:
             dtslogger.info("Step BEGIN: compress")
-            dtslogger.info("Compressing disk image...")
-            run_cmd(["zip", "-j", out_file_path("zip"),
-                     out_file_path("img"), out_file_path("json")])
+            # the disk image was already compressed by the step 'finalize'
+            if archive is None:
+                dtslogger.info("Compressing disk image...")
+                archive = ZipWriter(out_file_path("zip"))
+                _digest_disk_image(out_file_path("img"), out_file_path("blocks.json"), archive)
+            archive.write_file(out_file_path("json"))
+            archive.write_file(out_file_path("blocks.json"))
+            archive.close()
             dtslogger.info("Done!")
             cache_step('compress')
             dtslogger.info("Step END: compress\n")
@@ -902,12 +1019,13 @@ def _get_validator_fcn(partition, path):
     return None
 
 
-def _copy_file(origin, destination):
-    # create destination directory
-    os.makedirs(os.path.dirname(os.path.abspath(destination)), exist_ok=True)
-    # make copy of the file
-    dtslogger.info(f"Copying [{origin}] -> [{destination}]")
-    run_cmd(["cp", origin, destination])
+def _digest_disk_image(disk_image, manifest_path, archive):
+    pbar = ProgressBar()
+    disk_image_sha256 = digest_disk_image(
+        disk_image, manifest_path, archive, callback=lambda done, total: pbar.update(100 * done / max(1, total))
+    )
+    pbar.done()
+    return disk_image_sha256
 
 
 def transfer_file(partition, location):
@@ -11,6 +11,13 @@ import re
 import yaml
 import itertools
 import shutil
+import mmap
+import struct
+import stat
+import hashlib
+import tarfile
+import docker
+from concurrent.futures import ProcessPoolExecutor
 
 
 from utils.duckietown_utils import get_distro_version
@@ -22,7 +29,41 @@ from disk_image.create.constants import (
     MODULES_TO_LOAD,
     CLI_TOOLS_NEEDED,
 )
-from utils.cli_utils import ProgressBar, check_program_dependency
+from utils.cli_utils import check_program_dependency
+from utils.pull_utils import pull_images
+from utils.misc_utils import get_cache_dir
+from utils.registry_utils import get_registry_client
+
+# ioctl(2) used to get the physical extents of a file (linux/fiemap.h)
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_FLAG_SYNC = 0x00000001
+FIEMAP_HEADER = struct.Struct("=QQIIII")
+FIEMAP_EXTENT = struct.Struct("=QQQQQIIII")
+FIEMAP_MAX_EXTENTS = 32
+# extents with any of these flags cannot be written in place (unknown location, delayed
+# allocation, encoded, encrypted, not aligned, inline, tail-packed, unwritten)
+FIEMAP_EXTENT_UNSAFE = 0x2 | 0x4 | 0x8 | 0x80 | 0x100 | 0x200 | 0x400 | 0x800
+# placeholders are runs of printable characters (same as `strings`)
+PLACEHOLDER_PATTERN = re.compile(re.escape(FILE_PLACEHOLDER_SIGNATURE.encode()) + rb"[\x20-\x7e\t]*")
+# chunks scanned in parallel, they overlap so that placeholders across two chunks are found
+PLACEHOLDER_SCAN_CHUNK = 256 * 1024 ** 2
+PLACEHOLDER_SCAN_OVERLAP = 4096
+
+# reflink a whole file (Linux, supported by btrfs, XFS, etc.)
+FICLONE = 0x40049409
+COPY_CHUNK_SIZE = 8 * 1024 ** 2
+STEP_CACHE_CHUNK_SIZE = 4 * 1024 ** 2
+STEP_CACHE_MANIFEST_VERSION = 1
+STEP_CACHE_DEFAULT_MAX_SIZE_GB = 64
+# the packages installed by `apt` get updates, a cached upgrade is reused for this long (in days)
+STEP_CACHE_DEFAULT_UPGRADE_TTL_DAYS = 1
+HASH_CHUNK_SIZE = 1024 ** 2
+
+# pull-through cache of Docker Hub running on the build host
+REGISTRY_MIRROR_IMAGE = "registry:2"
+REGISTRY_MIRROR_CONTAINER = "dts-disk-image-registry-mirror"
+REGISTRY_MIRROR_PORT = 5000
+REGISTRY_MIRROR_REMOTE_URL = "https://registry-1.docker.io"
 
 
 class VirtualSDCard:
@@ -199,6 +240,29 @@ class VirtualSDCard:
                 raise e
         return None
 
+    def partition_offset(self, partition):
+        """
+        Returns the offset (in bytes) of the given partition within the disk image.
+        """
+        partition_dev = os.path.basename(self.partition_device(partition))
+        with open(f"/sys/class/block/{partition_dev}/start", "rt") as fin:
+            # sysfs reports the start of a partition in 512-byte sectors
+            return int(fin.read().strip()) * 512
+
+    def locate_file(self, partition, filepath, length):
+        """
+        Returns the offset (in bytes) of the given file within the disk image, as reported
+        by the filesystem, or None if the first `length` bytes of the file are not stored
+        contiguously (or the filesystem cannot tell).
+        """
+        extents = file_extents(filepath)
+        if not extents:
+            return None
+        logical, physical, extent_length, flags = extents[0]
+        if logical != 0 or extent_length < length or flags & FIEMAP_EXTENT_UNSAFE:
+            return None
+        return self.partition_offset(partition) + physical
+
     def _disk_by_label(self, partition):
         if self._loopdev:
             if partition not in self._partition_table:
@@ -213,25 +277,48 @@ def check_cli_tools():
 
 
 def pull_docker_image(client, image):
-    repository, tag = image.split(":")
-    pbar = ProgressBar()
-    total_layers = set()
-    completed_layers = set()
     dtslogger.info(f"Pulling image {image}...")
-    for step in client.api.pull(repository, tag, stream=True, decode=True):
-        if "status" not in step or "id" not in step:
-            continue
-        total_layers.add(step["id"])
-        if step["status"] in ["Download complete", "Pull complete"]:
-            completed_layers.add(step["id"])
-        # compute progress
-        if len(total_layers) > 0:
-            progress = int(100 * len(completed_layers) / len(total_layers))
-            pbar.update(progress)
-    pbar.update(100)
+    pull_images(client, [image], workers=1)
     dtslogger.info(f"Image pulled: {image}")
 
 
+def start_registry_mirror(client):
+    """
+    Starts (or reuses) a pull-through cache of Docker Hub on the given Docker engine and
+    returns its address (`host:port`). Layers are stored in the cache directory of the
+    shell, so that they survive across builds.
+    """
+    try:
+        container = client.containers.get(REGISTRY_MIRROR_CONTAINER)
+        if container.status != "running":
+            container.start()
+    except docker.errors.NotFound:
+        pull_docker_image(client, REGISTRY_MIRROR_IMAGE)
+        container = client.containers.run(
+            image=REGISTRY_MIRROR_IMAGE,
+            detach=True,
+            name=REGISTRY_MIRROR_CONTAINER,
+            restart_policy={"Name": "unless-stopped"},
+            environment={"REGISTRY_PROXY_REMOTEURL": REGISTRY_MIRROR_REMOTE_URL},
+            volumes={get_cache_dir("disk_image", "registry"): {"bind": "/var/lib/registry", "mode": "rw"}},
+        )
+    container.reload()
+    return f"{container.attrs['NetworkSettings']['IPAddress']}:{REGISTRY_MIRROR_PORT}"
+
+
+def registry_mirror_args(mirror):
+    """
+    Returns the arguments for `dockerd` to pull images from Docker Hub through the given
+    mirror (either `host:port` or a URL).
+    """
+    if "://" not in mirror:
+        mirror = f"http://{mirror}"
+    args = [f"--registry-mirror={mirror}"]
+    if mirror.startswith("http://"):
+        args.append(f"--insecure-registry={mirror[len('http://'):].rstrip('/')}")
+    return args
+
+
 def disk_template_partitions(disk_template_dir):
     return list(
         filter(lambda d: os.path.isdir(os.path.join(disk_template_dir, d)), os.listdir(disk_template_dir))
@@ -239,49 +326,172 @@ def disk_template_partitions(disk_template_dir):
 
 
 def disk_template_objects(disk_template_dir, partition, filter_type):
-    partition_template_dir = os.path.join(disk_template_dir, partition)
     # check if we know about this partition
-    if not os.path.isdir(partition_template_dir):
+    if not os.path.isdir(os.path.join(disk_template_dir, partition)):
         raise ValueError(f'Partition "{partition}" not found in disk template.')
-    # define filtering functions
-    filter_lambdas = {"file": os.path.isfile, "directory": os.path.isdir}
-    if filter_type not in filter_lambdas:
+    if filter_type not in ["file", "directory"]:
         raise ValueError('The argument filter_type can have values from ["file", "directory"].')
-    filter_lambda = filter_lambdas[filter_type]
-    # run glob, this returns absolute path of every file and dir under the partition template dir
-    glob_star = glob.glob(os.path.join(partition_template_dir, "**"), recursive=True)
-    return [
-        {
-            "origin": f,
-            "destination": os.path.join(
-                PARTITION_MOUNTPOINT(partition), os.path.relpath(f, partition_template_dir)
-            ),
-            "relative": "/" + os.path.relpath(f, partition_template_dir),
-        }
-        for f in glob_star
-        if filter_lambda(f)
+    return disk_template_manifest(disk_template_dir)[partition][filter_type]
+
+
+def disk_template_manifest(disk_template_dir):
+    """
+    Walks the disk template once and returns a dictionary {partition: {"directory": [...],
+    "file": [...]}}. Each object is a dictionary with the keys `origin`, `destination`,
+    `relative`, and `mode`. Files also have `placeholder`, the name of the placeholder
+    declared in their first line (or None).
+    """
+    manifest = {}
+    for partition in disk_template_partitions(disk_template_dir):
+        partition_template_dir = os.path.join(disk_template_dir, partition)
+        objects = {"directory": [], "file": []}
+        for root, dirs, files in os.walk(partition_template_dir):
+            dirs.sort()
+            entries = [("directory", d) for d in dirs] + [("file", f) for f in sorted(files)]
+            for filter_type, name in entries:
+                origin = os.path.join(root, name)
+                relative = os.path.relpath(origin, partition_template_dir)
+                obj = {
+                    "origin": origin,
+                    "destination": os.path.join(PARTITION_MOUNTPOINT(partition), relative),
+                    "relative": "/" + relative,
+                    "mode": os.stat(origin).st_mode,
+                }
+                if filter_type == "file":
+                    first_line = get_file_first_line(origin)
+                    obj["placeholder"] = first_line[len(FILE_PLACEHOLDER_SIGNATURE):] \
+                        if first_line.startswith(FILE_PLACEHOLDER_SIGNATURE) else None
+                objects[filter_type].append(obj)
+        manifest[partition] = objects
+    return manifest
+
+
+def existing_files_stat(paths):
+    """
+    Returns a dictionary {path: (mode, uid, gid)} with the given files that exist in a mounted
+    partition. Files that cannot be accessed by the current user are inspected with a single
+    `sudo stat` call.
+    """
+    stats, denied = {}, []
+    for path in paths:
+        try:
+            fstat = os.lstat(path)
+            stats[path] = fstat.st_mode, fstat.st_uid, fstat.st_gid
+        except FileNotFoundError:
+            pass
+        except PermissionError:
+            denied.append(path)
+    if not denied:
+        return stats
+    # paths are passed through stdin, `stat` fails (and prints nothing) for files that do not exist
+    proc = subprocess.run(
+        ["sudo", "xargs", "-0", "stat", "--printf", "%f %u %g %n\\0"],
+        input=b"\0".join(path.encode("utf-8") for path in denied),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    for record in proc.stdout.split(b"\0"):
+        if not record:
+            continue
+        mode, uid, gid, path = record.decode("utf-8").split(" ", 3)
+        stats[path] = int(mode, 16), int(uid), int(gid)
+    return stats
+
+
+def apply_disk_template(partition, objects):
+    """
+    Copies the directories and files of a partition of the disk template (as returned by
+    `disk_template_manifest`) to the mounted partition. Objects are sent to a single
+    privileged `tar` process. Like `cp` would do, existing directories (and symlinks to
+    directories) are left untouched, files replacing existing ones keep their permissions
+    and owner, new files and directories are owned by root.
+    """
+    existing = existing_files_stat([obj["destination"] for obj in objects["file"]])
+    proc = subprocess.Popen(
+        [
+            "sudo", "tar", "-x", "--no-overwrite-dir", "--keep-directory-symlink",
+            "-C", PARTITION_MOUNTPOINT(partition),
+        ],
+        stdin=subprocess.PIPE,
+    )
+    try:
+        with tarfile.open(fileobj=proc.stdin, mode="w|", format=tarfile.GNU_FORMAT) as tar:
+            for obj in objects["directory"] + objects["file"]:
+                tarinfo = tar.gettarinfo(obj["origin"], arcname=obj["relative"].lstrip("/"))
+                tarinfo.uid = tarinfo.gid = 0
+                tarinfo.uname = tarinfo.gname = "root"
+                # same permissions `cp` would give the file with the default umask (022)
+                tarinfo.mode = obj["mode"] & 0o7755
+                current = existing.get(obj["destination"]) if tarinfo.isfile() else None
+                if current is not None and stat.S_ISREG(current[0]):
+                    # `cp` overwrites the content of an existing file, its mode and owner are kept
+                    tarinfo.mode = stat.S_IMODE(current[0])
+                    tarinfo.uid, tarinfo.gid = current[1:]
+                    tarinfo.uname = tarinfo.gname = ""
+                if tarinfo.isfile():
+                    with open(obj["origin"], "rb") as fin:
+                        tar.addfile(tarinfo, fin)
+                else:
+                    tar.addfile(tarinfo)
+    finally:
+        proc.stdin.close()
+        proc.wait()
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+
+def file_extents(filepath):
+    """
+    Returns the list of extents (logical, physical, length, flags) of a file using the
+    FIEMAP ioctl, or None if the filesystem does not support it.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        return None
+    request = bytearray(FIEMAP_HEADER.size + FIEMAP_EXTENT.size * FIEMAP_MAX_EXTENTS)
+    FIEMAP_HEADER.pack_into(request, 0, 0, 0xFFFFFFFFFFFFFFFF, FIEMAP_FLAG_SYNC, 0, FIEMAP_MAX_EXTENTS, 0)
+    try:
+        with open(filepath, "rb") as fin:
+            fcntl.ioctl(fin.fileno(), FS_IOC_FIEMAP, request)
+    except OSError as e:
+        dtslogger.debug(f"Could not get the extents of {filepath}: {str(e)}")
+        return None
+    num_extents = FIEMAP_HEADER.unpack_from(request, 0)[3]
+    extents = []
+    for i in range(num_extents):
+        extent = FIEMAP_EXTENT.unpack_from(request, FIEMAP_HEADER.size + i * FIEMAP_EXTENT.size)
+        logical, physical, length, _, _, flags = extent[:6]
+        extents.append((logical, physical, length, flags))
+    return extents
+
+
+def find_placeholders_on_disk(disk_image, hints=None):
+    """
+    Returns a dictionary {placeholder: offset} with the position of the placeholders in the
+    disk image. `hints` can map the placeholders we are looking for to their expected
+    offset (e.g., as given by VirtualSDCard.locate_file), if all of them are confirmed
+    the disk image is not scanned.
+    """
+    if hints and None not in hints.values():
+        placeholders = _check_placeholders_on_disk(disk_image, hints)
+        if placeholders is not None:
+            dtslogger.debug(f"All {len(placeholders)} placeholders found at the expected offsets.")
+            return placeholders
+        dtslogger.debug("Some placeholders were not found at the expected offsets, scanning the disk image.")
+    # scan the disk image in parallel
+    chunks = [
+        (disk_image, chunk_start, min(range_end, chunk_start + PLACEHOLDER_SCAN_CHUNK))
+        for range_start, range_end in _data_ranges(disk_image)
+        for chunk_start in range(range_start, range_end, PLACEHOLDER_SCAN_CHUNK)
     ]
-
-
-def find_placeholders_on_disk(disk_image):
-    matches = run_cmd(
-        ["strings", "-t", "d", disk_image, "|", "grep", f'"{FILE_PLACEHOLDER_SIGNATURE}"'],
-        get_output=True,
-        shell=True,
-    ).splitlines()
-    # parse matches
-    matches = map(lambda m: m.split(" ")[::-1], matches)
-    matches = list(map(lambda m: (m[0], int(m[1])), matches))
-    # fix offset for strings attached to content from contiguous page
+    with ProcessPoolExecutor() as executor:
+        matches = list(itertools.chain.from_iterable(executor.map(_scan_placeholders, *zip(*chunks)))) \
+            if chunks else []
     placeholders = {}
     for string, offset in matches:
-        idx = string.index(FILE_PLACEHOLDER_SIGNATURE)
-        string = string[idx:]
-        placeholders[string] = offset + idx
-        dtslogger.debug(
-            f"Found placeholder {string} at position {placeholders[string]} "
-            f"(match was at {offset} w/ correction of {idx} bytes)."
-        )
+        placeholders[string] = offset
+        dtslogger.debug(f"Found placeholder {string} at position {offset}.")
     # make sure matches are unique
     if len(placeholders) != len(matches):
         pholders = map(lambda m: m[0], matches)
@@ -295,6 +505,421 @@ def find_placeholders_on_disk(disk_image):
     return placeholders
 
 
+def _check_placeholders_on_disk(disk_image, hints):
+    placeholders = {}
+    with open(disk_image, "rb") as fin:
+        for placeholder, offset in hints.items():
+            fin.seek(offset)
+            match = PLACEHOLDER_PATTERN.match(fin.read(len(placeholder) + 1))
+            if match is None or match.group(0).decode("ascii") != placeholder:
+                return None
+            placeholders[placeholder] = offset
+    return placeholders
+
+
+def _data_ranges(fpath):
+    """
+    Returns the list of ranges (start, end) of a (sparse) file that contain data.
+    """
+    size = os.path.getsize(fpath)
+    if not hasattr(os, "SEEK_DATA"):
+        return [(0, size)] if size else []
+    ranges = []
+    with open(fpath, "rb") as fin:
+        fd = fin.fileno()
+        offset = 0
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError:
+                # no data after `offset`
+                break
+            end = os.lseek(fd, start, os.SEEK_HOLE)
+            ranges.append((start, end))
+            offset = end
+    return ranges
+
+
+def _scan_placeholders(fpath, start, end):
+    # placeholders starting in [start, end) are reported, even if they end after `end`
+    matches = []
+    with open(fpath, "rb") as fin:
+        size = os.fstat(fin.fileno()).st_size
+        with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for match in PLACEHOLDER_PATTERN.finditer(mm, start, min(size, end + PLACEHOLDER_SCAN_OVERLAP)):
+                if match.start() >= end:
+                    break
+                matches.append((match.group(0).decode("ascii"), match.start()))
+    return matches
+
+
+def reflink_file(origin, destination):
+    """
+    Makes `destination` a copy-on-write clone of `origin`. Returns False if the filesystem
+    (or the OS) does not support reflinks, in which case `destination` is not created.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    with open(origin, "rb") as fin, open(destination, "wb") as fout:
+        try:
+            fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+            return True
+        except OSError as e:
+            dtslogger.debug(f"Could not reflink {origin} -> {destination}: {str(e)}")
+    os.remove(destination)
+    return False
+
+
+def copy_disk_image(origin, destination, size=None):
+    """
+    Copies a (sparse) disk image. The copy is a reflink when the filesystem supports it,
+    otherwise only the ranges of `origin` that contain data are copied and the holes are
+    preserved. If `size` is given, the copy is extended (with a hole) to `size` bytes.
+    Returns the method used, either "reflink" or "sparse".
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(destination)), exist_ok=True)
+    if reflink_file(origin, destination):
+        method = "reflink"
+    else:
+        method = "sparse"
+        with open(origin, "rb") as fin, open(destination, "wb") as fout:
+            for start, end in _data_ranges(origin):
+                _copy_range(fin.fileno(), fout.fileno(), start, end - start)
+            os.ftruncate(fout.fileno(), os.fstat(fin.fileno()).st_size)
+    if size is not None and os.path.getsize(destination) < size:
+        os.truncate(destination, size)
+    return method
+
+
+def _copy_range(fd_in, fd_out, offset, length):
+    end = offset + length
+    while offset < end:
+        n = min(COPY_CHUNK_SIZE, end - offset)
+        if hasattr(os, "copy_file_range"):
+            try:
+                copied = os.copy_file_range(fd_in, fd_out, n, offset, offset)
+            except OSError:
+                copied = os.pwrite(fd_out, os.pread(fd_in, n, offset), offset)
+        else:
+            copied = os.pwrite(fd_out, os.pread(fd_in, n, offset), offset)
+        if copied <= 0:
+            raise IOError(f"Unexpected end of file while copying at offset {offset}")
+        offset += copied
+
+
+class StepCache:
+    """
+    Stores the disk image at the end of a step so that a later run can start from there.
+
+    When the filesystem supports reflinks, a cached step is a copy-on-write clone of the
+    disk image stored in `<cache_dir>/<name>.<step>`, so that it costs (almost) nothing.
+    Otherwise, the disk image is split into chunks stored in a content-addressed store
+    (`<cache_dir>/objects/`), and the step is recorded as a manifest `<name>.<step>.json`
+    mapping offsets to chunks. Empty chunks are not stored, chunks shared with other
+    steps are stored only once.
+    """
+
+    def __init__(self, cache_dir, name):
+        self._cache_dir = cache_dir
+        self._name = name
+
+    def image_path(self, step):
+        return os.path.join(self._cache_dir, f"{self._name}.{step}")
+
+    def manifest_path(self, step):
+        return os.path.join(self._cache_dir, f"{self._name}.{step}.json")
+
+    def object_path(self, digest):
+        return os.path.join(self._cache_dir, "objects", digest[:2], digest)
+
+    def has(self, step):
+        return os.path.isfile(self.image_path(step)) or os.path.isfile(self.manifest_path(step))
+
+    def record(self, step, disk_image):
+        os.makedirs(self._cache_dir, exist_ok=True)
+        image_path = self.image_path(step)
+        manifest_path = self.manifest_path(step)
+        tmp_path = image_path + ".tmp"
+        if reflink_file(disk_image, tmp_path):
+            os.replace(tmp_path, image_path)
+            if os.path.isfile(manifest_path):
+                os.remove(manifest_path)
+            dtslogger.debug(f"Step '{step}' cached as a reflink of the disk image.")
+        else:
+            manifest = self._store_chunks(disk_image)
+            with open(manifest_path + ".tmp", "wt") as fout:
+                json.dump(manifest, fout)
+            os.replace(manifest_path + ".tmp", manifest_path)
+            if os.path.isfile(image_path):
+                os.remove(image_path)
+            dtslogger.debug(f"Step '{step}' cached as {len(manifest['chunks'])} chunks.")
+        self.prune()
+
+    def restore(self, step, destination, size=None):
+        image_path = self.image_path(step)
+        if os.path.isfile(image_path):
+            return copy_disk_image(image_path, destination, size=size)
+        with open(self.manifest_path(step), "rt") as fin:
+            manifest = json.load(fin)
+        with open(destination, "wb") as fout:
+            fd = fout.fileno()
+            for offset, digest in manifest["chunks"]:
+                with open(self.object_path(digest), "rb") as fin:
+                    data = fin.read()
+                os.pwrite(fd, data, offset)
+            os.ftruncate(fd, max(manifest["size"], size or 0))
+        return "chunks"
+
+    def remove(self, step):
+        for fpath in [self.image_path(step), self.manifest_path(step)]:
+            if os.path.isfile(fpath):
+                os.remove(fpath)
+        self.prune()
+
+    def disk_usage(self):
+        """
+        Returns the space (in bytes) used by the cache on disk. Extents shared by reflinks are
+        counted once per file.
+        """
+        usage = 0
+        for root, _, files in os.walk(self._cache_dir):
+            for fname in files:
+                usage += os.lstat(os.path.join(root, fname)).st_blocks * 512
+        return usage
+
+    def prune(self):
+        """
+        Removes the chunks that are not used by any cached step.
+        """
+        objects_dir = os.path.join(self._cache_dir, "objects")
+        if not os.path.isdir(objects_dir):
+            return
+        used = set()
+        for manifest_path in glob.glob(os.path.join(self._cache_dir, "*.json")):
+            with open(manifest_path, "rt") as fin:
+                used.update(digest for _, digest in json.load(fin)["chunks"])
+        for object_path in glob.glob(os.path.join(objects_dir, "*", "*")):
+            if os.path.basename(object_path) not in used:
+                os.remove(object_path)
+
+    def _store_chunks(self, disk_image):
+        chunks = []
+        zeros = bytes(STEP_CACHE_CHUNK_SIZE)
+        with open(disk_image, "rb") as fin:
+            fd = fin.fileno()
+            size = os.fstat(fd).st_size
+            # chunks are aligned, so that the same content is found at the same offsets
+            offsets = sorted(set(
+                offset
+                for start, end in _data_ranges(disk_image)
+                for offset in range(start - start % STEP_CACHE_CHUNK_SIZE, end, STEP_CACHE_CHUNK_SIZE)
+            ))
+            for offset in offsets:
+                data = os.pread(fd, min(STEP_CACHE_CHUNK_SIZE, size - offset), offset)
+                # holes are restored for free
+                if data == zeros[: len(data)]:
+                    continue
+                digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+                object_path = self.object_path(digest)
+                if not os.path.isfile(object_path):
+                    os.makedirs(os.path.dirname(object_path), exist_ok=True)
+                    with open(object_path + ".tmp", "wb") as fout:
+                        fout.write(data)
+                    os.replace(object_path + ".tmp", object_path)
+                chunks.append((offset, digest))
+        return {
+            "version": STEP_CACHE_MANIFEST_VERSION,
+            "size": size,
+            "chunk_size": STEP_CACHE_CHUNK_SIZE,
+            "chunks": chunks,
+        }
+
+
+class AutoStepCache:
+    """
+    Caches the disk image at the end of a step automatically, keyed by the fingerprint of
+    the inputs of all the steps performed so far (see `fingerprint`). A later build with the
+    same inputs can resume from the latest step whose fingerprint is in the cache.
+
+    Entries are stored in a StepCache and indexed in `<cache_dir>/auto/index.json` together
+    with some state of the build (e.g., the surgery plan). The least recently used entries
+    are evicted when the cache grows bigger than `max_size` bytes.
+    """
+
+    def __init__(self, cache_dir, name, max_size):
+        self._cache = StepCache(cache_dir, name)
+        self._index_path = os.path.join(cache_dir, "auto", "index.json")
+        self._max_size = max_size
+
+    @staticmethod
+    def key(fprint):
+        return f"auto-{fprint[:24]}"
+
+    def lookup(self, step_fingerprints):
+        """
+        Returns the (step, fingerprint) of the latest step in the list of pairs (step, fingerprint)
+        that is in the cache, or None.
+        """
+        index = self._load_index()
+        for step, fprint in reversed(step_fingerprints):
+            if fprint is not None and self.key(fprint) in index and self._cache.has(self.key(fprint)):
+                return step, fprint
+        return None
+
+    def state(self, fprint):
+        return self._load_index()[self.key(fprint)].get("state", {})
+
+    def restore(self, fprint, destination):
+        key = self.key(fprint)
+        method = self._cache.restore(key, destination)
+        index = self._load_index()
+        index[key]["last_used"] = time.time()
+        self._save_index(index)
+        return method
+
+    def record(self, step, fprint, disk_image, state=None):
+        key = self.key(fprint)
+        index = self._load_index()
+        if key not in index or not self._cache.has(key):
+            self._cache.record(key, disk_image)
+        index[key] = {"step": step, "fingerprint": fprint, "state": state or {}, "last_used": time.time()}
+        self._save_index(index)
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        index = self._load_index()
+        usage = self._cache.disk_usage()
+        for key, entry in sorted(index.items(), key=lambda kv: kv[1]["last_used"]):
+            if usage <= self._max_size:
+                break
+            if key == keep:
+                continue
+            dtslogger.info(f"Evicting cached step '{entry['step']}' ({key}) from the cache.")
+            self._cache.remove(key)
+            del index[key]
+            usage = self._cache.disk_usage()
+        self._save_index(index)
+
+    def _load_index(self):
+        if not os.path.isfile(self._index_path):
+            return {}
+        with open(self._index_path, "rt") as fin:
+            return json.load(fin)
+
+    def _save_index(self, index):
+        os.makedirs(os.path.dirname(self._index_path), exist_ok=True)
+        with open(self._index_path + ".tmp", "wt") as fout:
+            json.dump(index, fout, indent=4, sort_keys=True)
+        os.replace(self._index_path + ".tmp", self._index_path)
+
+
+def fingerprint(*inputs):
+    """
+    Returns a hex digest identifying the given (JSON-serializable) inputs.
+    """
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def time_window(ttl_days: float) -> int:
+    """
+    Returns the index of the current window of time of `ttl_days` days, it changes (and so do the
+    fingerprints that include it) every `ttl_days` days. A non-positive TTL changes every second.
+    """
+    if ttl_days <= 0:
+        return int(time.time())
+    return int(time.time() // (ttl_days * 86400))
+
+
+def fingerprint_steps(steps, step_inputs, salt, known):
+    """
+    Returns a list of pairs (step, fingerprint) for the given steps (in order) that appear in
+    `step_inputs`, a dictionary mapping steps to functions returning their inputs. The
+    fingerprint of a step covers the inputs of all the steps before it, it is None if the inputs
+    of the step (or of a step before it) are not known (yet), e.g., the base disk image was not
+    downloaded. The inputs computed are stored in `known` and not computed again.
+    """
+    fprint = fingerprint(salt)
+    fingerprints = []
+    for step in steps:
+        if step not in step_inputs:
+            continue
+        if fprint is not None and step not in known:
+            try:
+                inputs = step_inputs[step]()
+            except Exception as e:
+                dtslogger.warning(f"Could not fingerprint the inputs of the step '{step}': {str(e)}")
+                inputs = [None]
+            if None not in inputs:
+                known[step] = inputs
+        fprint = fingerprint(fprint, step, known[step]) if fprint is not None and step in known else None
+        fingerprints.append((step, fprint))
+    return fingerprints
+
+
+def file_sha256(filepath, memo_file=None):
+    """
+    Returns the SHA256 of a file. If `memo_file` is given, hashes are remembered there
+    (by path, size and modification time), and the last known hash of a file that does
+    not exist anymore is returned. Returns None if the file does not exist and no hash
+    is known.
+    """
+    filepath = os.path.abspath(filepath)
+    memo = {}
+    if memo_file is not None and os.path.isfile(memo_file):
+        with open(memo_file, "rt") as fin:
+            memo = json.load(fin)
+    known = memo.get(filepath)
+    if not os.path.isfile(filepath):
+        return known["sha256"] if known else None
+    fstat = os.stat(filepath)
+    if known and known["size"] == fstat.st_size and known["mtime_ns"] == fstat.st_mtime_ns:
+        return known["sha256"]
+    hasher = hashlib.sha256()
+    with open(filepath, "rb") as fin:
+        for chunk in iter(lambda: fin.read(HASH_CHUNK_SIZE), b""):
+            hasher.update(chunk)
+    digest = hasher.hexdigest()
+    if memo_file is not None:
+        memo[filepath] = {"size": fstat.st_size, "mtime_ns": fstat.st_mtime_ns, "sha256": digest}
+        os.makedirs(os.path.dirname(os.path.abspath(memo_file)), exist_ok=True)
+        with open(memo_file, "wt") as fout:
+            json.dump(memo, fout, indent=4, sort_keys=True)
+    return digest
+
+
+def directory_fingerprint(dirpath):
+    """
+    Returns a hex digest of the content of a directory (paths, permissions and content).
+    """
+    hasher = hashlib.sha256()
+    for root, dirs, files in os.walk(dirpath):
+        dirs.sort()
+        for name in sorted(dirs + files):
+            fpath = os.path.join(root, name)
+            fstat = os.lstat(fpath)
+            hasher.update(f"{os.path.relpath(fpath, dirpath)}\0{fstat.st_mode:o}\0".encode("utf-8"))
+            if os.path.islink(fpath):
+                hasher.update(os.readlink(fpath).encode("utf-8"))
+            elif os.path.isfile(fpath):
+                hasher.update(file_sha256(fpath).encode("ascii"))
+    return hasher.hexdigest()
+
+
+def resolve_image_digests(images):
+    """
+    Resolves a list of Docker images (`owner/module:tag`) to the digests of their
+    configuration (i.e., their content) on Docker Hub.
+    """
+    registry = get_registry_client()
+    digests = {}
+    for image in images:
+        repository, tag = image.rsplit(":", 1)
+        digests[image] = registry.manifest(repository, tag)["config"]["digest"]
+    return digests
+
+
 def get_file_first_line(filepath):
     with open(filepath, "rt") as f:
         try:
@@ -306,9 +931,9 @@ def get_file_first_line(filepath):
 
 
 def get_file_length(filepath):
-    stat_out = run_cmd(["stat", "--format", "%s,%b,%B", filepath], get_output=True)
-    real_size, num_blocks, block_size = stat_out.strip().split(",")
-    return int(real_size), int(num_blocks) * int(block_size)
+    fstat = os.stat(filepath)
+    # st_blocks is always in units of 512 bytes
+    return fstat.st_size, fstat.st_blocks * 512
 
 
 def run_cmd(cmd, get_output=False, shell=False, env=None):
@@ -7,7 +7,8 @@ import argparse
 from collections import OrderedDict
 from termcolor import colored
 from datetime import datetime
-from threading import Thread, Semaphore
+from threading import Semaphore
+from concurrent.futures import ThreadPoolExecutor
 
 from dt_shell import DTCommandAbs, dtslogger, DTShell
 from utils.docker_utils import get_client, get_endpoint_architecture_from_ip, get_remote_client
@@ -15,6 +16,7 @@ from utils.dtproject_utils import dtlabel, DTProject
 from utils.cli_utils import ProgressBar, ask_confirmation
 from utils.duckietown_utils import get_distro_version
 from utils.networking_utils import get_duckiebot_ip
+from utils.pull_utils import ImagePuller, DEFAULT_PULL_WORKERS
 
 
 class DTCommand(DTCommandAbs):
@@ -36,6 +38,13 @@ class DTCommand(DTCommandAbs):
             default=get_distro_version(shell),
             help="Only update images of this Duckietown distro",
         )
+        parser.add_argument(
+            "-j",
+            "--parallel",
+            type=int,
+            default=DEFAULT_PULL_WORKERS,
+            help="Number of modules to check and update in parallel",
+        )
         parser.add_argument("hostname", nargs=1, help="Name of the Duckiebot to check software status for")
         # parse arguments
         parsed = parser.parse_args(args)
@@ -67,47 +76,14 @@ class DTCommand(DTCommandAbs):
         for image in images:
             updates_monitor[image.tags[0]] = ("...", None)
 
-        # check which images need update
-        need_update = []
+        # check which images need update (in parallel)
         try:
-            for image in images:
-                # get image name
-                name = image.tags[0]
-                # fetch remote image labels
-                labels = _get_remote_labels(name)
-                if labels is None:
-                    # image is not available online
-                    updates_monitor[name] = ("not found", None)
-                    continue
-                # fetch local and remote build time
-                updates_monitor[name] = ("checking", None)
-                image_time_str = image.labels.get(dtlabel("time"), "ND")
-                image_time = _parse_time(image_time_str)
-                remote_time = _parse_time(labels[dtlabel("time")]) if dtlabel("time") in labels else "ND"
-                # show error, up-to-date or to update
-                if remote_time is None:
-                    # remote build time could not be fetched, error
-                    updates_monitor[name] = ("error", "red")
-                    continue
-                if image_time is None or image_time < remote_time:
-                    # the remote copy is newer than the local, fetch versions
-                    version_lbl = dtlabel("code.version.head")
-                    local_version = image.labels.get(version_lbl, "devel")
-                    remote_version = labels[version_lbl] if version_lbl in labels else "ND"
-                    # show OLDv -> NEWv
-                    version_transition = (
-                        f"({local_version} -> {remote_version})" if remote_version != "ND" else ""
-                    )
-                    # update monitor
-                    updates_monitor[name] = (f"update available {version_transition}", "yellow")
-                    need_update.append(name)
-                    continue
-                else:
-                    # module is up-to-date
-                    updates_monitor[name] = ("up-to-date", "green")
+            with ThreadPoolExecutor(max_workers=max(1, parsed.parallel)) as executor:
+                needs = list(executor.map(lambda i: _check_image(i, updates_monitor), images))
         except KeyboardInterrupt:
             dtslogger.info("Aborted")
             exit(0)
+        need_update = [image.tags[0] for image, need in zip(images, needs) if need]
         print()
 
         # nothing to do
@@ -132,19 +108,17 @@ class DTCommand(DTCommandAbs):
                 updates_monitor[name] = ("waiting", "yellow")
 
         # start update
-        workers = []
-        for image in need_update:
-            t = Thread(target=_pull_docker_image, args=(docker, image, updates_monitor))
-            workers.append(t)
-
-        # wait for the update to finish
         try:
-            for t in workers:
-                t.start()
-                t.join()
+            errors = _pull_docker_images(docker, need_update, updates_monitor, parsed.parallel)
         except KeyboardInterrupt:
             exit(0)
         print()
+        failed = [image for image, error in errors.items() if error is not None]
+        for image in failed:
+            dtslogger.error(f"Error while pulling {image}: {str(errors[image])}")
+        if failed:
+            dtslogger.error(f"Update failed for {len(failed)} module(s).")
+            exit(1)
         dtslogger.info("Update complete!")
 
 
@@ -173,28 +147,56 @@ def _get_remote_labels(image):
     return labels
 
 
-def _pull_docker_image(client, image, monitor):
-    try:
-        repository, tag = image.split(":")
-        buffer = io.StringIO()
-        pbar = ProgressBar(scale=0.3, buf=buffer)
-        total_layers = set()
-        completed_layers = set()
-        for step in client.api.pull(repository, tag, stream=True, decode=True):
-            if "status" not in step or "id" not in step:
-                continue
-            total_layers.add(step["id"])
-            if step["status"] in ["Pull complete", "Already exists"]:
-                completed_layers.add(step["id"])
-            # compute progress
-            if len(total_layers) > 0:
-                progress = int(100 * len(completed_layers) / len(total_layers))
-                pbar.update(progress)
-                monitor[image] = (buffer.getvalue().strip("\n"), None)
-        pbar.update(100)
-        monitor[image] = ("updated", "green")
-    except KeyboardInterrupt:
-        return
+def _check_image(image, monitor):
+    # get image name
+    name = image.tags[0]
+    monitor[name] = ("checking", None)
+    # fetch remote image labels
+    labels = _get_remote_labels(name)
+    if labels is None:
+        # image is not available online
+        monitor[name] = ("not found", None)
+        return False
+    # fetch local and remote build time
+    image_time_str = image.labels.get(dtlabel("time"), "ND")
+    image_time = _parse_time(image_time_str)
+    remote_time = _parse_time(labels[dtlabel("time")]) if dtlabel("time") in labels else "ND"
+    # show error, up-to-date or to update
+    if remote_time is None:
+        # remote build time could not be fetched, error
+        monitor[name] = ("error", "red")
+        return False
+    if image_time is None or image_time < remote_time:
+        # the remote copy is newer than the local, fetch versions
+        version_lbl = dtlabel("code.version.head")
+        local_version = image.labels.get(version_lbl, "devel")
+        remote_version = labels[version_lbl] if version_lbl in labels else "ND"
+        # show OLDv -> NEWv
+        version_transition = f"({local_version} -> {remote_version})" if remote_version != "ND" else ""
+        # update monitor
+        monitor[name] = (f"update available {version_transition}", "yellow")
+        return True
+    # module is up-to-date
+    monitor[name] = ("up-to-date", "green")
+    return False
+
+
+def _pull_docker_images(client, images, monitor, parallel):
+    buffers = {image: io.StringIO() for image in images}
+    pbars = {image: ProgressBar(scale=0.3, buf=buffers[image]) for image in images}
+
+    def _progress(puller, image):
+        pbars[image].update(puller.image_percentage(image))
+        if puller.image_percentage(image) >= 100:
+            monitor[image] = ("updated", "green")
+        else:
+            monitor[image] = (buffers[image].getvalue().strip(), None)
+
+    errors = ImagePuller(client, workers=parallel, callback=_progress).pull(images)
+    for image, error in errors.items():
+        if error is not None:
+            monitor[image] = ("error", "red")
+    return errors
 
 
 class UpdatesMonitor(OrderedDict):
@@ -4,7 +4,15 @@ import argparse
 import os
 
 import docker
-import nbformat  # install before?
+from utils.misc_utils import import_or_install
+
+# to clone the mooc repo
+import_or_install("gitpython", "git")
+# to convert the notebook into a python script
+import_or_install("nbformat", "nbformat")
+import_or_install("nbconvert", "nbconvert")
+
+import nbformat
 from nbconvert.exporters import PythonExporter
 import yaml
 from dt_shell import DTCommandAbs, dtslogger
@@ -6,7 +6,15 @@ import sys
 import signal
 import platform
 import subprocess
-import nbformat  # install before?
+from utils.misc_utils import import_or_install
+
+# to clone the mooc repo
+import_or_install("gitpython", "git")
+# to convert the notebook into a python script
+import_or_install("nbformat", "nbformat")
+import_or_install("nbconvert", "nbconvert")
+
+import nbformat
 from nbconvert.exporters import PythonExporter
 import yaml
 import requests
@@ -0,0 +1,64 @@
+import argparse
+
+from dt_shell import DTCommandAbs, dtslogger
+
+from utils.discovery_utils import agent_pid, agent_socket_path, run_agent, start_agent, stop_agent
+
+usage = """
+
+## Basic usage
+
+    Manages the background discovery agent. While running, the agent keeps a live table
+    of the Duckietown devices on the local network, commands query it instead of
+    discovering the devices themselves.
+
+    To find out more, use `dts fleet agent -h`.
+
+        $ dts fleet agent {start,stop,status,run}
+
+"""
+
+
+class DTCommand(DTCommandAbs):
+
+    help = "Manages the background discovery agent"
+
+    @staticmethod
+    def command(shell, args):
+        prog = "dts fleet agent"
+        parser = argparse.ArgumentParser(prog=prog, usage=usage)
+        parser.add_argument(
+            "action",
+            nargs="?",
+            default="status",
+            choices=["start", "stop", "status", "run"],
+            help="Start/stop the agent in background, show its status, or run it in foreground",
+        )
+        parsed = parser.parse_args(args)
+        # ---
+        if parsed.action == "start":
+            try:
+                pid = start_agent()
+            except RuntimeError as e:
+                dtslogger.error(str(e))
+                exit(1)
+            dtslogger.info(f"Discovery agent running (PID: {pid}).")
+        elif parsed.action == "stop":
+            if stop_agent():
+                dtslogger.info("Discovery agent stopped.")
+            else:
+                dtslogger.info("Discovery agent not running.")
+        elif parsed.action == "status":
+            pid = agent_pid()
+            if pid is None:
+                dtslogger.info("Discovery agent not running.")
+            else:
+                dtslogger.info(f"Discovery agent running (PID: {pid}) on {agent_socket_path()}.")
+        elif parsed.action == "run":
+            try:
+                run_agent()
+            except RuntimeError as e:
+                dtslogger.error(str(e))
+                exit(1)
+            except KeyboardInterrupt:
+                pass
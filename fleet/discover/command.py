@@ -1,15 +1,36 @@
-import os
+import sys
 import json
 import time
 import argparse
 import logging
-from collections import defaultdict
 from dt_shell import DTCommandAbs, dtslogger
 
-from utils.table_utils import format_matrix, fill_cell
+from utils.table_utils import fill_cell
 from utils.duckietown_utils import get_robot_types
+from utils.discovery_utils import get_discovery, AgentClient
 
 REFRESH_HZ = 1.0
+# the table is redrawn at most this often, no matter how many devices come and go
+MAX_REDRAW_HZ = 10.0
+# how long the snapshot modes wait for the devices to announce themselves (in seconds)
+DEFAULT_SNAPSHOT_WAIT = 3.0
+
+COLUMNS = [
+    "Status",  # Booting [yellow], Ready [green]
+    "Internet",  # No [grey], Yes [green]
+    "Dashboard",  # Down [grey], Up [green]
+    "Busy",  # No [grey], Yes [green]
+]
+COLUMN_DELIMITER = " | "
+NOTE = "NOTE: Only devices flashed using duckietown-shell-commands v4.1.0+ are supported."
+
+# ANSI escape sequences
+ANSI_CLEAR_SCREEN = "\x1b[2J\x1b[H"
+ANSI_MOVE_TO_LINE = "\x1b[{};1H"
+ANSI_CLEAR_LINE = "\x1b[K"
+ANSI_CLEAR_BELOW = "\x1b[J"
+ANSI_HIDE_CURSOR = "\x1b[?25l"
+ANSI_SHOW_CURSOR = "\x1b[?25h"
 
 usage = """
 
@@ -21,115 +42,141 @@ usage = """
 
         $ dts fleet discover [options]
 
+    Print the devices found once, as a table or as JSON, and exit:
+
+        $ dts fleet discover --once
+        $ dts fleet discover --json
+
 """
 
 
-class DiscoverListener:
-
-    services = defaultdict(dict)
-    supported_services = [
-        "DT::ONLINE",
-        "DT::PRESENCE",
-        "DT::BOOTING",
-        "DT::ROBOT_TYPE",
-        "DT::ROBOT_CONFIGURATION",
-        "DT::DASHBOARD",
-    ]
-
-    def __init__(self, args):
-        self.args = args
-
-    def process_service_name(self, name):
-        name = name.replace("._duckietown._tcp.local.", "")
-        service_parts = name.split("::")
-        if len(service_parts) != 3 or service_parts[0] != "DT":
-            return None, None
-        name = "{}::{}".format(service_parts[0], service_parts[1])
-        server = service_parts[2]
-        return name, server
-
-    def remove_service(self, zeroconf, type, name):
-        dtslogger.debug("SERVICE_REM: %s (%s)" % (str(name), str(type)))
-        name, server = self.process_service_name(name)
-        if not name:
-            return
-        del self.services[name][server]
+def device_state(hostname: str, services: dict) -> dict:
+    """
+    Returns the state of a device given the services it announces, {service: record}.
+    """
 
-    def add_service(self, zeroconf, type, sname):
-        dtslogger.debug("SERVICE_ADD: %s (%s)" % (str(sname), str(type)))
-        name, server = self.process_service_name(sname)
-        if not name:
-            return
-        dtslogger.debug("SERVICE_ADD: %s (%s)" % (str(name), str(server)))
-        info = zeroconf.get_service_info(type, sname)
-        if info is None:
-            return
-        dtslogger.debug("SERVICE_ADD: %s" % (str(info)))
-        txt = json.loads(list(info.properties.keys())[0].decode("utf-8")) if len(info.properties) else dict()
-        self.services[name][server] = {"port": info.port, "txt": txt}
-
-    def update_service(self, *args, **kwargs):
-        pass
-
-    def print(self):
-        # clear terminal
-        os.system("cls" if os.name == "nt" else "clear")
-        # get all discovered hostnames
-        hostnames = set()
-        for service in self.supported_services:
-            hostnames.update(self.services[service])
-        # create hostname -> robot_type map
-        hostname_to_type = defaultdict(lambda: "ND")
-        for device_hostname in self.services["DT::ROBOT_TYPE"]:
-            dev = self.services["DT::ROBOT_TYPE"][device_hostname]
-            if len(dev["txt"]) and "type" in dev["txt"]:
-                try:
-                    hostname_to_type[device_hostname] = dev["txt"]["type"]
-                except:
-                    pass
-        # create hostname -> robot_configuration map
-        hostname_to_config = defaultdict(lambda: "ND")
-        for device_hostname in self.services["DT::ROBOT_CONFIGURATION"]:
-            dev = self.services["DT::ROBOT_CONFIGURATION"][device_hostname]
-            if len(dev["txt"]) and "configuration" in dev["txt"]:
-                try:
-                    hostname_to_config[device_hostname] = dev["txt"]["configuration"]
-                except:
-                    pass
-        # prepare table
-        columns = [
-            "Status",  # Booting [yellow], Ready [green]
-            "Internet",  # No [grey], Yes [green]
-            "Dashboard",  # Down [grey], Up [green]
-            "Busy",  # No [grey], Yes [green]
+    def txt(service, key):
+        value = services.get(service, {}).get("txt", {}).get(key, "ND")
+        return value if isinstance(value, str) else "ND"
+
+    status = "ND"
+    if "DT::PRESENCE" in services:
+        status = "Ready"
+    if "DT::BOOTING" in services:
+        status = "Booting"
+    addresses = services.get("DT::PRESENCE", {}).get("addresses", [])
+    return {
+        "hostname": hostname,
+        "type": txt("DT::ROBOT_TYPE", "type"),
+        "model": txt("DT::ROBOT_CONFIGURATION", "configuration"),
+        "status": status,
+        "internet": "DT::ONLINE" in services,
+        "dashboard": "DT::DASHBOARD" in services,
+        "busy": "DT::BUSY" in services,
+        "address": addresses[0] if addresses else None,
+    }
+
+
+class DiscoverTable:
+    """
+    Keeps the state of the discovered devices and renders them as a table. Rows are formatted
+    only when the state of their device changes, and only the lines that differ from what is
+    already on screen are redrawn.
+    """
+
+    def __init__(self, filter_type=None):
+        self.filter_type = filter_type
+        self.states = {}
+        self._rows = {}
+        self._widths = None
+        self._screen = None
+
+    def update(self, devices: dict, full: bool = False):
+        """
+        Updates the state of the given devices, {hostname: {service: record}}. Devices
+        without services left the network, so do all the devices not listed in a full snapshot.
+        """
+        if full:
+            for hostname in set(self.states) - set(devices):
+                self.states.pop(hostname)
+                self._rows.pop(hostname, None)
+        for hostname, services in devices.items():
+            self._rows.pop(hostname, None)
+            if services:
+                self.states[hostname] = device_state(hostname, services)
+            else:
+                self.states.pop(hostname, None)
+
+    def visible(self) -> list:
+        return [
+            self.states[hostname]
+            for hostname in sorted(self.states)
+            if not self.filter_type or self.states[hostname]["type"] == self.filter_type
+        ]
+
+    def lines(self) -> list:
+        states = self.visible()
+        header = ["", "Type", "Model"] + [f" {c} " for c in COLUMNS] + ["Hostname"]
+        widths = [len(h) for h in header]
+        for state in states:
+            widths[0] = max(widths[0], len(state["hostname"]))
+            widths[1] = max(widths[1], len(state["type"]))
+            widths[2] = max(widths[2], len(state["model"]))
+            widths[-1] = max(widths[-1], len(state["hostname"]) + len(".local"))
+        # all the rows need to be formatted again when the columns are resized
+        if widths != self._widths:
+            self._widths = widths
+            self._rows.clear()
+        lines = [
+            COLUMN_DELIMITER.join(fill_cell(h, w) for h, w in zip(header, widths)),
+            COLUMN_DELIMITER.join("-" * w for w in widths),
+        ]
+        for state in states:
+            hostname = state["hostname"]
+            if hostname not in self._rows:
+                self._rows[hostname] = self._format_row(state)
+            lines.append(self._rows[hostname])
+        return lines
+
+    def _format_row(self, state: dict) -> str:
+        widths = self._widths
+        cells = [
+            fill_cell(state["hostname"], widths[0], format="{:<{}}"),
+            fill_cell(state["type"], widths[1], format="{:<{}}"),
+            fill_cell(state["model"], widths[2], format="{:<{}}"),
         ]
-        columns = list(map(lambda c: " %s " % c, columns))
-        header = ["Type", "Model"] + columns + ["Hostname"]
-        data = []
-
-        for device_hostname in list(sorted(hostnames)):
-            # filter by robot type
-            robot_type = hostname_to_type[device_hostname]
-            robot_configuration = hostname_to_config[device_hostname]
-            if self.args.filter_type and robot_type != self.args.filter_type:
-                continue
-            # prepare status list
-            statuses = []
-            for column in columns:
-                text, color, bg_color = column_to_text_and_color(column, device_hostname, self.services)
-                column_txt = fill_cell(text, len(column), color, bg_color)
-                statuses.append(column_txt)
-            # prepare row
-            row = (
-                [device_hostname, robot_type, robot_configuration]
-                + statuses
-                + [str(device_hostname) + ".local"]
-            )
-            data.append(row)
-
-        # print table
-        print("NOTE: Only devices flashed using duckietown-shell-commands v4.1.0+ are supported.\n")
-        print(format_matrix(header, data, "{:^{}}", "{:<{}}", "{:>{}}", "\n", " | "))
+        for column, width in zip(COLUMNS, widths[3:-1]):
+            text, color, bg_color = column_to_text_and_color(column, state)
+            cells.append(fill_cell(text, width, color, bg_color))
+        cells.append(fill_cell(state["hostname"] + ".local", widths[-1], format="{:>{}}"))
+        return COLUMN_DELIMITER.join(cells)
+
+    def draw(self):
+        """
+        Draws the table on the terminal, rewriting only the lines that changed.
+        """
+        lines = [NOTE, ""] + self.lines()
+        out = []
+        if self._screen is None:
+            out.append(ANSI_HIDE_CURSOR + ANSI_CLEAR_SCREEN)
+            self._screen = []
+        for i, line in enumerate(lines):
+            if i >= len(self._screen) or self._screen[i] != line:
+                out.append(ANSI_MOVE_TO_LINE.format(i + 1) + line + ANSI_CLEAR_LINE)
+        if len(lines) < len(self._screen):
+            out.append(ANSI_MOVE_TO_LINE.format(len(lines) + 1) + ANSI_CLEAR_BELOW)
+        self._screen = lines
+        if out:
+            sys.stdout.write("".join(out))
+            sys.stdout.flush()
+
+    def release(self):
+        """
+        Gives the terminal back, with the cursor right below the table.
+        """
+        if self._screen is not None:
+            sys.stdout.write(ANSI_MOVE_TO_LINE.format(len(self._screen) + 1) + ANSI_SHOW_CURSOR)
+            sys.stdout.flush()
 
 
 class DTCommand(DTCommandAbs):
@@ -138,13 +185,6 @@ class DTCommand(DTCommandAbs):
     def command(shell, args):
         prog = "dts fleet discover"
 
-        # try to import zeroconf
-        try:
-            from zeroconf import ServiceBrowser, Zeroconf
-        except ImportError:
-            dtslogger.error("{} requires zeroconf. Use pip to install it.")
-            return
-
         # parse arguments
         parser = argparse.ArgumentParser(prog=prog, usage=usage)
 
@@ -155,43 +195,97 @@ class DTCommand(DTCommandAbs):
             choices=get_robot_types(),
             help="Filter devices by type",
         )
+        parser.add_argument(
+            "--once",
+            default=False,
+            action="store_true",
+            help="Print the devices found and exit",
+        )
+        parser.add_argument(
+            "--json",
+            default=False,
+            action="store_true",
+            help="Print the devices found as JSON and exit (implies --once)",
+        )
+        parser.add_argument(
+            "--wait",
+            default=DEFAULT_SNAPSHOT_WAIT,
+            type=float,
+            help="Seconds to wait for the devices to show up before printing them with --once/--json "
+            "(not needed when the discovery agent is running, see `dts fleet agent`)",
+        )
 
         parsed = parser.parse_args(args)
 
-        # perform discover
-        zeroconf = Zeroconf()
-        listener = DiscoverListener(args=parsed)
-        ServiceBrowser(zeroconf, "_duckietown._tcp.local.", listener)
+        # discover devices (through the discovery agent, if running)
+        try:
+            discovery = get_discovery()
+        except ImportError:
+            dtslogger.error("{} requires zeroconf. Use pip to install it.".format(prog))
+            return
+        table = DiscoverTable(filter_type=parsed.filter_type)
 
-        while True:
-            if dtslogger.level > logging.DEBUG:
-                listener.print()
-            time.sleep(1.0 / REFRESH_HZ)
+        # snapshot mode
+        if parsed.once or parsed.json:
+            if not isinstance(discovery, AgentClient):
+                time.sleep(parsed.wait)
+            _, devices = discovery.wait_for_devices(0, 0)
+            table.update(devices)
+            if parsed.json:
+                print(json.dumps(table.visible(), indent=4, sort_keys=True))
+            else:
+                print(NOTE + "\n")
+                print("\n".join(table.lines()))
+            return
+
+        # live mode, redraw when something changes
+        version = 0
+        try:
+            while True:
+                since = version
+                try:
+                    version, devices = discovery.wait_for_devices(since, 1.0 / REFRESH_HZ)
+                except ConnectionError:
+                    # the agent went away, reconnect (or discover locally) and start from scratch
+                    dtslogger.debug("Lost the discovery agent, reconnecting...")
+                    discovery = get_discovery()
+                    version = 0
+                    continue
+                # a new table (e.g., the agent was restarted) sends a full snapshot
+                table.update(devices, full=since == 0 or version < since)
+                if dtslogger.level > logging.DEBUG:
+                    table.draw()
+                # coalesce bursts of changes
+                time.sleep(1.0 / MAX_REDRAW_HZ)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            table.release()
 
 
-def column_to_text_and_color(column, hostname, services):
+def column_to_text_and_color(column, state):
     column = column.strip()
     text, color, bg_color = "ND", "white", "grey"
     #  -> Status
     if column == "Status":
-        if hostname in services["DT::PRESENCE"]:
+        if state["status"] == "Ready":
             text, color, bg_color = "Ready", "white", "green"
-        if hostname in services["DT::BOOTING"]:
+        if state["status"] == "Booting":
             text, color, bg_color = "Booting", "white", "yellow"
     #  -> Dashboard
     if column == "Dashboard":
         text, color, bg_color = "Down", "white", "grey"
-        if hostname in services["DT::DASHBOARD"]:
+        if state["dashboard"]:
             text, color, bg_color = "Up", "white", "green"
     #  -> Internet
     if column == "Internet":
         text, color, bg_color = "No", "white", "grey"
-        if hostname in services["DT::ONLINE"]:
+        if state["internet"]:
             text, color, bg_color = "Yes", "white", "green"
     #  -> Busy
     if column == "Busy":
         text, color, bg_color = "No", "white", "grey"
-        if hostname in services["DT::BUSY"]:
+        if state["busy"]:
             text, color, bg_color = "Yes", "white", "green"
     # ----------
     return text, color, bg_color
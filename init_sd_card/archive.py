@@ -0,0 +1,216 @@
+import io
+import os
+import time
+import zlib
+import lzma
+import struct
+from typing import Callable, Iterator, Optional, Tuple
+
+CHUNK_SIZE = 1024 ** 2
+FOLLOW_INTERVAL = 0.2
+
+ZIP_LOCAL_HEADER = struct.Struct("<4sHHHHHIIIHH")
+ZIP_LOCAL_SIGNATURE = b"PK\x03\x04"
+ZIP_ZIP64_EXTRA_ID = 0x0001
+ZIP_FLAG_DATA_DESCRIPTOR = 0x08
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+XZ_MAGIC = b"\xfd7zXZ\x00"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+class ArchiveError(Exception):
+    pass
+
+
+class FollowReader(io.RawIOBase):
+    """
+    Reads a file that is still being written (e.g., downloaded) by someone else.
+    Reads block until new data is available or `finished()` returns True.
+
+    Args:
+        fpath:      path to the file to read
+        finished:   function returning True once the file is complete, it should raise
+                    an exception if the writer failed
+    """
+
+    def __init__(self, fpath: str, finished: Callable[[], bool]):
+        self._fpath = fpath
+        self._finished = finished
+        self._fin = None
+        self.nbytes = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while True:
+            # check the status before reading, so that no data is lost at the end
+            done = self._finished()
+            if self._fin is None and os.path.isfile(self._fpath):
+                self._fin = open(self._fpath, "rb", buffering=0)
+            if self._fin is not None:
+                n = self._fin.readinto(b)
+                if n:
+                    self.nbytes += n
+                    return n
+            if done:
+                return 0
+            time.sleep(FOLLOW_INTERVAL)
+
+    def close(self):
+        if self._fin is not None:
+            self._fin.close()
+        super(FollowReader, self).close()
+
+
+def iter_archive(fileobj) -> Iterator[Tuple[str, Optional[int], io.RawIOBase]]:
+    """
+    Iterates over the files contained in an archive read from a non-seekable stream.
+    Yields triplets (name, size, reader), where `size` is None when the (uncompressed) size
+    of the file is not known in advance. Each reader has to be consumed before moving on.
+
+    Supported formats are ZIP (stored and deflated files, ZIP64), and single files
+    compressed with XZ or Zstandard (requires the `zstandard` package).
+    """
+    fileobj = io.BufferedReader(fileobj, buffer_size=CHUNK_SIZE) \
+        if not isinstance(fileobj, io.BufferedReader) else fileobj
+    magic = fileobj.peek(len(XZ_MAGIC))[: len(XZ_MAGIC)]
+    if magic.startswith(ZIP_LOCAL_SIGNATURE):
+        yield from _iter_zip(fileobj)
+    elif magic.startswith(XZ_MAGIC):
+        yield "", None, _DecompressReader(fileobj, lzma.LZMADecompressor())
+    elif magic.startswith(ZSTD_MAGIC):
+        try:
+            import zstandard
+        except ImportError:
+            raise ArchiveError("Install the Python package `zstandard` to read .zst archives")
+        yield "", None, zstandard.ZstdDecompressor().stream_reader(fileobj)
+    else:
+        raise ArchiveError("Archive format not recognized")
+
+
+def _iter_zip(fileobj):
+    while True:
+        header = _read_exactly(fileobj, ZIP_LOCAL_HEADER.size, allow_eof=True)
+        # the central directory (or the end of the stream) follows the last file
+        if header is None or not header.startswith(ZIP_LOCAL_SIGNATURE):
+            return
+        _, _, flags, method, _, _, crc, csize, usize, name_len, extra_len = ZIP_LOCAL_HEADER.unpack(header)
+        name = _read_exactly(fileobj, name_len).decode("utf-8", errors="replace")
+        extra = _read_exactly(fileobj, extra_len)
+        if flags & ZIP_FLAG_DATA_DESCRIPTOR:
+            raise ArchiveError(f"File '{name}' was archived in streaming mode, this is not supported")
+        # large files store their sizes in the ZIP64 extra field
+        if 0xFFFFFFFF in (csize, usize):
+            usize, csize = _zip64_sizes(extra, usize, csize)
+        compressed = _LimitedReader(fileobj, csize)
+        if method == ZIP_STORED:
+            reader = compressed
+        elif method == ZIP_DEFLATED:
+            reader = _DecompressReader(compressed, zlib.decompressobj(-zlib.MAX_WBITS))
+        else:
+            raise ArchiveError(f"Compression method {method} of file '{name}' not supported")
+        reader = _CRCReader(reader, crc, name)
+        yield name, usize, reader
+        # skip whatever was not consumed
+        while compressed.read(CHUNK_SIZE):
+            pass
+
+
+def _zip64_sizes(extra, usize, csize):
+    offset = 0
+    while offset + 4 <= len(extra):
+        eid, elen = struct.unpack_from("<HH", extra, offset)
+        if eid == ZIP_ZIP64_EXTRA_ID:
+            values = iter(struct.unpack_from(f"<{elen // 8}Q", extra, offset + 4))
+            # fields are only present when the corresponding header field is 0xFFFFFFFF
+            if usize == 0xFFFFFFFF:
+                usize = next(values)
+            if csize == 0xFFFFFFFF:
+                csize = next(values)
+            return usize, csize
+        offset += 4 + elen
+    raise ArchiveError("Invalid ZIP64 file header")
+
+
+def _read_exactly(fileobj, n, allow_eof=False):
+    data = b""
+    while len(data) < n:
+        chunk = fileobj.read(n - len(data))
+        if not chunk:
+            if allow_eof and not data:
+                return None
+            raise ArchiveError("Unexpected end of archive")
+        data += chunk
+    return data
+
+
+class _LimitedReader(io.RawIOBase):
+    def __init__(self, fileobj, size):
+        self._fileobj = fileobj
+        self._left = size
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self._left <= 0:
+            return 0
+        chunk = self._fileobj.read(min(len(b), self._left))
+        if not chunk:
+            raise ArchiveError("Unexpected end of archive")
+        n = len(chunk)
+        b[:n] = chunk
+        self._left -= n
+        return n
+
+
+class _DecompressReader(io.RawIOBase):
+    """
+    Decompresses data read from `fileobj` with a zlib or lzma decompressor. The output is
+    bounded by the size of the read, images are full of highly compressible empty space.
+    """
+
+    def __init__(self, fileobj, decompressor):
+        self._fileobj = fileobj
+        self._decompressor = decompressor
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        decompressor = self._decompressor
+        while not decompressor.eof:
+            if getattr(decompressor, "unconsumed_tail", b""):
+                data = decompressor.unconsumed_tail
+            elif getattr(decompressor, "needs_input", True):
+                data = self._fileobj.read(CHUNK_SIZE)
+                if not data:
+                    raise ArchiveError("Unexpected end of compressed data")
+            else:
+                data = b""
+            out = decompressor.decompress(data, len(b))
+            if out:
+                b[: len(out)] = out
+                return len(out)
+        return 0
+
+
+class _CRCReader(io.RawIOBase):
+    def __init__(self, fileobj, crc, name):
+        self._fileobj = fileobj
+        self._expected = crc
+        self._name = name
+        self._crc = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self._fileobj.readinto(b)
+        if n:
+            self._crc = zlib.crc32(memoryview(b)[:n], self._crc)
+        elif self._crc != self._expected:
+            raise ArchiveError(f"CRC mismatch for file '{self._name}', the archive is corrupted")
+        return n
@@ -1,3 +1,5 @@
+import io
+import base64
 import argparse
 import getpass
 import json
@@ -7,17 +9,22 @@ import shutil
 import subprocess
 import time
 import socket
+import zipfile
 from collections import namedtuple
 from types import SimpleNamespace
 
 from future import builtins
 from datetime import datetime
+from threading import Thread
+
+from dt_data_api import DataClient, TransferStatus
 
 from dt_shell import DTShell, dtslogger, DTCommandAbs, __version__ as shell_version
 from utils.cli_utils import ProgressBar, ask_confirmation, check_program_dependency
 from utils.duckietown_utils import get_robot_types, get_robot_configurations, get_robot_hardware
-from utils.misc_utils import human_time
+from utils.misc_utils import human_time, human_size
 
+from .archive import ArchiveError, FollowReader, iter_archive
 from .constants import (
     TIPS_AND_TRICKS,
     LIST_DEVICES_CMD,
@@ -32,13 +39,14 @@ INIT_SD_CARD_VERSION = "2.1.0"  # incremental number, semantic version
 Wifi = namedtuple("Wifi", "name ssid psk username password")
 
 TMP_WORKDIR = "/tmp/duckietown/dts/init_sd_card"
-DD_BLOCK_SIZE = "1M"
 DEFAULT_ROBOT_TYPE = "duckiebot"
 DEFAULT_WIFI_CONFIG = "duckietown:quackquack"
 COMMAND_DIR = os.path.dirname(os.path.abspath(__file__))
 SUPPORTED_STEPS = ["license", "download", "flash", "verify", "setup"]
 WIRED_ROBOT_TYPES = ["watchtower", "traffic_light", "town"]
 NVIDIA_LICENSE_FILE = os.path.join(COMMAND_DIR, "nvidia-license.txt")
+FLASHER_SCRIPT = os.path.join(COMMAND_DIR, "flasher.py")
+FEED_CHUNK_SIZE = 1024 ** 2
 
 
 def DISK_IMAGE_VERSION(robot_configuration, experimental=False):
@@ -139,6 +147,19 @@ class DTCommand(DTCommandAbs):
             action="store_true",
             help="Use experimental disk image and parameters"
         )
+        parser.add_argument(
+            "--stream",
+            default=False,
+            action="store_true",
+            help="Flash the disk image while downloading and decompressing it, "
+                 "without extracting it to disk"
+        )
+        parser.add_argument(
+            "--verify-all",
+            default=False,
+            action="store_true",
+            help="Verify the blocks that were zeroed instead of written while flashing as well"
+        )
         parser.add_argument(
             "--workdir",
             default=TMP_WORKDIR,
@@ -215,6 +236,7 @@ class DTCommand(DTCommandAbs):
             "disk_zip": in_file("zip"),
             "disk_img": in_file("img"),
             "disk_metadata": in_file("json"),
+            "disk_blocks": in_file("blocks.json"),
         }
         # perform steps
         for step_name in steps:
@@ -256,8 +278,11 @@ def step_license(_, parsed, __):
 
 
 def step_download(shell, parsed, data):
+    # the disk image is streamed straight into the flasher (see step_flash)
+    stream = parsed.stream and "flash" in parsed.steps.split(",") and not os.path.isfile(data["disk_img"])
     # check if dependencies are met
-    check_program_dependency("unzip")
+    if not stream:
+        check_program_dependency("unzip")
 
     # clear cache (if requested)
     if parsed.no_cache:
@@ -272,6 +297,15 @@ def step_download(shell, parsed, data):
                 shutil.rmtree(parsed.workdir)
     # create temporary dir
     _run_cmd(["mkdir", "-p", parsed.workdir])
+    # in streaming mode, the download continues in background while flashing
+    if stream:
+        if os.path.isfile(data["disk_zip"]):
+            dtslogger.info(f"Reusing cached ZIP image file [{data['disk_zip']}].")
+            return {"disk_archive": data["disk_zip"], "download": None}
+        disk_image = DISK_IMAGE_CLOUD_LOCATION(parsed.robot_configuration, parsed.experimental)
+        dtslogger.info(f"Downloading [public]:{disk_image} -> {data['disk_zip']} (in background)")
+        download = DataClient().storage("public").download(disk_image, data["disk_zip"])
+        return {"disk_archive": data["disk_zip"], "download": download}
     # download zip (if necessary)
     dtslogger.info("Looking for ZIP image file...")
     if not os.path.isfile(data["disk_zip"]):
@@ -290,16 +324,17 @@ def step_download(shell, parsed, data):
         _run_cmd(["unzip", data["disk_zip"], "-d", parsed.workdir])
     else:
         dtslogger.info(f"Reusing cached DISK image file [{data['disk_img']}].")
+    # the block hashes of the disk image (if shipped) are used to verify the SD card
+    if not os.path.isfile(data["disk_blocks"]):
+        _extract_member(data["disk_zip"], data["disk_blocks"])
     # ---
     return {}
 
 
 def step_flash(_, parsed, data):
     # check if dependencies are met
-    check_program_dependency("dd")
     check_program_dependency("sudo")
     check_program_dependency("lsblk")
-    check_program_dependency("sync")
 
     # ask for a device if not set already
     if parsed.device is None:
@@ -325,104 +360,67 @@ def step_flash(_, parsed, data):
                 dtslogger.info("Please retry while specifying a valid device. Bye bye!")
                 exit(4)
 
-    # use dd to flash
-    stime = time.time()
-    dtslogger.info("Flashing File[{}] -> {}[{}]:".format(data["disk_img"], sd_type, parsed.device))
-    dd_cmd = (["sudo"] if sd_type == "SD" else []) + [
-        "dd",
-        "if={}".format(data["disk_img"]),
-        "of={}".format(parsed.device),
-        "bs={}".format(DD_BLOCK_SIZE),
-        "status=progress",
-    ]
-
-    # create a progress bar to track the progress
-    pbar = ProgressBar(header='Flashing [ETA: ND]')
-    tbytes = os.stat(data["disk_img"]).st_size
-
-    # launch dd
-    dd = subprocess.Popen(dd_cmd, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-    dtslogger.debug(f"$ {dd_cmd}")
-
-    # read status and update progress bar
-    par = b""
-    while dd.poll() is None:
-        time.sleep(0.1)
-        # consume everything from the buffer
-        char = dd.stderr.read(1)
-        while len(char) == 1:
-            if par is not None:
-                par += char
-            if char == b"\r":
-                par = b""
-            if char == b" " and par is not None:
-                try:
-                    nbytes = float(par.decode("utf-8"))
-                    progress = int(100 * (nbytes / tbytes))
-                    pbar.update(progress)
-                    # compute ETA
-                    if progress > 0:
-                        elapsed = time.time() - stime
-                        eta = (100 - progress) * (elapsed / progress)
-                        pbar.set_header('Flashing [ETA: {}]'.format(human_time(eta, True)))
-                except ValueError:
-                    pass
-                par = None
-            # get next char
-            char = dd.stderr.read(1)
-    # jump to 100% if success
-    if dd.returncode == 0:
-        pbar.update(100)
-        dtslogger.info('Flashed in {}'.format(human_time(time.time() - stime)))
-
-    # flush I/O buffer
-    dtslogger.info("Flushing I/O buffer...")
-    _run_cmd(["sync"])
-    dtslogger.info("Done!")
+    # block hashes are computed while flashing, so that verify does not need to read the image
+    flash_manifest = os.path.join(parsed.workdir, "flash.blocks.json")
+    try:
+        if data.get("disk_archive") and not os.path.isfile(data["disk_img"]):
+            # flash the disk image while decompressing (and downloading) the archive
+            dtslogger.info("Flashing Archive[{}] -> {}[{}]:".format(data["disk_archive"], sd_type, parsed.device))
+            result = _stream_flash(parsed, data, sd_type, flash_manifest)
+        else:
+            # flash the disk image
+            dtslogger.info("Flashing File[{}] -> {}[{}]:".format(data["disk_img"], sd_type, parsed.device))
+            result = _run_flasher(
+                ["flash", data["disk_img"], parsed.device, "--manifest-out", flash_manifest],
+                sudo=sd_type == "SD",
+                header="Flashing",
+            )
+    except (IOError, ArchiveError) as e:
+        dtslogger.error("The flashing step failed. The error reads:\n\n{}".format(str(e)))
+        exit(9)
+    dtslogger.info(
+        "Flashed in {} ({} written, {} skipped, {}/s)".format(
+            human_time(result["elapsed"]),
+            human_size(result["written"]),
+            human_size(result["zeroed"]),
+            human_size(result["throughput"]),
+        )
+    )
     # ---
     dtslogger.info("{}[{}] flashed!".format(sd_type, parsed.device))
-    return {"sd_type": sd_type}
+    return {"sd_type": sd_type, "flash_manifest": flash_manifest}
 
 
 def step_verify(_, parsed, data):
     dtslogger.info("Verifying {}[{}]...".format(data.get("sd_type", ""), parsed.device))
-    buf_size = 16 * 1024
-    # create a progress bar to track the progress
-    pbar = ProgressBar(header='Verifying [ETA: ND]')
-    tbytes = os.stat(data["disk_img"]).st_size
-    nbytes = 0
-    stime = time.time()
-    # compare bytes
+    # verify against (in order of preference): the block hashes computed while flashing,
+    # the block hashes shipped with the disk image, the disk image itself
+    if os.path.isfile(data.get("flash_manifest", "")):
+        args = ["--manifest", data["flash_manifest"]] + ([] if parsed.verify_all else ["--written-only"])
+    elif os.path.isfile(data.get("disk_blocks", "")):
+        args = ["--manifest", data["disk_blocks"]]
+        # used if the flasher cannot compute the hashes in the manifest
+        if os.path.isfile(data["disk_img"]):
+            args += ["--source", data["disk_img"]]
+    else:
+        args = ["--source", data["disk_img"]]
     try:
-        with open(data["disk_img"], "rb") as origin:
-            with _sudo_open(parsed.device, "rb") as destination:
-                buffer1 = origin.read(buf_size)
-                while buffer1:
-                    buf1_len = len(buffer1)
-                    buffer2 = destination.read(buf1_len)
-                    buf2_len = len(buffer2)
-                    # check lengths, then content
-                    if buf1_len != buf2_len or buffer1 != buffer2:
-                        raise IOError("Mismatch in range position [{}-{}]".format(nbytes, nbytes + buf1_len))
-                    # update progress bar
-                    nbytes += buf1_len
-                    progress = int(100 * (nbytes / tbytes))
-                    pbar.update(progress)
-                    # compute ETA
-                    if progress > 0:
-                        elapsed = time.time() - stime
-                        eta = (100 - progress) * (elapsed / progress)
-                        pbar.set_header('Verifying [ETA: {}]'.format(human_time(eta, True)))
-                    # read another chunk
-                    buffer1 = origin.read(buf_size)
+        result = _run_flasher(
+            ["verify", parsed.device] + args, sudo=data.get("sd_type", "SD") == "SD", header="Verifying"
+        )
     except IOError as e:
-        sys.stdout.write("\n")
-        sys.stdout.flush()
         dtslogger.error(
             "The verification step failed. Please, try re-flashing.\n" "The error reads:\n\n{}".format(str(e))
         )
         exit(5)
-    dtslogger.info('Verified in {}'.format(human_time(time.time() - stime)))
+    dtslogger.info(
+        "Verified in {} ({} verified, {} skipped, {}/s)".format(
+            human_time(result["elapsed"]),
+            human_size(result["verified"]),
+            human_size(result["skipped"]),
+            human_size(result["throughput"]),
+        )
+    )
     # ---
     dtslogger.info("{}[{}] successfully flashed!".format(data.get("sd_type", ""), parsed.device))
     return {}
@@ -430,9 +428,7 @@ def step_verify(_, parsed, data):
 
 def step_setup(shell, parsed, data):
     # check if dependencies are met
-    check_program_dependency("dd")
     check_program_dependency("sudo")
-    check_program_dependency("sync")
 
     # compile data used to format placeholders
     surgery_data = {
@@ -477,10 +473,10 @@ def step_setup(shell, parsed, data):
     surgery_data["sanitize_files"] = "\n".join(map(lambda f: f'dt-sanitize-file "{f}"', sanitize))
     # get disk image placeholders
     placeholders_dir = os.path.join(COMMAND_DIR, "placeholders", f'v{disk_metadata["version"]}')
-    # perform surgery
-    dtslogger.info("Performing surgery on the SD card...")
+    # prepare surgery
+    writes = []
     for surgery_bit in surgery_plan:
-        dtslogger.info("Performing surgery on [{partition}]:{path}.".format(**surgery_bit))
+        dtslogger.info("Preparing surgery on [{partition}]:{path}.".format(**surgery_bit))
         # get placeholder info
         surgery_bit["placeholder"] = surgery_bit["placeholder"]
         placeholder_file = os.path.join(placeholders_dir, surgery_bit["placeholder"])
@@ -513,42 +509,137 @@ def step_setup(shell, parsed, data):
             "Injecting {}/{} bytes ({}%) ".format(used_bytes, block_size, block_usage)
             + "into [{partition}]:{path}.".format(**surgery_bit)
         )
-        # apply change
-        dd_cmd = (["sudo"] if data.get("sd_type", "SD") == "SD" else []) + [
-            "dd",
-            "of={}".format(parsed.device),
-            "bs=1",
-            "count={}".format(block_size),
-            "seek={}".format(block_offset),
-            "conv=notrunc",
-        ]
-        # write twice (found to increase success rate)
-        for wpass in range(2):
-            # launch dd
-            dd = subprocess.Popen(dd_cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
-            dtslogger.debug(f"[{wpass+1}/2] $ {dd_cmd}")
-            # write
-            dd.stdin.write(masked_content)
-            dd.stdin.flush()
-            dd.stdin.close()
-            dd.wait()
-            # flush I/O buffer
-            _run_cmd(["sync"])
+        writes.append({"offset": block_offset, "data": base64.b64encode(masked_content).decode("ascii")})
+    # perform surgery, all the blocks are written (and read back) in a single pass
+    dtslogger.info("Performing surgery on the SD card...")
+    try:
+        result = _run_flasher(
+            ["surgery", parsed.device],
+            sudo=data.get("sd_type", "SD") == "SD",
+            header="Surgery",
+            stdin=io.BytesIO(json.dumps({"writes": writes}).encode("utf-8")),
+        )
+    except IOError as e:
+        dtslogger.error("The surgery failed. Please, try re-flashing.\nThe error reads:\n\n{}".format(str(e)))
+        exit(10)
+    if result["rewrites"] > 0:
+        dtslogger.debug(f"{result['rewrites']} block(s) had to be written more than once.")
     dtslogger.info("Surgery went OK!")
-    # flush I/O buffer
-    dtslogger.info("Flushing I/O buffer...")
-    _run_cmd(["sync"])
-    dtslogger.info("Done!")
     # ---
     return {}
 
 
-def _sudo_open(filepath, *_, **__):
-    # check if dependencies are met
-    check_program_dependency("cat")
-    # ---
-    proc = subprocess.Popen(["sudo", "cat", filepath], stdout=subprocess.PIPE)
-    return proc.stdout
+def _stream_flash(parsed, data, sd_type, flash_manifest):
+    download = data.get("download", None)
+
+    def _downloaded():
+        if download is None:
+            return True
+        if download.status in [TransferStatus.ERROR, TransferStatus.STOPPED]:
+            raise IOError(f"Download failed: {download.reason}")
+        return download.status == TransferStatus.FINISHED
+
+    result = None
+    for name, size, fin in iter_archive(FollowReader(data["disk_archive"], _downloaded)):
+        # the first file in the archive is the disk image
+        if result is None:
+            args = ["flash", "-", parsed.device, "--manifest-out", flash_manifest]
+            args += ["--size", str(size)] if size is not None else []
+            result = _run_flasher(args, sudo=sd_type == "SD", header="Flashing", stdin=fin)
+            continue
+        # everything else (e.g., disk image metadata) is extracted into the working directory
+        with open(os.path.join(parsed.workdir, os.path.basename(name)), "wb") as fout:
+            shutil.copyfileobj(fin, fout)
+    if result is None:
+        raise ArchiveError("The archive does not contain a disk image")
+    return result
+
+
+def _extract_member(archive, destination):
+    # extracts the file named as `destination` from the archive, if the archive contains it
+    try:
+        with zipfile.ZipFile(archive) as zin:
+            name = os.path.basename(destination)
+            if name not in zin.namelist():
+                return
+            with zin.open(name) as fin, open(destination, "wb") as fout:
+                shutil.copyfileobj(fin, fout)
+    except (OSError, zipfile.BadZipFile) as e:
+        dtslogger.debug(f"Could not extract {os.path.basename(destination)} from {archive}: {str(e)}")
+
+
+def _run_flasher(args, sudo, header, stdin=None):
+    cmd = (["sudo"] if sudo else []) + [sys.executable, FLASHER_SCRIPT] + args
+    dtslogger.debug(f"$ {cmd}")
+    # create a progress bar to track the progress
+    pbar = ProgressBar(header=f"{header} [ETA: ND]")
+    flasher = subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, stdin=subprocess.PIPE if stdin is not None else None
+    )
+    result, error = None, None
+    # data can be fed to the flasher through its stdin
+    feed_errors = []
+    if stdin is not None:
+        feeder = Thread(target=_feed_flasher, args=(stdin, flasher.stdin, feed_errors), daemon=True)
+        feeder.start()
+    # the flasher reports its progress as JSON lines
+    for line in flasher.stdout:
+        try:
+            message = json.loads(line.decode("utf-8"))
+        except ValueError:
+            continue
+        if "progress" in message:
+            stats = message["progress"]
+            # the size of streamed images might not be known in advance
+            if stats["total"] is None:
+                pbar.set_header(
+                    "{} [{} @ {}/s]".format(
+                        header, human_size(stats["done"], precision=1), human_size(stats["throughput"], precision=1)
+                    )
+                )
+                continue
+            pbar.update(int(100 * stats["done"] / max(1, stats["total"])))
+            # compute ETA
+            if stats["throughput"] > 0:
+                eta = (stats["total"] - stats["done"]) / stats["throughput"]
+                pbar.set_header(
+                    "{} [{}/s, ETA: {}]".format(
+                        header, human_size(stats["throughput"], precision=1), human_time(eta, True)
+                    )
+                )
+        if "warning" in message:
+            sys.stdout.write("\n")
+            sys.stdout.flush()
+            dtslogger.warning(message["warning"])
+        result = message.get("result", result)
+        error = message.get("error", error)
+    flasher.wait()
+    # errors on the data source are more meaningful than their effect on the flasher
+    if feed_errors:
+        sys.stdout.write("\n")
+        sys.stdout.flush()
+        raise IOError(str(feed_errors[0]))
+    if flasher.returncode != 0 or result is None:
+        sys.stdout.write("\n")
+        sys.stdout.flush()
+        raise IOError(error or f"The flasher exited with code {flasher.returncode}")
+    pbar.update(100)
+    return result
+
+
+def _feed_flasher(source, sink, errors):
+    try:
+        shutil.copyfileobj(source, sink, FEED_CHUNK_SIZE)
+    except BrokenPipeError:
+        # the flasher stopped reading, it will report why
+        pass
+    except BaseException as e:
+        errors.append(e)
+    finally:
+        try:
+            sink.close()
+        except OSError:
+            pass
 
 
 def _interpret_wifi_string(s):
@@ -0,0 +1,738 @@
+#!/usr/bin/env python3
+"""
+Block-level flashing, verification and surgery engine used by `dts init_sd_card`.
+
+This module only depends on the Python standard library because it is executed as a
+standalone script (through `sudo`) when the target is a block device, e.g.,
+
+    sudo python3 flasher.py flash disk.img /dev/sdX
+
+Progress and results are reported on stdout as JSON lines.
+"""
+
+import os
+import sys
+import json
+import base64
+import stat
+import time
+import queue
+import hashlib
+import struct
+import argparse
+import threading
+
+DEFAULT_BLOCK_SIZE = 4 * 1024 ** 2
+# dirty pages are flushed to the device every this many bytes
+DEFAULT_SYNC_EVERY = 256 * 1024 ** 2
+# number of buffers shared by the reader and the writer
+NUM_BUFFERS = 3
+PROGRESS_INTERVAL = 0.25
+# ioctl(2) request used to zero out a range of a block device (linux/fs.h)
+BLKZEROOUT = 0x127F
+# block hash functions, in order of preference (the last one is always available)
+HASH_ALGORITHMS = ["blake3", "xxh3_128", "blake2b"]
+MANIFEST_VERSION = 1
+# number of times a block that does not read back correctly is written again
+SURGERY_RETRIES = 3
+
+_fdatasync = getattr(os, "fdatasync", os.fsync)
+
+
+class FlashError(Exception):
+    pass
+
+
+class VerifyError(Exception):
+    pass
+
+
+class FlashStats:
+    def __init__(self, total):
+        self.total = total
+        self.written = 0
+        self.zeroed = 0
+        self.stime = time.time()
+
+    @property
+    def done(self):
+        return self.written + self.zeroed
+
+    @property
+    def elapsed(self):
+        return time.time() - self.stime
+
+    @property
+    def throughput(self):
+        return self.done / max(0.001, self.elapsed)
+
+    def as_dict(self):
+        return {
+            "total": self.total,
+            "written": self.written,
+            "zeroed": self.zeroed,
+            "done": self.done,
+            "elapsed": self.elapsed,
+            "throughput": self.throughput,
+        }
+
+
+class VerifyStats:
+    def __init__(self, total):
+        self.total = total
+        self.verified = 0
+        self.skipped = 0
+        self.stime = time.time()
+
+    @property
+    def done(self):
+        return self.verified + self.skipped
+
+    @property
+    def elapsed(self):
+        return time.time() - self.stime
+
+    @property
+    def throughput(self):
+        return self.verified / max(0.001, self.elapsed)
+
+    def as_dict(self):
+        return {
+            "total": self.total,
+            "verified": self.verified,
+            "skipped": self.skipped,
+            "done": self.done,
+            "elapsed": self.elapsed,
+            "throughput": self.throughput,
+        }
+
+
+def flash(source, target, size=None, block_size=DEFAULT_BLOCK_SIZE, sync_every=DEFAULT_SYNC_EVERY,
+          sparse=True, manifest_out=None, hash_algorithm=None, callback=None):
+    """
+    Copies `source` onto `target` block by block.
+
+    Reads and writes happen on two different threads sharing a small pool of buffers.
+    Blocks made only of zeros (and holes of sparse source files) are not written, they are
+    zeroed using BLKZEROOUT on block devices and left as holes on regular files.
+    Written data is flushed with fdatasync every `sync_every` bytes, so that the page cache
+    never holds more than that and the progress reflects what actually reached the device.
+    If `manifest_out` is given, the block hashes of the source are computed while flashing
+    and stored there, so that the device can be verified without reading the source again.
+
+    Args:
+        source:         path to the disk image, or a readable binary stream
+        target:         path to the device (or file) to write
+        size:           number of bytes to copy, streams of unknown size are read until EOF
+        block_size:     size of the blocks read and written
+        sync_every:     number of bytes written between two calls to fdatasync
+        sparse:         whether zero blocks should be skipped
+        manifest_out:   (optional) path where the block-hash manifest is written
+        hash_algorithm: (optional) hash function used for the manifest
+        callback:       function called as `callback(stats)` while flashing
+
+    Returns:
+        a dictionary with the statistics of the operation
+    """
+    close_source = isinstance(source, str)
+    if close_source:
+        source = open(source, "rb", buffering=0)
+    if size is None and _is_regular_file(source):
+        size = os.fstat(source.fileno()).st_size
+    is_device = os.path.exists(target) and stat.S_ISBLK(os.stat(target).st_mode)
+    flags = os.O_WRONLY | (0 if is_device else os.O_CREAT | os.O_TRUNC)
+    fd = os.open(target, flags, 0o644)
+    stats = FlashStats(size)
+    free, full = queue.Queue(), queue.Queue()
+    for _ in range(NUM_BUFFERS):
+        free.put(bytearray(block_size))
+    reader = _BlockReader(source, size, block_size, free, full)
+    reader.start()
+    hasher = None
+    if manifest_out is not None:
+        hasher = _BlockHasher(hash_algorithm or default_hash_algorithm(), block_size, size)
+    zeros = bytes(block_size)
+    zero_run = None
+    synced = 0
+    last_notify = 0
+    try:
+        while True:
+            item = full.get()
+            if item is None:
+                break
+            offset, length, buf = item
+            # holes in the source are reported without a buffer
+            data = memoryview(buf)[:length] if buf is not None else None
+            zero = sparse and (data is None or _is_zero(data, zeros))
+            if hasher is not None:
+                hasher.update(offset, data if data is not None else memoryview(zeros)[:length], zero)
+            if zero:
+                if zero_run is not None and zero_run[0] + zero_run[1] == offset:
+                    zero_run[1] += length
+                else:
+                    _zero_out(fd, zero_run, is_device, stats)
+                    zero_run = [offset, length]
+            else:
+                _zero_out(fd, zero_run, is_device, stats)
+                zero_run = None
+                if data is None:
+                    data = memoryview(zeros)[:length]
+                _pwrite(fd, data, offset)
+                stats.written += length
+            if buf is not None:
+                free.put(buf)
+            # flush data to the device periodically
+            if stats.written - synced >= sync_every:
+                _fdatasync(fd)
+                synced = stats.written
+            if callback is not None and time.time() - last_notify >= PROGRESS_INTERVAL:
+                callback(stats)
+                last_notify = time.time()
+        if reader.error is not None:
+            raise FlashError(f"Error while reading the disk image: {str(reader.error)}")
+        # the size of streams becomes known at the end
+        if size is None:
+            size = stats.total = stats.done
+            if hasher is not None:
+                hasher.finish(size)
+        _zero_out(fd, zero_run, is_device, stats)
+        # regular files need to be extended to include trailing holes
+        if not is_device:
+            os.ftruncate(fd, size)
+        os.fsync(fd)
+    finally:
+        reader.stop(free)
+        os.close(fd)
+        if close_source:
+            source.close()
+    if hasher is not None:
+        save_manifest(hasher.manifest(), manifest_out)
+    if callback is not None:
+        callback(stats)
+    return stats.as_dict()
+
+
+def verify(target, manifest=None, source=None, written_only=False, block_size=DEFAULT_BLOCK_SIZE,
+           callback=None):
+    """
+    Verifies the content of `target` block by block.
+
+    The expected block hashes come from a block-hash manifest (e.g., shipped with the disk
+    image or written by `flash`), in which case only the target is read. Otherwise, they
+    are computed from `source` on a separate thread while the target is being read.
+
+    Args:
+        target:         path to the device (or file) to verify
+        manifest:       (optional) block-hash manifest, as returned by `load_manifest`
+        source:         (optional) path to the disk image, used when `manifest` is not given
+        written_only:   skip the blocks that `flash` zeroed instead of writing
+        block_size:     size of the blocks (ignored when `manifest` is given)
+        callback:       function called as `callback(stats)` while verifying
+
+    Returns:
+        a dictionary with the statistics of the operation
+    """
+    skip = set()
+    if manifest is not None:
+        algorithm = manifest["algorithm"]
+        block_size = manifest["block_size"]
+        size = manifest["size"]
+        expected = manifest["blocks"].__getitem__
+        if written_only:
+            skip = set(manifest.get("zeroed_blocks", []))
+    elif source is not None:
+        algorithm = default_hash_algorithm()
+        size = os.stat(source).st_size
+        source_hasher = _SourceHasher(source, size, block_size, algorithm)
+        source_hasher.start()
+        expected = source_hasher.get
+    else:
+        raise VerifyError("Either a block-hash manifest or the disk image is needed")
+    stats = VerifyStats(size)
+    stats.skipped = sum(min(block_size, size - i * block_size) for i in skip)
+    free, full = queue.Queue(), queue.Queue()
+    for _ in range(NUM_BUFFERS):
+        free.put(bytearray(block_size))
+    device = open(target, "rb", buffering=0)
+    reader = _BlockReader(device, size, block_size, free, full, skip=skip)
+    reader.start()
+    hasher = _BlockHasher(algorithm, block_size, size)
+    zeros = bytes(block_size)
+    last_notify = 0
+    try:
+        while True:
+            item = full.get()
+            if item is None:
+                break
+            offset, length, buf = item
+            data = memoryview(buf)[:length] if buf is not None else memoryview(zeros)[:length]
+            block = hasher.update(offset, data)
+            if buf is not None:
+                free.put(buf)
+            stats.verified += length
+            if block is not None and hasher.blocks[block] != expected(block):
+                start = block * block_size
+                end = min(size, start + block_size)
+                raise VerifyError(f"Mismatch in range position [{start}-{end}]")
+            if callback is not None and time.time() - last_notify >= PROGRESS_INTERVAL:
+                callback(stats)
+                last_notify = time.time()
+        if reader.error is not None:
+            raise VerifyError(f"Error while reading the device: {str(reader.error)}")
+    finally:
+        reader.stop(free)
+        device.close()
+    if callback is not None:
+        callback(stats)
+    return stats.as_dict()
+
+
+def surgery(target, writes, retries=SURGERY_RETRIES, callback=None):
+    """
+    Applies a list of writes to `target` in a single pass.
+
+    The target is opened once, the writes are applied in order of offset followed by a
+    single fsync. Every block is then read back (bypassing the page cache, where
+    supported) and its checksum is compared against the expected one, blocks that do
+    not match are written again (up to `retries` times).
+
+    Args:
+        target:     path to the device (or file) to modify
+        writes:     list of pairs (offset, data)
+        retries:    number of times a block that does not match is written again
+        callback:   function called as `callback(stats)` after each pass
+
+    Returns:
+        a dictionary with the statistics of the operation
+    """
+    writes = sorted(writes, key=lambda w: w[0])
+    for (offset1, data1), (offset2, _) in zip(writes, writes[1:]):
+        if offset1 + len(data1) > offset2:
+            raise FlashError(f"Overlapping writes at bytes {offset1} and {offset2}")
+    stime = time.time()
+    total = sum(len(data) for _, data in writes)
+    stats = {"total": total, "done": 0, "writes": len(writes), "rewrites": 0, "throughput": 0}
+    fd = os.open(target, os.O_RDWR)
+    try:
+        pending = writes
+        for trial in range(retries + 1):
+            for offset, data in pending:
+                _pwrite(fd, memoryview(data), offset)
+            os.fsync(fd)
+            # make sure we read back what is on the device, not what is in memory
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            pending = [
+                (offset, data)
+                for offset, data in pending
+                if hashlib.sha256(_pread(fd, len(data), offset)).digest() != hashlib.sha256(data).digest()
+            ]
+            stats["done"] = total - sum(len(data) for _, data in pending)
+            stats["throughput"] = stats["done"] / max(0.001, time.time() - stime)
+            if callback is not None:
+                callback(stats)
+            if not pending:
+                break
+            stats["rewrites"] += len(pending)
+        if pending:
+            raise FlashError(
+                f"{len(pending)} block(s) could not be written, the first one is at byte {pending[0][0]}"
+            )
+    finally:
+        os.close(fd)
+    stats["elapsed"] = time.time() - stime
+    return stats
+
+
+def new_hasher(algorithm):
+    if algorithm == "blake3":
+        import blake3
+        return blake3.blake3()
+    if algorithm == "xxh3_128":
+        import xxhash
+        return xxhash.xxh3_128()
+    if algorithm == "blake2b":
+        return hashlib.blake2b(digest_size=16)
+    raise ValueError(f"Hash algorithm '{algorithm}' not supported")
+
+
+def hash_available(algorithm):
+    try:
+        new_hasher(algorithm)
+        return True
+    except ImportError:
+        return False
+
+
+def default_hash_algorithm():
+    for algorithm in HASH_ALGORITHMS:
+        try:
+            new_hasher(algorithm)
+            return algorithm
+        except ImportError:
+            continue
+
+
+def load_manifest(fpath):
+    with open(fpath, "rt") as fin:
+        manifest = json.load(fin)
+    if manifest.get("version") != MANIFEST_VERSION:
+        raise ValueError(f"Block-hash manifest version {manifest.get('version')} not supported")
+    # make sure we know the hash function (it might still need a module that is not installed)
+    if manifest.get("algorithm") not in HASH_ALGORITHMS:
+        raise ValueError(f"Hash algorithm '{manifest.get('algorithm')}' not supported")
+    return manifest
+
+
+def save_manifest(manifest, fpath):
+    tmp = f"{fpath}.tmp"
+    with open(tmp, "wt") as fout:
+        json.dump(manifest, fout)
+    os.replace(tmp, fpath)
+
+
+class _BlockHasher:
+    """
+    Computes the hashes of consecutive blocks of data. Data is fed in pieces that never
+    cross the boundary of a block (see `_BlockReader`). The size can be None when the data
+    comes from a stream, see `finish`.
+    """
+
+    def __init__(self, algorithm, block_size, size):
+        self._algorithm = algorithm
+        self._block_size = block_size
+        self._size = size
+        self._hasher = None
+        self._zero = True
+        self.blocks = {}
+        self.zeroed_blocks = []
+
+    def update(self, offset, data, zero=False):
+        """
+        Returns the index of the block completed by the given piece of data, if any.
+        """
+        if offset % self._block_size == 0:
+            self._hasher = new_hasher(self._algorithm)
+            self._zero = True
+        self._hasher.update(data)
+        self._zero = self._zero and zero
+        end = offset + len(data)
+        if end % self._block_size != 0 and end != self._size:
+            return None
+        block = offset // self._block_size
+        self.blocks[block] = self._hasher.hexdigest()
+        if self._zero:
+            self.zeroed_blocks.append(block)
+        return block
+
+    def finish(self, size):
+        """
+        Sets the size of the data (when not known in advance) and completes the last block.
+        """
+        if self._size is None and size % self._block_size != 0:
+            block = size // self._block_size
+            self.blocks[block] = self._hasher.hexdigest()
+            if self._zero:
+                self.zeroed_blocks.append(block)
+        self._size = size
+
+    def manifest(self):
+        num_blocks = (self._size + self._block_size - 1) // self._block_size
+        return {
+            "version": MANIFEST_VERSION,
+            "algorithm": self._algorithm,
+            "block_size": self._block_size,
+            "size": self._size,
+            "blocks": [self.blocks.get(i, None) for i in range(num_blocks)],
+            "zeroed_blocks": self.zeroed_blocks,
+        }
+
+
+class _SourceHasher(threading.Thread):
+    def __init__(self, source, size, block_size, algorithm):
+        super(_SourceHasher, self).__init__(daemon=True)
+        self._source = source
+        self._size = size
+        self._block_size = block_size
+        self._hasher = _BlockHasher(algorithm, block_size, size)
+        self._finished = False
+        self._error = None
+        self._cond = threading.Condition()
+
+    def run(self):
+        free, full = queue.Queue(), queue.Queue()
+        for _ in range(NUM_BUFFERS):
+            free.put(bytearray(self._block_size))
+        zeros = bytes(self._block_size)
+        try:
+            with open(self._source, "rb", buffering=0) as source:
+                reader = _BlockReader(source, self._size, self._block_size, free, full)
+                reader.start()
+                while True:
+                    item = full.get()
+                    if item is None:
+                        break
+                    offset, length, buf = item
+                    data = memoryview(buf)[:length] if buf is not None else memoryview(zeros)[:length]
+                    with self._cond:
+                        if self._hasher.update(offset, data) is not None:
+                            self._cond.notify_all()
+                    if buf is not None:
+                        free.put(buf)
+                self._error = reader.error
+        except BaseException as e:
+            self._error = e
+        finally:
+            with self._cond:
+                self._finished = True
+                self._cond.notify_all()
+
+    def get(self, block):
+        with self._cond:
+            self._cond.wait_for(lambda: block in self._hasher.blocks or self._finished)
+            if block not in self._hasher.blocks:
+                raise VerifyError(f"Error while reading the disk image: {str(self._error)}")
+            return self._hasher.blocks[block]
+
+
+class _BlockReader(threading.Thread):
+    """
+    Reads `source` in pieces that never cross the boundary of a block, holes of sparse
+    files are reported without reading them. Blocks in `skip` are not read at all.
+    """
+
+    def __init__(self, source, size, block_size, free, full, skip=None):
+        super(_BlockReader, self).__init__(daemon=True)
+        self._source = source
+        self._size = size
+        self._block_size = block_size
+        self._free = free
+        self._full = full
+        self._skip = skip or set()
+        self._stopped = False
+        self.error = None
+
+    def run(self):
+        try:
+            for start, end, hole in _extents(self._source, self._size):
+                offset = start
+                while (end is None or offset < end) and not self._stopped:
+                    length = self._block_size - offset % self._block_size
+                    if end is not None:
+                        length = min(length, end - offset)
+                    if offset // self._block_size in self._skip:
+                        offset += length
+                        continue
+                    if hole:
+                        self._full.put((offset, length, None))
+                    else:
+                        buf = self._free.get()
+                        if buf is None:
+                            return
+                        if self._skip:
+                            self._source.seek(offset)
+                        nread = _readinto(self._source, memoryview(buf)[:length])
+                        if nread < length:
+                            if end is not None:
+                                raise FlashError(f"Unexpected end of data at byte {offset + nread}")
+                            # end of a stream of unknown size
+                            if nread > 0:
+                                self._full.put((offset, nread, buf))
+                            return
+                        self._full.put((offset, length, buf))
+                    offset += length
+        except BaseException as e:
+            self.error = e
+        finally:
+            self._full.put(None)
+
+    def stop(self, free):
+        self._stopped = True
+        # unblock the reader if it is waiting for a buffer
+        free.put(None)
+
+
+def _extents(source, size):
+    """
+    Yields (start, end, is_hole) triplets covering the first `size` bytes of `source`.
+    Holes are only reported for sparse regular files on systems supporting SEEK_DATA.
+    A `size` of None means that the source has to be read until EOF.
+    """
+    if size is None or not hasattr(os, "SEEK_DATA") or not _is_regular_file(source):
+        yield 0, size, False
+        return
+    fd = source.fileno()
+    offset = 0
+    while offset < size:
+        try:
+            data = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError:
+            # no more data after `offset`
+            data = size
+        data = min(data, size)
+        if data > offset:
+            yield offset, data, True
+        if data >= size:
+            break
+        hole = min(os.lseek(fd, data, os.SEEK_HOLE), size)
+        os.lseek(fd, data, os.SEEK_SET)
+        yield data, hole, False
+        offset = hole
+
+
+def _is_regular_file(source):
+    try:
+        return stat.S_ISREG(os.fstat(source.fileno()).st_mode)
+    except (AttributeError, OSError, ValueError):
+        return False
+
+
+def _readinto(source, view):
+    nread = 0
+    while nread < len(view):
+        n = source.readinto(view[nread:])
+        if not n:
+            break
+        nread += n
+    return nread
+
+
+def _pread(fd, length, offset):
+    data = b""
+    while len(data) < length:
+        chunk = os.pread(fd, length - len(data), offset + len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def _pwrite(fd, data, offset):
+    while len(data):
+        n = os.pwrite(fd, data, offset)
+        data = data[n:]
+        offset += n
+
+
+def _is_zero(data, zeros):
+    # cheap test on the edges first, most non-zero blocks end here
+    if data[0] or data[-1]:
+        return False
+    if len(data) == len(zeros):
+        return data.tobytes() == zeros
+    return data.tobytes() == bytes(len(data))
+
+
+def _zero_out(fd, zero_run, is_device, stats):
+    if zero_run is None:
+        return
+    offset, length = zero_run
+    stats.zeroed += length
+    # regular files are truncated when opened, holes are already zero
+    if not is_device:
+        return
+    try:
+        import fcntl
+        fcntl.ioctl(fd, BLKZEROOUT, struct.pack("QQ", offset, length))
+        return
+    except (ImportError, OSError):
+        pass
+    # the device does not support BLKZEROOUT, write the zeros
+    zeros = bytes(min(length, DEFAULT_BLOCK_SIZE))
+    end = offset + length
+    while offset < end:
+        n = min(len(zeros), end - offset)
+        _pwrite(fd, memoryview(zeros)[:n], offset)
+        offset += n
+
+
+def _emit(kind, payload):
+    sys.stdout.write(json.dumps({kind: payload}) + "\n")
+    sys.stdout.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="flasher")
+    subparsers = parser.add_subparsers(dest="action")
+    flash_parser = subparsers.add_parser("flash")
+    flash_parser.add_argument("source", help="Disk image to flash ('-' for stdin)")
+    flash_parser.add_argument("target", help="Device or file to write")
+    flash_parser.add_argument("--size", type=int, default=None, help="Number of bytes to flash")
+    flash_parser.add_argument("--block-size", type=int, default=DEFAULT_BLOCK_SIZE)
+    flash_parser.add_argument("--sync-every", type=int, default=DEFAULT_SYNC_EVERY)
+    flash_parser.add_argument("--no-sparse", dest="sparse", default=True, action="store_false")
+    flash_parser.add_argument("--manifest-out", default=None, help="Where to store the block hashes")
+    verify_parser = subparsers.add_parser("verify")
+    verify_parser.add_argument("target", help="Device or file to verify")
+    verify_parser.add_argument("--manifest", default=None, help="Block-hash manifest to verify against")
+    verify_parser.add_argument("--source", default=None, help="Disk image to verify against")
+    verify_parser.add_argument("--block-size", type=int, default=DEFAULT_BLOCK_SIZE)
+    verify_parser.add_argument(
+        "--written-only",
+        default=False,
+        action="store_true",
+        help="Skip the blocks that were zeroed instead of written",
+    )
+    surgery_parser = subparsers.add_parser(
+        "surgery", description="Writes are read from stdin as JSON: {'writes': [{'offset', 'data'}]}, "
+                               "with data encoded in base64"
+    )
+    surgery_parser.add_argument("target", help="Device or file to modify")
+    surgery_parser.add_argument("--retries", type=int, default=SURGERY_RETRIES)
+    parsed = parser.parse_args()
+    try:
+        if parsed.action == "flash":
+            source = sys.stdin.buffer if parsed.source == "-" else parsed.source
+            result = flash(
+                source,
+                parsed.target,
+                size=parsed.size,
+                block_size=parsed.block_size,
+                sync_every=parsed.sync_every,
+                sparse=parsed.sparse,
+                manifest_out=parsed.manifest_out,
+                callback=lambda s: _emit("progress", s.as_dict()),
+            )
+        elif parsed.action == "verify":
+            manifest = load_manifest(parsed.manifest) if parsed.manifest else None
+            # the flasher runs as root, whose Python might lack the hash function of the manifest
+            if manifest is not None and not hash_available(manifest["algorithm"]):
+                message = f"The hash function '{manifest['algorithm']}' of the block-hash manifest is not available"
+                if parsed.source is None:
+                    _emit("warning", f"{message}, the verification was skipped.")
+                    stats = VerifyStats(manifest["size"])
+                    stats.skipped = manifest["size"]
+                    _emit("result", stats.as_dict())
+                    return 0
+                _emit("warning", f"{message}, verifying against the disk image instead.")
+                manifest = None
+            result = verify(
+                parsed.target,
+                manifest=manifest,
+                source=parsed.source,
+                written_only=parsed.written_only,
+                block_size=parsed.block_size,
+                callback=lambda s: _emit("progress", s.as_dict()),
+            )
+        elif parsed.action == "surgery":
+            writes = [
+                (w["offset"], base64.b64decode(w["data"])) for w in json.load(sys.stdin)["writes"]
+            ]
+            result = surgery(
+                parsed.target,
+                writes,
+                retries=parsed.retries,
+                callback=lambda s: _emit("progress", s),
+            )
+        else:
+            parser.print_usage()
+            return 1
+    except (FlashError, VerifyError, KeyError, ValueError, ImportError, OSError) as e:
+        _emit("error", str(e))
+        return 2
+    _emit("result", result)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -48,5 +48,7 @@ Please, update your Duckietown Shell using the following command,
 
 check_compatible()
 
-# noinspection PyUnresolvedReferences
-from .command import DTCommand
+# commands are loaded lazily, `command.py` is imported only when used
+from utils.commands_utils import lazy_commands_package as _lazy_commands_package
+
+__getattr__, __dir__ = _lazy_commands_package(__name__, __file__)
@@ -1,36 +1,19 @@
 import json
-import time
-from types import SimpleNamespace
-from zeroconf import ServiceBrowser, Zeroconf
 
 from dt_shell import dtslogger
 
+from utils.discovery_utils import get_discovery
+from utils.networking_utils import forget_duckiebot_ip
 
-def wait_for_service(target_service: str, target_hostname: str = None, timeout: int = 10):
-    # define callbacks
-    workspace = SimpleNamespace(service=target_service, hostname=target_hostname, data=None)
-
-    def cb(service: str, hostname: str, data: dict):
-        if target_service == service and target_hostname == hostname:
-            workspace.data = data
-            workspace.service = service
-            workspace.hostname = hostname
 
-    # perform discover
-    zeroconf = Zeroconf()
-    listener = DiscoverListener(service_in_callback=cb)
-    ServiceBrowser(zeroconf, "_duckietown._tcp.local.", listener)
-    # wait
-    stime = time.time()
-    while workspace.data is None:
-        time.sleep(0.5)
-        if (timeout > 0) and (time.time() - stime > timeout):
-            msg = f"No devices matched the search criteria (service={target_service}, hostname={target_hostname})."
-            zeroconf.close()
-            raise TimeoutError(msg)
-    zeroconf.close()
+def wait_for_service(target_service: str, target_hostname: str = None, timeout: int = 10):
+    # the discovery agent answers right away, otherwise devices are discovered in-process
+    data = get_discovery().wait_for(target_service, target_hostname, timeout)
+    if data is None:
+        msg = f"No devices matched the search criteria (service={target_service}, hostname={target_hostname})."
+        raise TimeoutError(msg)
     # ---
-    return workspace.service, workspace.hostname, workspace.data
+    return target_service, target_hostname, data["txt"]
 
 
 class DiscoverListener:
@@ -62,6 +45,9 @@ class DiscoverListener:
         dtslogger.debug(f"Zeroconf:SERVICE_OUT (name={name}, hostname={hostname}, data={txt})")
         if not name:
             return
+        # the device left the network, its address might change
+        if name == "DT::PRESENCE":
+            forget_duckiebot_ip(hostname)
         if self.service_out_callback:
             self.service_out_callback(name, hostname, txt)
 
@@ -1,8 +1,12 @@
 import os
+import re
 import sys
 import math
+import logging
+import threading
 import subprocess
 from shutil import which
+from contextlib import contextmanager
 
 from dt_shell import dtslogger
 
@@ -123,3 +127,93 @@ def check_program_dependency(exe):
     if p is None:
         raise Exception("Could not find program %r" % exe)
     dtslogger.debug("Found %r at %s" % (exe, p))
+
+
+_output_prefix = threading.local()
+
+
+def set_output_prefix(prefix):
+    _output_prefix.value = prefix
+
+
+def get_output_prefix():
+    return getattr(_output_prefix, "value", None)
+
+
+class PrefixedStream:
+    """
+    Wraps a text stream and prefixes every line with the output prefix of the thread
+    writing it (see `set_output_prefix`). Lines are written atomically, so that the output
+    of concurrent threads gets interleaved line by line.
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._lock = threading.Lock()
+        # incomplete lines, {thread: (prefix, line)}
+        self._pending = {}
+
+    @property
+    def stream(self):
+        return self._stream
+
+    def write(self, data):
+        prefix = get_output_prefix()
+        thread = threading.get_ident()
+        if prefix is None and thread not in self._pending:
+            with self._lock:
+                return self._stream.write(data)
+        # split into lines, keep the last (incomplete) line until it is complete
+        prefix, buffer = self._pending.pop(thread, (prefix, ""))
+        lines = re.split(r"(?<=[\n\r])", buffer + data)
+        partial = lines.pop()
+        if partial:
+            self._pending[thread] = (prefix, partial)
+        with self._lock:
+            for line in lines:
+                self._stream.write(prefix + line)
+        return len(data)
+
+    def flush(self):
+        # incomplete lines are not flushed, they would end up split across multiple lines
+        with self._lock:
+            self._stream.flush()
+
+    def close(self):
+        """
+        Writes the incomplete lines left, the wrapped stream is not closed.
+        """
+        with self._lock:
+            for prefix, line in self._pending.values():
+                self._stream.write(prefix + line + "\n")
+            self._pending.clear()
+            self._stream.flush()
+
+    def __getattr__(self, item):
+        return getattr(self._stream, item)
+
+
+class _PrefixFilter(logging.Filter):
+    def filter(self, record):
+        prefix = get_output_prefix()
+        if prefix is not None:
+            record.msg = f"{prefix}{record.msg}"
+        return True
+
+
+@contextmanager
+def prefixed_output():
+    """
+    Within this context, everything written to stdout or through `dtslogger` by a thread
+    is prefixed with the output prefix of that thread.
+    """
+    stream = PrefixedStream(sys.stdout)
+    log_filter = _PrefixFilter()
+    sys.stdout = stream
+    dtslogger.addFilter(log_filter)
+    try:
+        yield stream
+    finally:
+        stream.close()
+        sys.stdout = stream.stream
+        dtslogger.removeFilter(log_filter)
@@ -0,0 +1,137 @@
+import os
+import re
+import ast
+import sys
+import importlib
+
+from dt_shell import DTCommandAbs, DTCommandPlaceholder
+
+COMMAND_FILE = "command.py"
+COMMAND_MODULE = "command"
+# attributes the shell sets on the command classes it loads
+SHELL_ATTRIBUTES = ["name", "level", "commands", "parser", "descriptor"]
+# the attribute `help` in the body of the class DTCommand (i.e., not in its methods)
+COMMAND_CLASS = re.compile(r"^class DTCommand\b")
+COMMAND_HELP = re.compile(r"^ {4}help\s*=\s*(.+?)\s*$")
+
+
+def find_submodules(path: str) -> set:
+    """
+    Returns the names of the modules and packages in the directory `path`, without importing them.
+    """
+    names = set()
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir() and os.path.isfile(os.path.join(entry.path, "__init__.py")):
+                names.add(entry.name)
+            elif entry.is_file() and entry.name.endswith(".py") and entry.name != "__init__.py":
+                names.add(entry.name[: -len(".py")])
+    return names
+
+
+def read_command_help(command_file: str):
+    """
+    Returns the `help` of the class DTCommand defined in the given file, without importing it.
+    Only string literals are supported, None is returned otherwise.
+    """
+    try:
+        with open(command_file, "rt") as fin:
+            source = fin.read()
+    except OSError:
+        return None
+    match, in_class = None, False
+    for line in source.splitlines():
+        if COMMAND_CLASS.match(line):
+            in_class = True
+        elif in_class and line and not line[0].isspace():
+            # the class ended
+            break
+        elif in_class:
+            match = COMMAND_HELP.match(line)
+            if match:
+                break
+    if match is None:
+        return None
+    try:
+        value = ast.literal_eval(match.group(1))
+    except (ValueError, SyntaxError):
+        return None
+    return value if isinstance(value, str) else None
+
+
+def load_command(package: str):
+    """
+    Imports the module `command` of the given package and returns its class DTCommand.
+    """
+    return importlib.import_module(f"{package}.{COMMAND_MODULE}").DTCommand
+
+
+def lazy_command(package: str, help: str = None):
+    """
+    Returns a DTCommand class that imports the actual command (and its dependencies) only
+    when the command is executed or auto-completed. The `help` is the one shown by the shell.
+    """
+
+    def _load():
+        # the shell configured the proxy, the actual command gets the same configuration
+        klass = load_command(package)
+        for attr in SHELL_ATTRIBUTES:
+            if attr in DTCommand.__dict__:
+                setattr(klass, attr, DTCommand.__dict__[attr])
+        return klass
+
+    class DTCommand(DTCommandAbs):
+        @staticmethod
+        def command(shell, args, **kwargs):
+            return _load().command(shell, args, **kwargs)
+
+        @staticmethod
+        def complete(shell, word, line):
+            return _load().complete(shell, word, line)
+
+    DTCommand.help = help
+    DTCommand.__module__ = package
+    DTCommand.__qualname__ = "DTCommand"
+    return DTCommand
+
+
+def lazy_commands_package(name: str, init_file: str):
+    """
+    Makes a package of commands lazy, nothing is imported until it is used.
+    Returns the functions `__getattr__` and `__dir__` for the package (see PEP 562).
+
+    Usage (in `__init__.py`):
+
+        __getattr__, __dir__ = lazy_commands_package(__name__, __file__)
+
+    Subpackages (i.e., subcommands) and modules are imported when they are accessed.
+    The attribute `DTCommand` is a proxy to the class DTCommand defined in `command.py`
+    (a placeholder if the package only groups subcommands), with the same `help` (read from
+    the source, see `read_command_help`), any other attribute is looked
+    up in `command.py`, like the `from .command import *` these packages used to do.
+    """
+    module = sys.modules[name]
+    path = os.path.dirname(os.path.abspath(init_file))
+    has_command = os.path.isfile(os.path.join(path, COMMAND_FILE))
+    submodules = find_submodules(path)
+
+    def __getattr__(attr: str):
+        if attr in submodules:
+            # importing a submodule also sets it as an attribute of this package
+            return importlib.import_module(f"{name}.{attr}")
+        if attr == "DTCommand":
+            if has_command:
+                value = lazy_command(name, read_command_help(os.path.join(path, COMMAND_FILE)))
+            else:
+                value = type("DTCommand", (DTCommandPlaceholder,), {})
+        elif has_command and not attr.startswith("__"):
+            value = getattr(importlib.import_module(f"{name}.{COMMAND_MODULE}"), attr)
+        else:
+            raise AttributeError(f"module '{name}' has no attribute '{attr}'")
+        setattr(module, attr, value)
+        return value
+
+    def __dir__():
+        return sorted(set(module.__dict__) | submodules | {"DTCommand"})
+
+    return __getattr__, __dir__
@@ -0,0 +1,349 @@
+import os
+import sys
+import json
+import time
+import atexit
+import signal
+import socket
+import threading
+import subprocess
+import socketserver
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from dt_shell import dtslogger
+
+from utils.misc_utils import get_cache_dir
+from utils.networking_utils import forget_duckiebot_ip, DUCKIETOWN_SERVICE_TYPE
+
+AGENT_SOCKET_FILE = "agent.sock"
+AGENT_PID_FILE = "agent.pid"
+AGENT_CONNECT_TIMEOUT = 0.2
+AGENT_START_TIMEOUT = 5
+SERVICE_INFO_TIMEOUT_MS = 3000
+SERVICE_INFO_WORKERS = 8
+# number of changes remembered by the table, clients lagging further behind get a full snapshot
+CHANGE_LOG_SIZE = 4096
+
+
+class ServiceTable:
+    """
+    Live table of the `DT::*` services announced by the devices on the network, indexed by
+    service and by hostname. Every change bumps the version of the table and wakes up whoever
+    is waiting for it, nobody needs to poll. The latest changes are logged, so that clients
+    can fetch only the devices that changed.
+    """
+
+    def __init__(self):
+        self._services = defaultdict(dict)
+        self._devices = defaultdict(dict)
+        self._version = 0
+        self._log = deque(maxlen=CHANGE_LOG_SIZE)
+        self._cond = threading.Condition()
+
+    def add(self, service: str, hostname: str, record: dict):
+        with self._cond:
+            self._services[service][hostname] = record
+            self._devices[hostname][service] = record
+            self._changed(hostname)
+
+    def remove(self, service: str, hostname: str):
+        with self._cond:
+            if self._services[service].pop(hostname, None) is not None:
+                self._devices[hostname].pop(service, None)
+                if not self._devices[hostname]:
+                    del self._devices[hostname]
+                self._changed(hostname)
+
+    def _changed(self, hostname: str):
+        self._version += 1
+        self._log.append((self._version, hostname))
+        self._cond.notify_all()
+
+    def table(self) -> dict:
+        with self._cond:
+            return {service: dict(devices) for service, devices in self._services.items() if devices}
+
+    def wait_for(self, service: str, hostname: str, timeout: float) -> Optional[dict]:
+        """
+        Returns the record of the service `service` announced by `hostname`, waiting for at
+        most `timeout` seconds (forever if timeout <= 0) for it to appear. Returns None on timeout.
+        """
+        deadline = time.time() + timeout if timeout > 0 else None
+        with self._cond:
+            while hostname not in self._services[service]:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+            return self._services[service][hostname]
+
+    def wait_for_devices(self, since: int, timeout: float) -> (int, dict):
+        """
+        Waits (at most `timeout` seconds) for the table to change after version `since`.
+        Returns the pair (version, devices), where devices is a dictionary {hostname: {service:
+        record}} with the devices that changed after `since` (all of them if since is 0, or if
+        `since` comes from another table, e.g., before the agent was restarted).
+        Devices that left the network have no services.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._version != since, timeout)
+            oldest = self._version - len(self._log)
+            if since <= 0 or since < oldest or since > self._version:
+                hostnames = set(self._devices.keys())
+            else:
+                hostnames = set(hostname for version, hostname in self._log if version > since)
+            devices = {hostname: dict(self._devices.get(hostname, {})) for hostname in hostnames}
+            return self._version, devices
+
+
+class _TableListener:
+    """
+    Feeds a ServiceTable. Service info is resolved on a pool of workers, not in the callbacks
+    of the browser, so that a slow device does not hold back the others.
+    """
+
+    def __init__(self, table: ServiceTable):
+        self._table = table
+        self._executor = ThreadPoolExecutor(max_workers=SERVICE_INFO_WORKERS)
+        # services are resolved only if they did not disappear in the meantime
+        self._generation = defaultdict(int)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _parse_name(sname):
+        name = sname.replace("." + DUCKIETOWN_SERVICE_TYPE, "")
+        service_parts = name.split("::")
+        if len(service_parts) != 3 or service_parts[0] != "DT":
+            return None, None
+        return "{}::{}".format(service_parts[0], service_parts[1]), service_parts[2]
+
+    def add_service(self, zeroconf, type, sname):
+        service, hostname = self._parse_name(sname)
+        if not service:
+            return
+        with self._lock:
+            self._generation[sname] += 1
+            generation = self._generation[sname]
+        self._executor.submit(self._resolve, zeroconf, type, sname, service, hostname, generation)
+
+    def update_service(self, zeroconf, type, sname):
+        self.add_service(zeroconf, type, sname)
+
+    def remove_service(self, zeroconf, type, sname):
+        service, hostname = self._parse_name(sname)
+        if not service:
+            return
+        with self._lock:
+            self._generation[sname] += 1
+        dtslogger.debug(f"Zeroconf:SERVICE_OUT (name={service}, hostname={hostname})")
+        self._table.remove(service, hostname)
+        # the device left the network, its address might change
+        if service == "DT::PRESENCE":
+            forget_duckiebot_ip(hostname)
+
+    def _resolve(self, zeroconf, type, sname, service, hostname, generation):
+        try:
+            info = zeroconf.get_service_info(type, sname, timeout=SERVICE_INFO_TIMEOUT_MS)
+        except Exception as e:
+            dtslogger.debug(f"Could not resolve the service {sname}: {str(e)}")
+            return
+        if info is None:
+            return
+        txt = dict()
+        try:
+            txt = json.loads(list(info.properties.keys())[0].decode("utf-8")) if len(info.properties) else dict()
+        except (ValueError, UnicodeDecodeError):
+            pass
+        addresses = getattr(info, "addresses", None) or [info.address]
+        record = {
+            "port": info.port,
+            "txt": txt,
+            "addresses": [socket.inet_ntoa(a) for a in addresses if a],
+        }
+        with self._lock:
+            if self._generation[sname] != generation:
+                return
+            dtslogger.debug(f"Zeroconf:SERVICE_IN (name={service}, hostname={hostname}, data={txt})")
+            self._table.add(service, hostname, record)
+
+
+def start_browser(table: ServiceTable):
+    """
+    Starts browsing the Duckietown services on the network, feeding the given table.
+    Returns the Zeroconf object, to be closed when done.
+    """
+    from zeroconf import ServiceBrowser, Zeroconf
+
+    zeroconf = Zeroconf()
+    ServiceBrowser(zeroconf, DUCKIETOWN_SERVICE_TYPE, _TableListener(table))
+    return zeroconf
+
+
+class AgentClient:
+    """
+    Client for the discovery agent. It exposes the same query methods of ServiceTable.
+    Raises ConnectionError if the agent is not running.
+    """
+
+    def __init__(self, socket_path: Optional[str] = None):
+        self._socket_path = socket_path or agent_socket_path()
+        self.request("ping", timeout=AGENT_CONNECT_TIMEOUT)
+
+    def request(self, op: str, timeout: Optional[float] = None, **kwargs):
+        if not hasattr(socket, "AF_UNIX"):
+            raise ConnectionError("UNIX sockets are not supported on this platform")
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.settimeout(AGENT_CONNECT_TIMEOUT)
+                sock.connect(self._socket_path)
+                sock.settimeout(timeout)
+                sock.sendall(json.dumps(dict(op=op, **kwargs)).encode("utf-8") + b"\n")
+                response = json.loads(sock.makefile("rb").readline().decode("utf-8"))
+        except (OSError, ValueError) as e:
+            raise ConnectionError(f"Discovery agent not reachable: {str(e)}")
+        if "error" in response:
+            raise ConnectionError(response["error"])
+        return response["result"]
+
+    def table(self) -> dict:
+        return self.request("table")
+
+    def wait_for(self, service: str, hostname: str, timeout: float) -> Optional[dict]:
+        return self.request(
+            "wait_for", timeout=timeout + 1 if timeout > 0 else None,
+            service=service, hostname=hostname, wait=timeout
+        )
+
+    def wait_for_devices(self, since: int, timeout: float) -> (int, dict):
+        version, devices = self.request("wait_for_devices", timeout=timeout + 1, since=since, wait=timeout)
+        return version, devices
+
+
+class _AgentHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        table = self.server.table
+        try:
+            request = json.loads(self.rfile.readline().decode("utf-8"))
+            op = request["op"]
+            if op == "ping":
+                result = os.getpid()
+            elif op == "table":
+                result = table.table()
+            elif op == "wait_for":
+                result = table.wait_for(request["service"], request["hostname"], request["wait"])
+            elif op == "wait_for_devices":
+                result = table.wait_for_devices(request["since"], request["wait"])
+            else:
+                raise ValueError(f"Unknown operation '{op}'")
+            response = {"result": result}
+        except Exception as e:
+            response = {"error": str(e)}
+        self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+
+class _AgentServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def agent_socket_path() -> str:
+    return os.path.join(get_cache_dir("discovery"), AGENT_SOCKET_FILE)
+
+
+def agent_pid() -> Optional[int]:
+    """
+    Returns the PID of the discovery agent, or None if the agent is not running.
+    """
+    try:
+        return AgentClient().request("ping", timeout=AGENT_CONNECT_TIMEOUT)
+    except ConnectionError:
+        return None
+
+
+def run_agent():
+    """
+    Runs the discovery agent in the current process, until it is terminated.
+    """
+    socket_path = agent_socket_path()
+    if agent_pid() is not None:
+        raise RuntimeError("The discovery agent is already running")
+    # remove the socket left behind by an agent that died
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    table = ServiceTable()
+    zeroconf = start_browser(table)
+    server = _AgentServer(socket_path, _AgentHandler)
+    server.table = table
+    pid_file = os.path.join(get_cache_dir("discovery"), AGENT_PID_FILE)
+    with open(pid_file, "wt") as fout:
+        fout.write(str(os.getpid()))
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start())
+    dtslogger.info(f"Discovery agent listening on {socket_path}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        zeroconf.close()
+        for fpath in [socket_path, pid_file]:
+            if os.path.exists(fpath):
+                os.remove(fpath)
+
+
+def start_agent() -> int:
+    """
+    Starts the discovery agent in a detached process and returns its PID.
+    """
+    pid = agent_pid()
+    if pid is not None:
+        return pid
+    commands_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [commands_dir, os.environ.get("PYTHONPATH")])))
+    subprocess.Popen(
+        [sys.executable, "-c", "from utils.discovery_utils import run_agent; run_agent()"],
+        cwd=commands_dir,
+        env=env,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+    stime = time.time()
+    while time.time() - stime < AGENT_START_TIMEOUT:
+        pid = agent_pid()
+        if pid is not None:
+            return pid
+        time.sleep(0.1)
+    raise RuntimeError("The discovery agent did not start")
+
+
+def stop_agent() -> bool:
+    pid = agent_pid()
+    if pid is None:
+        return False
+    os.kill(pid, signal.SIGTERM)
+    return True
+
+
+_local_table: Optional[ServiceTable] = None
+_local_table_lock = threading.Lock()
+
+
+def get_discovery():
+    """
+    Returns an object to query the Duckietown services on the network (see ServiceTable).
+    The discovery agent is used when running, otherwise the services are discovered by
+    this process (once, the table is shared by all the callers).
+    """
+    global _local_table
+    try:
+        return AgentClient()
+    except ConnectionError:
+        pass
+    with _local_table_lock:
+        if _local_table is None:
+            dtslogger.debug("Discovery agent not running, discovering devices in-process.")
+            _local_table = ServiceTable()
+            zeroconf = start_browser(_local_table)
+            atexit.register(zeroconf.close)
+        return _local_table
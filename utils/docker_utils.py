@@ -1,20 +1,24 @@
 import os
+import copy
 import platform
 import subprocess
 import sys
 import re
 import time
+import threading
 import traceback
 from datetime import datetime
 from os.path import expanduser
 
 import docker
+import requests
 from dt_shell import dtslogger
 from dt_shell.env_checks import check_docker_environment
 
 
 from utils.cli_utils import ProgressBar, start_command_in_subprocess
 from utils.networking_utils import get_duckiebot_ip
+from utils.pull_utils import pull_images
 
 RPI_GUI_TOOLS = "duckietown/rpi-gui-tools:master18"
 RPI_DUCKIEBOT_BASE = "duckietown/rpi-duckiebot-base:master18"
@@ -37,15 +41,99 @@ Docker Endpoint:
 """
 
 
+# seconds for which the output of `docker info` is considered fresh
+DOCKER_INFO_TTL = 60
+
+# process-wide registry of Docker endpoints, one client per sanitized base URL
+_endpoints = {}
+_endpoints_lock = threading.Lock()
+
+
+class _DockerEndpoint:
+    def __init__(self, url: str, client: docker.DockerClient):
+        self.url = url
+        self.client = client
+        self._info = None
+        self._info_time = 0
+        self._lock = threading.Lock()
+
+    def info(self, ttl: float = DOCKER_INFO_TTL) -> dict:
+        with self._lock:
+            if self._info is None or (time.time() - self._info_time) > ttl:
+                self._info = self.client.info()
+                self._info_time = time.time()
+            return copy.deepcopy(self._info)
+
+    def invalidate(self):
+        with self._lock:
+            self._info = None
+
+
+def _endpoint_url(endpoint=None, port=DEFAULT_DOCKER_TCP_PORT):
+    if endpoint is None:
+        return os.environ.get("DOCKER_HOST", DEFAULT_MACHINE)
+    return sanitize_docker_baseurl(endpoint, port)
+
+
+def _get_endpoint(endpoint=None, port=DEFAULT_DOCKER_TCP_PORT) -> _DockerEndpoint:
+    # clients created somewhere else are not pooled
+    if isinstance(endpoint, docker.DockerClient):
+        with _endpoints_lock:
+            for epoint in _endpoints.values():
+                if epoint.client is endpoint:
+                    return epoint
+        return _DockerEndpoint(endpoint.api.base_url, endpoint)
+    # pooled clients
+    url = _endpoint_url(endpoint, port)
+    with _endpoints_lock:
+        if url not in _endpoints:
+            client = docker.from_env() if endpoint is None else docker.DockerClient(base_url=url)
+            _endpoints[url] = _DockerEndpoint(url, client)
+            dtslogger.debug(f"Opened new Docker client for endpoint [{url}]")
+        return _endpoints[url]
+
+
+def get_endpoint_info(endpoint=None, port=DEFAULT_DOCKER_TCP_PORT, ttl=DOCKER_INFO_TTL):
+    """
+    Returns the output of `docker info` for the given endpoint. The result is cached
+    for `ttl` seconds, a copy is returned so that callers are free to modify it.
+    """
+    epoint = _get_endpoint(endpoint, port)
+    try:
+        return epoint.info(ttl)
+    except (docker.errors.APIError, requests.exceptions.ConnectionError):
+        # the endpoint went away (e.g., a robot rebooted), the next call opens a new client
+        _forget_endpoint(epoint)
+        raise
+
+
+def forget_endpoint(endpoint=None, port=DEFAULT_DOCKER_TCP_PORT):
+    """
+    Closes the pooled client for the given endpoint (if any) and drops its cached info.
+    """
+    if isinstance(endpoint, docker.DockerClient):
+        epoint = _get_endpoint(endpoint)
+    else:
+        with _endpoints_lock:
+            epoint = _endpoints.get(_endpoint_url(endpoint, port))
+    if epoint is not None:
+        _forget_endpoint(epoint)
+
+
+def _forget_endpoint(epoint: _DockerEndpoint):
+    with _endpoints_lock:
+        if _endpoints.get(epoint.url) is not epoint:
+            # not pooled (or already replaced)
+            return
+        _endpoints.pop(epoint.url)
+    epoint.invalidate()
+    epoint.client.close()
+
+
 def get_endpoint_architecture(hostname=None, port=DEFAULT_DOCKER_TCP_PORT):
     from utils.dtproject_utils import CANONICAL_ARCH
 
-    client = (
-        docker.from_env()
-        if hostname is None
-        else docker.DockerClient(base_url=sanitize_docker_baseurl(hostname, port))
-    )
-    epoint_arch = client.info()["Architecture"]
+    epoint_arch = get_endpoint_info(hostname, port)["Architecture"]
     if epoint_arch not in CANONICAL_ARCH:
         dtslogger.error(f"Architecture {epoint_arch} not supported!")
         exit(1)
@@ -62,46 +150,20 @@ def sanitize_docker_baseurl(baseurl: str, port=DEFAULT_DOCKER_TCP_PORT):
 
 
 def get_client(endpoint=None):
-    if endpoint is None:
-        return docker.from_env()
-    return (
-        endpoint
-        if isinstance(endpoint, docker.DockerClient)
-        else docker.DockerClient(base_url=sanitize_docker_baseurl(endpoint))
-    )
+    return _get_endpoint(endpoint).client
 
 
 def get_remote_client(duckiebot_ip, port=DEFAULT_DOCKER_TCP_PORT):
-    return docker.DockerClient(base_url=f"tcp://{duckiebot_ip}:{port}")
+    return _get_endpoint(duckiebot_ip, port).client
+
 
-# TODO quick hack to make this work - duplication of code above bad
 def get_endpoint_architecture_from_ip(duckiebot_ip, port=DEFAULT_DOCKER_TCP_PORT):
-    from utils.dtproject_utils import CANONICAL_ARCH
-    client = get_remote_client(duckiebot_ip, port)
-    epoint_arch = client.info()["Architecture"]
-    if epoint_arch not in CANONICAL_ARCH:
-        dtslogger.error(f"Architecture {epoint_arch} not supported!")
-        exit(1)
-    return CANONICAL_ARCH[epoint_arch]
+    return get_endpoint_architecture(duckiebot_ip, port)
+
 
 def pull_image(image, endpoint=None, progress=True):
     client = get_client(endpoint)
-    layers = set()
-    pulled = set()
-    pbar = ProgressBar() if progress else None
-    for line in client.api.pull(image, stream=True, decode=True):
-        if "id" not in line or "status" not in line:
-            continue
-        layer_id = line["id"]
-        layers.add(layer_id)
-        if line["status"] in ["Already exists", "Pull complete"]:
-            pulled.add(layer_id)
-        # update progress bar
-        if progress:
-            percentage = max(0.0, min(1.0, len(pulled) / max(1.0, len(layers)))) * 100.0
-            pbar.update(percentage)
-    if progress:
-        pbar.done()
+    pull_images(client, [image], workers=1, progress=progress)
 
 
 def push_image(image, endpoint=None, progress=True, **kwargs):
@@ -125,9 +187,11 @@ def push_image(image, endpoint=None, progress=True, **kwargs):
 
 
 def push_image_to_duckiebot(image_name, hostname):
-    # If password required, we need to configure with sshpass
-    command = "docker save %s | gzip | pv | ssh -C duckie@%s.local docker load" % (image_name, hostname,)
-    subprocess.check_output(["/bin/sh", "-c", command])
+    from utils.transfer_utils import transfer_image
+
+    # only the layers missing on the robot are sent, compressed
+    duckiebot_ip = get_duckiebot_ip(hostname)
+    transfer_image(get_client(), get_remote_client(duckiebot_ip), image_name)
 
 
 def logs_for_container(client, container_id):
@@ -1,17 +1,16 @@
 import os
 import re
 import copy
-import json
 import yaml
 import subprocess
-import requests
-import docker
+import zlib
 
 from docker.errors import APIError, ImageNotFound
 from types import SimpleNamespace
 
 from dt_shell import UserError
-from utils.docker_utils import sanitize_docker_baseurl
+from utils.docker_utils import get_client
+from utils.registry_utils import get_registry_client
 
 
 REQUIRED_METADATA_KEYS = {"*": ["TYPE_VERSION"], "1": ["TYPE", "VERSION"], "2": ["TYPE", "VERSION"]}
@@ -92,11 +91,8 @@ TEMPLATE_TO_LAUNCHFILE = {
 
 DISTRO_KEY = {"1": "MAJOR", "2": "DISTRO"}
 
-DOCKER_HUB_API_URL = {
-    "token": "https://auth.docker.io/token?scope=repository:{image}:pull&service=registry.docker.io",
-    "digest": "https://registry-1.docker.io/v2/{image}/manifests/{tag}",
-    "inspect": "https://registry-1.docker.io/v2/{image}/blobs/{digest}",
-}
+# projects loaded in this process, {path: (fingerprint, DTProject)}
+_projects_cache = {}
 
 
 class DTProject:
@@ -130,6 +126,24 @@ class DTProject:
             )
             self._adapters.append('git')
 
+    @classmethod
+    def load(cls, path: str) -> "DTProject":
+        """
+        Returns a (possibly cached) DTProject for the given path. Cached projects are reused
+        for as long as the process lives (e.g., commands chained in the same `dts` session)
+        and are invalidated when `.dtproject` or the git HEAD, refs, tags or index change.
+        Changes to the working tree that do not touch the git index are not detected.
+        """
+        path = os.path.abspath(path)
+        fingerprint = _project_fingerprint(path)
+        cached = _projects_cache.get(path)
+        if cached is not None and cached[0] == fingerprint:
+            return cached[1]
+        project = cls(path)
+        # `git status` might refresh the index, fingerprint the repository once again
+        _projects_cache[path] = (_project_fingerprint(path), project)
+        return project
+
     @property
     def path(self):
         return self._path
@@ -315,34 +329,45 @@ class DTProject:
 
     @staticmethod
     def _get_repo_info(path):
-        sha = _run_cmd(["git", "-C", f'"{path}"', "rev-parse", "HEAD"])[0]
-        branch = _run_cmd(["git", "-C", f'"{path}"', "rev-parse", "--abbrev-ref", "HEAD"])[0]
-        head_tag = _run_cmd(
-            [
-                "git",
-                "-C",
-                f'"{path}"',
-                "describe",
-                "--exact-match",
-                "--tags",
-                "HEAD",
-                "2>/dev/null",
-                "||",
-                ":",
-            ]
-        )
-        head_tag = head_tag[0] if head_tag else "ND"
-        closest_tag = _run_cmd(["git", "-C", f'"{path}"', "tag"])
-        closest_tag = closest_tag[-1] if closest_tag else "ND"
-        origin_url = _run_cmd(["git", "-C", f'"{path}"', "config", "--get", "remote.origin.url"])[0]
+        # most of the info is read straight from the `.git` directory, git is only
+        # invoked for what cannot be resolved that way (e.g., objects stored in packs)
+        gitdir = os.path.join(path, ".git")
+        head_ref, sha = _git_head(gitdir)
+        if sha is None:
+            sha = _run_cmd(["git", "-C", f'"{path}"', "rev-parse", "HEAD"])[0]
+        branch = _git_abbrev_ref(head_ref) if head_ref else "HEAD"
+        # tags
+        tags = _git_tags(gitdir)
+        head_tag = _git_head_tag(gitdir, tags, sha)
+        if head_tag is None:
+            head_tag = _run_cmd(
+                [
+                    "git",
+                    "-C",
+                    f'"{path}"',
+                    "describe",
+                    "--exact-match",
+                    "--tags",
+                    "HEAD",
+                    "2>/dev/null",
+                    "||",
+                    ":",
+                ]
+            )
+            head_tag = head_tag[0] if head_tag else "ND"
+        closest_tag = sorted(tags)[-1] if tags else "ND"
+        origin_url = _git_config(gitdir).get("remote.origin.url")
+        if origin_url is None:
+            origin_url = _run_cmd(["git", "-C", f'"{path}"', "config", "--get", "remote.origin.url"])[0]
         if origin_url.endswith(".git"):
             origin_url = origin_url[:-4]
         if origin_url.endswith("/"):
             origin_url = origin_url[:-1]
         repo = origin_url.split("/")[-1]
-        # get info about current git INDEX
-        nmodified = len(_run_cmd(["git", "-C", f'"{path}"', "status", "--porcelain", "--untracked-files=no"]))
-        nadded = len(_run_cmd(["git", "-C", f'"{path}"', "status", "--porcelain"]))
+        # get info about current git INDEX (untracked files are reported with the '??' code)
+        status = _run_cmd(["git", "-C", f'"{path}"', "status", "--porcelain"])
+        nmodified = len([line for line in status if not line.startswith("??")])
+        nadded = len(status)
         # return info
         return {
             "REPOSITORY": repo,
@@ -358,23 +383,7 @@ class DTProject:
 
     @staticmethod
     def inspect_remote_image(image, tag):
-        res = requests.get(DOCKER_HUB_API_URL["token"].format(image=image)).json()
-        token = res["token"]
-        # ---
-        res = requests.get(
-            DOCKER_HUB_API_URL["digest"].format(image=image, tag=tag),
-            headers={
-                "Accept": "application/vnd.docker.distribution.manifest.v2+json",
-                "Authorization": "Bearer {0}".format(token),
-            },
-        ).text
-        digest = json.loads(res)["config"]["digest"]
-        # ---
-        res = requests.get(
-            DOCKER_HUB_API_URL["inspect"].format(image=image, tag=tag, digest=digest),
-            headers={"Authorization": "Bearer {0}".format(token)},
-        ).json()
-        return res
+        return get_registry_client().inspect(image, tag)
 
 
 def assert_canonical_arch(arch):
@@ -410,11 +419,187 @@ def _remote_url_to_https(remote_url):
     return remote_url
 
 
+def _project_fingerprint(path):
+    def _mtime(*p):
+        try:
+            return os.stat(os.path.join(path, *p)).st_mtime_ns
+        except OSError:
+            return None
+
+    gitdir = os.path.join(path, ".git")
+    head_ref, _ = _git_head(gitdir) if os.path.isdir(gitdir) else (None, None)
+    return (
+        _mtime(".dtproject"),
+        _mtime(".git", "HEAD"),
+        _mtime(".git", "index"),
+        _mtime(".git", "packed-refs"),
+        _mtime(".git", "refs", "tags"),
+        _mtime(".git", *head_ref.split("/")) if head_ref else None,
+    )
+
+
 def _run_cmd(cmd):
     cmd = " ".join(cmd)
     return [line for line in subprocess.check_output(cmd, shell=True).decode("utf-8").split("\n") if line]
 
 
+def _git_read(gitdir, *path):
+    fpath = os.path.join(gitdir, *path)
+    if not os.path.isfile(fpath):
+        return None
+    with open(fpath, "rt") as fin:
+        return fin.read().strip()
+
+
+def _git_packed_refs(gitdir):
+    """
+    Returns a dictionary {ref: (sha, peeled_sha)} with the content of `.git/packed-refs`.
+    The peeled SHA is the commit an annotated tag points to, None if not available.
+    """
+    refs = {}
+    content = _git_read(gitdir, "packed-refs")
+    if not content:
+        return refs
+    last = None
+    for line in content.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        if line.startswith("^"):
+            if last is not None:
+                refs[last] = (refs[last][0], line[1:].strip())
+            continue
+        sha, _, ref = line.partition(" ")
+        refs[ref.strip()] = (sha, None)
+        last = ref.strip()
+    return refs
+
+
+def _git_resolve_ref(gitdir, ref, packed_refs=None):
+    # follow symbolic refs (at most a few hops, git does the same)
+    for _ in range(5):
+        content = _git_read(gitdir, *ref.split("/"))
+        if content is None:
+            packed_refs = _git_packed_refs(gitdir) if packed_refs is None else packed_refs
+            return packed_refs[ref][0] if ref in packed_refs else None
+        if not content.startswith("ref:"):
+            return content
+        ref = content[4:].strip()
+    return None
+
+
+def _git_head(gitdir):
+    """
+    Returns the pair (ref, sha) for the current HEAD. The ref is None for detached HEADs,
+    the sha is None when it cannot be resolved (e.g., empty repository).
+    """
+    content = _git_read(gitdir, "HEAD")
+    if content is None:
+        return None, None
+    if not content.startswith("ref:"):
+        return None, content
+    ref = content[4:].strip()
+    return ref, _git_resolve_ref(gitdir, ref)
+
+
+def _git_abbrev_ref(ref):
+    for prefix in ["refs/heads/", "refs/tags/", "refs/remotes/"]:
+        if ref.startswith(prefix):
+            return ref[len(prefix):]
+    return ref
+
+
+def _git_tags(gitdir):
+    """
+    Returns a dictionary {tag_name: (sha, peeled_sha)} of all the tags in the repository.
+    """
+    tags = {
+        ref[len("refs/tags/"):]: shas
+        for ref, shas in _git_packed_refs(gitdir).items()
+        if ref.startswith("refs/tags/")
+    }
+    tags_dir = os.path.join(gitdir, "refs", "tags")
+    for root, _, files in os.walk(tags_dir):
+        for fname in files:
+            fpath = os.path.join(root, fname)
+            tag = os.path.relpath(fpath, tags_dir).replace(os.sep, "/")
+            with open(fpath, "rt") as fin:
+                tags[tag] = (fin.read().strip(), None)
+    return tags
+
+
+def _git_object_header(gitdir, sha):
+    """
+    Returns the type and the first lines of a loose object, None if the object is packed.
+    """
+    fpath = os.path.join(gitdir, "objects", sha[:2], sha[2:])
+    if not os.path.isfile(fpath):
+        return None
+    with open(fpath, "rb") as fin:
+        # the header of a tag object fits in the first few hundred bytes
+        raw = zlib.decompressobj().decompress(fin.read(), 512)
+    otype, _, content = raw.partition(b" ")
+    return otype.decode("utf-8"), content.split(b"\0", 1)[-1].decode("utf-8", errors="ignore")
+
+
+def _git_head_tag(gitdir, tags, sha):
+    """
+    Returns the name of the tag pointing at the given commit, 'ND' if no tags point at it,
+    None if the answer cannot be determined by looking at the `.git` directory.
+    """
+    annotated, lightweight = [], []
+    for tag, (tag_sha, peeled_sha) in tags.items():
+        if peeled_sha is not None:
+            # annotated tag with known target
+            if peeled_sha == sha:
+                annotated.append(tag)
+            continue
+        if tag_sha == sha:
+            lightweight.append(tag)
+            continue
+        obj = _git_object_header(gitdir, tag_sha)
+        if obj is None:
+            # the object is packed, we cannot tell if this is an annotated tag
+            return None
+        otype, content = obj
+        if otype == "tag" and content.startswith(f"object {sha}"):
+            annotated.append(tag)
+    # `git describe` prefers annotated tags over lightweight ones
+    candidates = annotated or lightweight
+    return sorted(candidates)[0] if candidates else "ND"
+
+
+def _git_config(gitdir):
+    """
+    Returns a flat dictionary {section.subsection.key: value} with the content
+    of the repository's `.git/config` file. Only the first value of a key is kept.
+    """
+    config = {}
+    content = _git_read(gitdir, "config")
+    if not content:
+        return config
+    section = None
+    section_pattern = re.compile(r'^\[\s*([^\s\]"]+)(?:\s+"(.*)")?\s*\]')
+    key_pattern = re.compile(r"^([A-Za-z][\w-]*)\s*=\s*(.*)$")
+    for line in content.splitlines():
+        line = line.strip()
+        if not line or line[0] in "#;":
+            continue
+        match = section_pattern.match(line)
+        if match:
+            section = match.group(1).lower()
+            if match.group(2) is not None:
+                section = f"{section}.{match.group(2)}"
+            continue
+        match = key_pattern.match(line)
+        if match and section is not None:
+            key = f"{section}.{match.group(1).lower()}"
+            value = match.group(2).strip()
+            if len(value) >= 2 and value[0] == value[-1] == '"':
+                value = value[1:-1]
+            config.setdefault(key, value)
+    return config
+
+
 def _parse_configurations(config_file: str) -> dict:
     with open(config_file, "rt") as fin:
         configurations_content = yaml.load(fin, Loader=yaml.SafeLoader)
@@ -425,8 +610,4 @@ def _parse_configurations(config_file: str) -> dict:
 
 
 def _docker_client(endpoint):
-    return (
-        endpoint
-        if isinstance(endpoint, docker.DockerClient)
-        else docker.DockerClient(base_url=sanitize_docker_baseurl(endpoint))
-    )
+    return get_client(endpoint)
@@ -1,3 +1,7 @@
+import os
+import importlib.util
+
+
 def human_time(time_secs, compact=False):
     label = lambda s: s[0] if compact else " " + s
     days = int(time_secs // 86400)
@@ -21,3 +25,25 @@ def human_size(value, suffix="B", precision=2):
             return f"%3.{precision}f %s%s" % (value, unit, suffix)
         value /= 1024.0
     return f"%.{precision}f%s%s".format(value, "Yi", suffix)
+
+
+def import_or_install(package, name):
+    """
+    Installs the given (pip) package if the module `name` cannot be found.
+    """
+    # look for the module without importing it, pip is only needed when it is missing
+    if importlib.util.find_spec(name) is None:
+        import pip
+        pip.main(['install', package])
+
+
+def get_cache_dir(*subdirs):
+    """
+    Returns the path to a (sub)directory of the local cache of the Duckietown Shell commands,
+    the directory is created if it does not exist.
+    """
+    cache_dir = os.path.join(
+        os.environ.get("DTSHELL_CACHE_DIR", os.path.expanduser("~/.dt-shell/cache")), *subdirs
+    )
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
@@ -1,21 +1,139 @@
 import os
-import re
+import json
+import time
+import socket
+import threading
+from typing import Optional
 
+from dt_shell import dtslogger
 
-def get_ip_from_ping(alias):
-    response = os.popen("ping -c 1 %s" % alias).read()
-    m = re.search("PING.*?\((.*?)\)+", response)
-    if m:
-        return m.group(1)
-    else:
-        raise Exception("Unable to locate %s!" % alias)
+from utils.misc_utils import get_cache_dir
+
+# resolved addresses are trusted for this long (in seconds)
+RESOLVER_CACHE_TTL = 300
+RESOLVER_CACHE_FILE = "resolver.json"
+# how long to wait for an answer to a mDNS query (in seconds)
+MDNS_TIMEOUT = 1.0
+DUCKIETOWN_SERVICE_TYPE = "_duckietown._tcp.local."
+DUCKIETOWN_PRESENCE_SERVICE = "DT::PRESENCE::{hostname}." + DUCKIETOWN_SERVICE_TYPE
+
+# in-memory cache {hostname: (ip, expiration)}
+_resolved = {}
+_resolved_lock = threading.Lock()
 
 
 def get_duckiebot_ip(duckiebot_name):
+    """
+    Resolves the hostname of a Duckiebot to its IP address. Results are cached in memory
+    and on disk for RESOLVER_CACHE_TTL seconds, or until the Duckiebot's services disappear
+    from the network (see `forget_duckiebot_ip`).
+
+    The Duckiebot is resolved through its `_duckietown._tcp` mDNS service first, falling
+    back to the system resolver for `<name>.local` and `<name>`.
+    """
+    hostname = duckiebot_name[: -len(".local")] if duckiebot_name.endswith(".local") else duckiebot_name
+    # IP addresses do not need to be resolved
+    if _is_ip(hostname):
+        return hostname
+    # check the in-memory cache
+    with _resolved_lock:
+        ip, expiration = _resolved.get(hostname, (None, 0))
+    if ip is not None and time.time() < expiration:
+        return ip
+    # check the disk cache
+    entry = _load_cache().get(hostname)
+    if entry is not None and time.time() < entry["expiration"]:
+        with _resolved_lock:
+            _resolved[hostname] = (entry["ip"], entry["expiration"])
+        return entry["ip"]
+    # resolve
+    ip = _resolve_mdns(hostname) or _resolve_system(f"{hostname}.local") or _resolve_system(hostname)
+    if ip is None:
+        raise Exception("Unable to locate %s!" % duckiebot_name)
+    dtslogger.debug(f"Resolved {hostname} -> {ip}")
+    expiration = time.time() + RESOLVER_CACHE_TTL
+    with _resolved_lock:
+        _resolved[hostname] = (ip, expiration)
+    cache = _load_cache()
+    cache[hostname] = {"ip": ip, "expiration": expiration}
+    _dump_cache(cache)
+    return ip
+
+
+def forget_duckiebot_ip(hostname):
+    """
+    Removes a Duckiebot from the resolver cache, e.g., when its services disappear.
+    """
+    with _resolved_lock:
+        _resolved.pop(hostname, None)
+    cache = _load_cache()
+    if cache.pop(hostname, None) is not None:
+        dtslogger.debug(f"Forgetting the address of {hostname}")
+        _dump_cache(cache)
+
+
+def _is_ip(address):
+    try:
+        socket.inet_aton(address)
+        return address.count(".") == 3
+    except OSError:
+        return False
+
+
+def _resolve_mdns(hostname) -> Optional[str]:
+    try:
+        from zeroconf import Zeroconf
+    except ImportError:
+        return None
+    zeroconf = None
     try:
-        duckiebot_ip = get_ip_from_ping("%s.local" % duckiebot_name)
+        zeroconf = Zeroconf()
+        info = zeroconf.get_service_info(
+            DUCKIETOWN_SERVICE_TYPE,
+            DUCKIETOWN_PRESENCE_SERVICE.format(hostname=hostname),
+            timeout=int(MDNS_TIMEOUT * 1000),
+        )
+        if info is None:
+            return None
+        addresses = getattr(info, "addresses", None) or [info.address]
+        return socket.inet_ntoa(addresses[0]) if addresses and addresses[0] else None
     except Exception as e:
-        print(e)
-        duckiebot_ip = get_ip_from_ping(duckiebot_name)
+        dtslogger.debug(f"Could not resolve {hostname} via mDNS: {str(e)}")
+        return None
+    finally:
+        if zeroconf is not None:
+            zeroconf.close()
 
-    return duckiebot_ip
+
+def _resolve_system(name) -> Optional[str]:
+    try:
+        return socket.getaddrinfo(name, None, socket.AF_INET, socket.SOCK_STREAM)[0][4][0]
+    except (socket.gaierror, OSError, IndexError):
+        return None
+
+
+def _cache_file():
+    return os.path.join(get_cache_dir("networking"), RESOLVER_CACHE_FILE)
+
+
+def _load_cache() -> dict:
+    try:
+        with open(_cache_file(), "rt") as fin:
+            return json.load(fin)
+    except (OSError, ValueError):
+        # missing or corrupted cache files are simply ignored (and later overwritten)
+        return {}
+
+
+def _dump_cache(cache: dict):
+    fpath = _cache_file()
+    now = time.time()
+    cache = {hostname: entry for hostname, entry in cache.items() if entry["expiration"] > now}
+    try:
+        # write to a temporary file first, the rename is atomic
+        tmp = f"{fpath}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wt") as fout:
+            json.dump(cache, fout)
+        os.replace(tmp, fpath)
+    except OSError as e:
+        dtslogger.debug(f"Cannot write cache file {fpath}: {str(e)}")
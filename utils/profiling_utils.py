@@ -0,0 +1,308 @@
+import os
+import re
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+from typing import List, Optional
+
+# NOTE: this module does not depend on `dt_shell`, it can be run without the Duckietown Shell
+#       (e.g., in CI) with:
+#
+#           python3 -m utils.profiling_utils [options]
+
+COMMANDS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COMMAND_FILE = "command.py"
+# time allowed to load the tree of commands (i.e., the startup of `dts`)
+DEFAULT_STARTUP_BUDGET_MS = 300
+# time allowed to load a single command (this is paid only when the command runs)
+DEFAULT_COMMAND_BUDGET_MS = 2000
+# relative growth allowed with respect to a baseline report, and a floor for the noise
+DEFAULT_TOLERANCE = 0.2
+NOISE_MS = 5
+DEFAULT_REPEAT = 3
+IMPORT_TIMEOUT = 120
+TOP_MODULES = 5
+
+IMPORTTIME_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)\s*$")
+
+# a minimal `dt_shell`, commands are loaded against it so that the profiler works offline,
+# without the shell installed, and measures the commands only
+STUB_SHELL_VERSION = "6.0.0"
+STUB_SHELL_GETATTR = '''
+def __getattr__(name):
+    # anything else is a class that does nothing (it can also be raised, caught and extended)
+    if name.startswith("__"):
+        raise AttributeError(name)
+    return type(name, (Exception,), {"__init__": lambda self, *args, **kwargs: None})
+'''
+STUB_SHELL = {
+    "__init__.py": f'''
+import logging
+
+__version__ = "{STUB_SHELL_VERSION}"
+dtslogger = logging.getLogger("dts")
+
+
+class UserError(Exception):
+    pass
+
+
+class DTShell:
+    pass
+
+
+class DTCommandAbs:
+    name = None
+    level = None
+    help = None
+    commands = None
+    fake = False
+
+    @staticmethod
+    def command(shell, args, **kwargs):
+        pass
+
+    @staticmethod
+    def complete(shell, word, line):
+        return []
+
+
+class DTCommandPlaceholder(DTCommandAbs):
+    fake = True
+
+
+class OtherVersions:
+    name2versions = {{}}
+''' + STUB_SHELL_GETATTR,
+    "commands_.py": STUB_SHELL_GETATTR,
+    "duckietown_tokens.py": STUB_SHELL_GETATTR,
+    "env_checks.py": STUB_SHELL_GETATTR,
+    "tokens_cli.py": STUB_SHELL_GETATTR,
+    "utils.py": STUB_SHELL_GETATTR,
+}
+
+
+def write_shell_stub(path: str):
+    """
+    Writes the stub of `dt_shell` as a package in the directory `path`.
+    """
+    package_dir = os.path.join(path, "dt_shell")
+    os.makedirs(package_dir, exist_ok=True)
+    for fname, content in STUB_SHELL.items():
+        with open(os.path.join(package_dir, fname), "wt") as fout:
+            fout.write(content.lstrip())
+
+
+def find_commands(commands_dir: str = COMMANDS_DIR) -> List[str]:
+    """
+    Returns the (dotted) selectors of all the commands, e.g., `devel.build`, without importing them.
+    """
+    selectors = []
+    for root, dirs, files in os.walk(commands_dir):
+        dirs[:] = sorted(
+            d for d in dirs if os.path.isfile(os.path.join(root, d, "__init__.py"))
+            and not (root == commands_dir and d in ["lib", "utils"])
+        )
+        if root != commands_dir and COMMAND_FILE in files:
+            selectors.append(os.path.relpath(root, commands_dir).replace(os.sep, "."))
+    return selectors
+
+
+def parse_importtime(output: str, after: str = "dt_shell") -> dict:
+    """
+    Parses the output of `python -X importtime`, considering only what is imported after the
+    (top-level) module `after`. Returns the total time and {module: cumulative} (all in ms).
+    """
+    modules, total, started = {}, 0, False
+    for line in output.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if not match:
+            continue
+        _, cumulative, indent, module = match.groups()
+        top_level = len(indent) == 0
+        if not started:
+            started = top_level and module == after
+            continue
+        modules[module] = int(cumulative) / 1000.0
+        if top_level:
+            total += int(cumulative) / 1000.0
+    return {"time_ms": round(total, 2), "modules": modules}
+
+
+def profile_imports(statements: List[str], commands_dir: str, stub_dir: str, repeat: int = DEFAULT_REPEAT) -> dict:
+    """
+    Runs the given statements in a fresh interpreter with `-X importtime` (`repeat` times,
+    the fastest run is kept). Returns the time (in ms) spent importing modules, the cumulative
+    import time of each module, and the error raised (if any).
+    """
+    code = "\n".join(["import dt_shell"] + statements)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([stub_dir, commands_dir]), PYTHONDONTWRITEBYTECODE="1")
+    # stay offline, even if a command tries to install its dependencies
+    env["PIP_NO_INDEX"] = "1"
+    env.pop("PYTHONIMPORTTIME", None)
+    best = None
+    for _ in range(max(1, repeat)):
+        try:
+            proc = subprocess.run(
+                [sys.executable, "-X", "importtime", "-c", code],
+                cwd=commands_dir, env=env, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE, timeout=IMPORT_TIMEOUT,
+            )
+        except subprocess.TimeoutExpired:
+            return {"time_ms": None, "modules": {}, "error": f"Timed out after {IMPORT_TIMEOUT} seconds"}
+        stderr = proc.stderr.decode("utf-8", errors="replace")
+        if proc.returncode != 0:
+            errors = [line for line in stderr.splitlines() if not IMPORTTIME_LINE.match(line)]
+            return {"time_ms": None, "modules": {}, "error": errors[-1] if errors else "Unknown error"}
+        result = parse_importtime(stderr)
+        if best is None or result["time_ms"] < best["time_ms"]:
+            best = result
+    best["error"] = None
+    return best
+
+
+def profile_startup(commands: List[str], commands_dir: str, stub_dir: str, repeat: int = DEFAULT_REPEAT) -> dict:
+    """
+    Measures the time needed to load the tree of commands, i.e., to import all the packages and
+    get their DTCommand classes, like the shell does when it starts.
+    """
+    packages = sorted(set(".".join(c.split(".")[: i + 1]) for c in commands for i in range(c.count(".") + 1)))
+    statements = ["import importlib"] + [
+        f"getattr(importlib.import_module({package!r}), 'DTCommand', None)" for package in packages
+    ]
+    return profile_imports(statements, commands_dir, stub_dir, repeat)
+
+
+def profile_command(command: str, commands_dir: str, stub_dir: str, repeat: int = DEFAULT_REPEAT) -> dict:
+    """
+    Measures the time needed to load a command, in isolation.
+    """
+    statements = ["import importlib", f"importlib.import_module({command + '.command'!r})"]
+    return profile_imports(statements, commands_dir, stub_dir, repeat)
+
+
+def check_budget(report: dict, baseline: Optional[dict] = None, tolerance: float = DEFAULT_TOLERANCE) -> List[str]:
+    """
+    Returns the list of violations found in the report: startup or commands exceeding their
+    budgets, or growing more than `tolerance` with respect to the baseline report (if given).
+    """
+    violations = []
+    entries = [("startup", report["startup"], report["budget"]["startup_ms"])] + [
+        (command, result, report["budget"]["command_ms"]) for command, result in report["commands"].items()
+    ]
+    for name, result, budget in entries:
+        if result["time_ms"] is None:
+            continue
+        if result["time_ms"] > budget:
+            violations.append(f"{name}: {result['time_ms']:.1f}ms exceeds the budget of {budget:.1f}ms")
+        if baseline is None:
+            continue
+        previous = baseline["startup"] if name == "startup" else baseline["commands"].get(name)
+        if previous is None or previous["time_ms"] is None:
+            continue
+        limit = previous["time_ms"] * (1.0 + tolerance) + NOISE_MS
+        if result["time_ms"] > limit:
+            violations.append(
+                f"{name}: {result['time_ms']:.1f}ms, it was {previous['time_ms']:.1f}ms in the baseline"
+            )
+    return violations
+
+
+def format_report(report: dict, top: int = TOP_MODULES) -> str:
+    lines = [f"Startup (loading all the commands): {report['startup']['time_ms']}ms", ""]
+    commands = sorted(
+        report["commands"].items(), key=lambda c: -1 if c[1]["time_ms"] is None else c[1]["time_ms"], reverse=True
+    )
+    width = max([len(command) for command, _ in commands] + [len("Command")])
+    lines.append(f"{'Command':<{width}} | {'Import (ms)':>11} | Heaviest modules (cumulative ms)")
+    lines.append(f"{'-' * width} | {'-' * 11} | {'-' * 32}")
+    for command, result in commands:
+        if result["time_ms"] is None:
+            lines.append(f"{command:<{width}} | {'ERROR':>11} | {result['error']}")
+            continue
+        # third-party modules are grouped by package, those of this repository are shown as they are
+        own = command.split(".")[0]
+        heaviest = {}
+        for module, t in result["modules"].items():
+            root = module.split(".")[0]
+            if root == own:
+                # the packages of the command itself include everything else
+                continue
+            name = module if os.path.isdir(os.path.join(COMMANDS_DIR, root)) else root
+            heaviest[name] = max(heaviest.get(name, 0), t)
+        heaviest = sorted(heaviest.items(), key=lambda m: m[1], reverse=True)[:top]
+        heaviest = ", ".join(f"{m} ({t:.0f})" for m, t in heaviest)
+        lines.append(f"{command:<{width}} | {result['time_ms']:>11.1f} | {heaviest}")
+    return "\n".join(lines)
+
+
+def main(args: List[str], prog: Optional[str] = None) -> int:
+    """
+    Profiles the import time of the commands and checks it against the budget.
+    Returns the exit code (0 if everything is within budget).
+    """
+    parser = argparse.ArgumentParser(prog=prog)
+    parser.add_argument(
+        "-c", "--command", dest="commands", action="append", default=None,
+        help="Profile only the given command (e.g., devel.build); can be repeated",
+    )
+    parser.add_argument(
+        "--budget", default=DEFAULT_STARTUP_BUDGET_MS, type=float,
+        help="Time (ms) allowed to load all the commands when the shell starts",
+    )
+    parser.add_argument(
+        "--command-budget", default=DEFAULT_COMMAND_BUDGET_MS, type=float,
+        help="Time (ms) allowed to load a single command",
+    )
+    parser.add_argument("--baseline", default=None, help="Report (JSON) to compare against")
+    parser.add_argument(
+        "--tolerance", default=DEFAULT_TOLERANCE, type=float,
+        help="Relative growth allowed with respect to the baseline",
+    )
+    parser.add_argument("--repeat", default=DEFAULT_REPEAT, type=int, help="Runs per measurement")
+    parser.add_argument("-o", "--output", default=None, help="Write the report (JSON) to this file")
+    parser.add_argument(
+        "--strict", default=False, action="store_true", help="Commands that cannot be loaded are failures"
+    )
+    parsed = parser.parse_args(args)
+    # find commands
+    commands = parsed.commands or find_commands(COMMANDS_DIR)
+    baseline = None
+    if parsed.baseline:
+        with open(parsed.baseline, "rt") as fin:
+            baseline = json.load(fin)
+    # profile
+    with tempfile.TemporaryDirectory(prefix="dts-profile-") as stub_dir:
+        write_shell_stub(stub_dir)
+        report = {
+            "python": sys.version.split(" ")[0],
+            "budget": {"startup_ms": parsed.budget, "command_ms": parsed.command_budget},
+            "startup": profile_startup(find_commands(COMMANDS_DIR), COMMANDS_DIR, stub_dir, parsed.repeat),
+            "commands": {},
+        }
+        for command in commands:
+            print(f"Profiling {command}...", file=sys.stderr)
+            report["commands"][command] = profile_command(command, COMMANDS_DIR, stub_dir, parsed.repeat)
+    # report
+    print(format_report(report))
+    if parsed.output:
+        with open(parsed.output, "wt") as fout:
+            json.dump(report, fout, indent=4, sort_keys=True)
+    # check
+    violations = check_budget(report, baseline, parsed.tolerance)
+    if report["startup"]["error"]:
+        violations.append(f"startup: {report['startup']['error']}")
+    if parsed.strict:
+        violations += [f"{c}: {r['error']}" for c, r in report["commands"].items() if r["error"]]
+    print("")
+    for violation in violations:
+        print(f"FAILED: {violation}")
+    if not violations:
+        print("All the commands are within budget.")
+    return 1 if violations else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:], prog="python3 -m utils.profiling_utils"))
@@ -0,0 +1,211 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Optional
+
+from dt_shell import dtslogger
+
+from utils.cli_utils import ProgressBar
+from utils.misc_utils import human_size, human_time
+
+DEFAULT_PULL_WORKERS = 4
+
+# statuses reported by the Docker engine for a layer that is fully available
+LAYER_DONE_STATUSES = ["Already exists", "Download complete", "Pull complete"]
+# statuses reported by the Docker engine for layers (others, e.g., "Pulling from ...", carry the tag as id)
+LAYER_STATUSES = [
+    "Pulling fs layer",
+    "Waiting",
+    "Downloading",
+    "Verifying Checksum",
+    "Extracting",
+] + LAYER_DONE_STATUSES
+
+
+class LayerProgress:
+    def __init__(self, layer_id: str):
+        self.id = layer_id
+        self.current = 0
+        self.total = 0
+        self.done = False
+
+    def update(self, status: str, detail: dict):
+        if status == "Downloading":
+            self.total = detail.get("total", self.total) or self.total
+            self.current = detail.get("current", self.current) or self.current
+        elif status in LAYER_DONE_STATUSES:
+            self.current = self.total
+            self.done = True
+
+
+class ImagePuller:
+    """
+    Pulls multiple images concurrently on the same Docker endpoint and keeps track of
+    the progress at the byte level. Layers shared between images are accounted for once,
+    the Docker engine makes sure they are also downloaded only once.
+
+    Args:
+        client:     a docker.DockerClient
+        workers:    maximum number of images pulled at the same time
+        callback:   function called as `callback(puller, image)` every time the
+                    progress of an image changes
+    """
+
+    def __init__(self, client, workers: int = DEFAULT_PULL_WORKERS, callback: Callable = None):
+        self._client = client
+        self._workers = max(1, workers)
+        self._callback = callback
+        self._lock = threading.Lock()
+        self._layers: Dict[str, LayerProgress] = {}
+        self._image_layers: Dict[str, set] = {}
+        self._completed: Dict[str, bool] = {}
+        self._stime = None
+
+    @property
+    def images(self):
+        return list(self._image_layers.keys())
+
+    def pull(self, images: Iterable[str]) -> Dict[str, Optional[BaseException]]:
+        """
+        Pulls the given images and returns a dictionary {image: error}, where error is
+        None for images pulled successfully.
+        """
+        images = list(dict.fromkeys(images))
+        for image in images:
+            self._image_layers[image] = set()
+            self._completed[image] = False
+        self._stime = time.time()
+        with ThreadPoolExecutor(max_workers=self._workers) as executor:
+            futures = {image: executor.submit(self._pull, image) for image in images}
+        return {image: future.exception() for image, future in futures.items()}
+
+    def _pull(self, image: str):
+        repository, tag = _split_image(image)
+        for step in self._client.api.pull(repository, tag, stream=True, decode=True):
+            if "error" in step:
+                raise RuntimeError(step["error"])
+            if "status" not in step or "id" not in step:
+                continue
+            if step["status"] not in LAYER_STATUSES and not step.get("progressDetail"):
+                continue
+            with self._lock:
+                layer_id = step["id"]
+                if layer_id not in self._layers:
+                    self._layers[layer_id] = LayerProgress(layer_id)
+                self._layers[layer_id].update(step["status"], step.get("progressDetail") or {})
+                self._image_layers[image].add(layer_id)
+            self._notify(image)
+        with self._lock:
+            for layer_id in self._image_layers[image]:
+                self._layers[layer_id].done = True
+                self._layers[layer_id].current = self._layers[layer_id].total
+            self._completed[image] = True
+        self._notify(image)
+
+    def _notify(self, image: str):
+        if self._callback is not None:
+            self._callback(self, image)
+
+    def _bytes(self, layers) -> (int, int):
+        current = sum(self._layers[lid].current for lid in layers)
+        total = sum(self._layers[lid].total for lid in layers)
+        return current, total
+
+    def _percentage(self, layers, completed) -> float:
+        if completed:
+            return 100.0
+        # 100% is reserved for completed pulls (layers might still be extracting)
+        return min(99.0, self._percentage_bytes(layers))
+
+    def _percentage_bytes(self, layers) -> float:
+        if not layers:
+            return 0.0
+        current, total = self._bytes(layers)
+        # layers with unknown size (e.g., waiting) count as one unit each
+        unknown = [lid for lid in layers if self._layers[lid].total == 0]
+        if total == 0:
+            return 100.0 * len([lid for lid in unknown if self._layers[lid].done]) / len(unknown)
+        # weigh unknown layers as the average of the known ones
+        known = len(layers) - len(unknown)
+        avg = total / known
+        current += avg * len([lid for lid in unknown if self._layers[lid].done])
+        total += avg * len(unknown)
+        return 100.0 * current / total
+
+    def image_percentage(self, image: str) -> float:
+        with self._lock:
+            return self._percentage(self._image_layers.get(image, set()), self._completed.get(image))
+
+    def percentage(self) -> float:
+        with self._lock:
+            return self._percentage(set(self._layers.keys()), all(self._completed.values()))
+
+    def downloaded(self) -> (int, int):
+        """
+        Returns the pair (current, total) of bytes downloaded across all the images.
+        """
+        with self._lock:
+            return self._bytes(self._layers.keys())
+
+    def throughput(self) -> float:
+        if self._stime is None:
+            return 0.0
+        current, _ = self.downloaded()
+        return current / max(0.001, time.time() - self._stime)
+
+    def eta(self) -> Optional[float]:
+        current, total = self.downloaded()
+        throughput = self.throughput()
+        if throughput <= 0 or total <= 0:
+            return None
+        return max(0.0, total - current) / throughput
+
+    def status(self) -> str:
+        current, total = self.downloaded()
+        eta = self.eta()
+        eta = human_time(eta, compact=True) if eta is not None else "ND"
+        return (
+            f"{human_size(current, precision=1)}/{human_size(total, precision=1)} "
+            f"@ {human_size(self.throughput(), precision=1)}/s, ETA {eta}"
+        )
+
+
+def pull_images(client, images, workers=DEFAULT_PULL_WORKERS, progress=True, callback=None):
+    """
+    Pulls the given images concurrently and shows an aggregated progress bar.
+    Raises the first error encountered, if any, once all the pulls are done.
+    """
+    pbar = ProgressBar() if progress else None
+    pbar_lock = threading.Lock()
+
+    def _callback(puller, image):
+        if pbar is not None:
+            with pbar_lock:
+                pbar.set_header(puller.status())
+                pbar.update(puller.percentage())
+        if callback is not None:
+            callback(puller, image)
+
+    puller = ImagePuller(client, workers=workers, callback=_callback)
+    errors = puller.pull(images)
+    if pbar is not None:
+        pbar.done()
+    for image, error in errors.items():
+        if error is not None:
+            dtslogger.error(f"An error occurred while pulling the image {image}: {str(error)}")
+    for error in errors.values():
+        if error is not None:
+            raise error
+    return puller
+
+
+def _split_image(image: str) -> (str, str):
+    # images pinned to a digest (repository@sha256:...) are pulled by digest (the API takes it as tag)
+    if "@" in image:
+        repository, _, digest = image.partition("@")
+        return repository, digest
+    # the tag is what follows the last ':' as long as it is not part of a registry address
+    repository, sep, tag = image.rpartition(":")
+    if not sep or "/" in tag:
+        return image, "latest"
+    return repository, tag
@@ -0,0 +1,133 @@
+import os
+import json
+import time
+import threading
+from typing import Optional
+
+import requests
+
+from dt_shell import dtslogger
+
+from utils.misc_utils import get_cache_dir
+
+DOCKER_HUB_API_URL = {
+    "token": "https://auth.docker.io/token?scope=repository:{image}:pull&service=registry.docker.io",
+    "digest": "https://registry-1.docker.io/v2/{image}/manifests/{tag}",
+    "inspect": "https://registry-1.docker.io/v2/{image}/blobs/{digest}",
+}
+
+MANIFEST_V2_MEDIA_TYPE = "application/vnd.docker.distribution.manifest.v2+json"
+
+# tokens are renewed this many seconds before they expire
+TOKEN_EXPIRATION_MARGIN = 10
+DEFAULT_TOKEN_LIFETIME = 60
+
+
+class RegistryClient:
+    """
+    Client for the Docker Hub registry API.
+
+    All the requests go through the same HTTP session (persistent connections),
+    pull tokens are reused until they expire, manifests are revalidated using conditional
+    requests and config blobs are cached on disk by digest (they are content-addressed,
+    so they never go stale).
+    """
+
+    def __init__(self, cache_dir: str = None):
+        self._session = requests.Session()
+        self._cache_dir = cache_dir or get_cache_dir("registry")
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def token(self, image: str) -> str:
+        scope = f"repository:{image}:pull"
+        with self._lock:
+            token, expiration = self._tokens.get(scope, (None, 0))
+            if token is not None and time.time() < expiration:
+                return token
+        res = self._session.get(DOCKER_HUB_API_URL["token"].format(image=image))
+        res.raise_for_status()
+        res = res.json()
+        token = res["token"]
+        lifetime = int(res.get("expires_in", DEFAULT_TOKEN_LIFETIME))
+        with self._lock:
+            self._tokens[scope] = (token, time.time() + lifetime - TOKEN_EXPIRATION_MARGIN)
+        return token
+
+    def manifest(self, image: str, tag: str) -> dict:
+        cache_file = self._cache_file("manifests", *image.split("/"), f"{tag}.json")
+        cached = _load_json(cache_file)
+        headers = {
+            "Accept": MANIFEST_V2_MEDIA_TYPE,
+            "Authorization": "Bearer {0}".format(self.token(image)),
+        }
+        if cached is not None and cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        res = self._session.get(DOCKER_HUB_API_URL["digest"].format(image=image, tag=tag), headers=headers)
+        if res.status_code == 304 and cached is not None:
+            dtslogger.debug(f"Manifest for {image}:{tag} not modified, using cache.")
+            return cached["manifest"]
+        res.raise_for_status()
+        manifest = res.json()
+        etag = res.headers.get("ETag", res.headers.get("Docker-Content-Digest"))
+        _dump_json(cache_file, {"etag": etag, "manifest": manifest})
+        return manifest
+
+    def blob(self, image: str, digest: str) -> dict:
+        cache_file = self._cache_file("blobs", *digest.split(":"))
+        blob = _load_json(cache_file)
+        if blob is not None:
+            return blob
+        res = self._session.get(
+            DOCKER_HUB_API_URL["inspect"].format(image=image, digest=digest),
+            headers={"Authorization": "Bearer {0}".format(self.token(image))},
+        )
+        res.raise_for_status()
+        blob = res.json()
+        _dump_json(cache_file, blob)
+        return blob
+
+    def inspect(self, image: str, tag: str) -> dict:
+        """
+        Returns the configuration blob of the image `image:tag`.
+        """
+        digest = self.manifest(image, tag)["config"]["digest"]
+        return self.blob(image, digest)
+
+    def _cache_file(self, *path) -> str:
+        return os.path.join(self._cache_dir, *path)
+
+
+_registry_client: Optional[RegistryClient] = None
+_registry_client_lock = threading.Lock()
+
+
+def get_registry_client() -> RegistryClient:
+    global _registry_client
+    with _registry_client_lock:
+        if _registry_client is None:
+            _registry_client = RegistryClient()
+        return _registry_client
+
+
+def _load_json(fpath: str) -> Optional[dict]:
+    if not os.path.isfile(fpath):
+        return None
+    try:
+        with open(fpath, "rt") as fin:
+            return json.load(fin)
+    except (OSError, ValueError):
+        # corrupted cache entries are simply ignored (and later overwritten)
+        return None
+
+
+def _dump_json(fpath: str, data: dict):
+    try:
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        # write to a temporary file first, the rename is atomic
+        tmp = f"{fpath}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wt") as fout:
+            json.dump(data, fout)
+        os.replace(tmp, fpath)
+    except OSError as e:
+        dtslogger.debug(f"Cannot write cache file {fpath}: {str(e)}")
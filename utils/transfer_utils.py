@@ -0,0 +1,511 @@
+import io
+import os
+import json
+import time
+import hashlib
+import tarfile
+import tempfile
+import threading
+import subprocess
+import collections
+from shutil import which
+from typing import Dict, List, Optional
+
+import requests
+from docker.errors import APIError
+
+from dt_shell import dtslogger
+
+from utils.cli_utils import ProgressBar
+from utils.docker_utils import get_client
+from utils.misc_utils import human_size
+
+DEFAULT_TRANSFER_RETRIES = 5
+# layers are committed at the destination in batches of (at least) this many bytes
+DEFAULT_CHECKPOINT_SIZE = 64 * 1024 ** 2
+# the image is read ahead of what is sent by at most this many batches (stored on disk)
+SPOOL_AHEAD_BATCHES = 2
+# gzip-compatible codecs, in order of preference (parallel first)
+COMPRESSION_CODECS = [["pigz", "-1", "-c"], ["gzip", "-1", "-c"]]
+CHUNK_SIZE = 1024 ** 2
+
+
+class TransferError(Exception):
+    pass
+
+
+def transfer_image(
+    origin,
+    destination,
+    image: str,
+    progress: bool = True,
+    retries: int = DEFAULT_TRANSFER_RETRIES,
+    compress: Optional[bool] = None,
+    checkpoint_size: int = DEFAULT_CHECKPOINT_SIZE,
+):
+    """
+    Transfers an image between two Docker endpoints through the Docker API.
+
+    The image is read from the origin (i.e., `docker save`) while it is loaded at the
+    destination. Layers are sent in order and committed at the destination in batches
+    (as untagged checkpoint images), so that a dropped connection only causes the current
+    batch to be sent again. Layers that are already present at the destination are never
+    sent. Data sent to remote endpoints is compressed on the fly (pigz, if available).
+    Layers are stored on disk until they are sent, the image is read ahead of what is sent
+    by about SPOOL_AHEAD_BATCHES batches.
+
+    Args:
+        origin:             endpoint (or docker.DockerClient) the image is read from
+        destination:        endpoint (or docker.DockerClient) the image is loaded into
+        image:              name of the image to transfer
+        progress:           whether to show a progress bar
+        retries:            number of times a failed batch is retried
+        compress:           whether to compress the data, defaults to True for TCP endpoints
+        checkpoint_size:    minimum size (in bytes) of a batch of layers
+    """
+    origin = get_client(origin)
+    destination = get_client(destination)
+    if compress is None:
+        compress = not destination.api.base_url.startswith("http+")
+    # get the list of layers (diff IDs) of the image
+    info = origin.api.inspect_image(image)
+    diff_ids = info["RootFS"]["Layers"]
+    chains = _chain_ids(diff_ids)
+    monitor = _TransferMonitor(info["Size"], progress)
+    with tempfile.TemporaryDirectory(prefix="dts-transfer-") as workdir:
+        available = _retry(lambda: _available_chain_ids(destination), retries)
+        # a diff ID can appear more than once (e.g., empty layers), count the positions needing it
+        needed = collections.Counter(
+            diff_id for diff_id, chain in zip(diff_ids, chains) if chain not in available
+        )
+        # read the image from the origin in background, layers already at the destination are skipped
+        spool = _ImageSpool(
+            origin, image, set(diff_ids), needed, workdir, max_stored=SPOOL_AHEAD_BATCHES * checkpoint_size
+        )
+        spool.start()
+        checkpoints = []
+        try:
+            # send the layers in order, one batch at a time
+            batch, batch_size = [], 0
+            for i, (diff_id, chain) in enumerate(zip(diff_ids, chains)):
+                if chain in available:
+                    monitor.skipped(diff_id)
+                    continue
+                path = spool.wait_layer(diff_id)
+                if path is None:
+                    # the layer could not be identified in the image archive, send everything
+                    dtslogger.debug(f"Layer {diff_id} not found in the archive, disabling checkpoints.")
+                    break
+                batch.append(diff_id)
+                if batch.count(diff_id) == 1:
+                    batch_size += os.path.getsize(path)
+                if batch_size >= checkpoint_size or i == len(diff_ids) - 1:
+                    prefix = diff_ids[: i + 1]
+                    checkpoints.append(
+                        _retry(
+                            lambda: _load_checkpoint(destination, spool, info, prefix, batch, compress, monitor),
+                            retries,
+                        )
+                    )
+                    available.update(chains[: i + 1])
+                    # the layers are at the destination now, no need to keep them on disk (unless
+                    # they appear again later in the image)
+                    spool.release(batch)
+                    batch, batch_size = [], 0
+            # send the image itself (metadata and whatever layer is still missing)
+            spool.wait_done()
+            _retry(
+                lambda: _load_image(destination, spool, diff_ids, chains, compress, monitor), retries
+            )
+        finally:
+            spool.stop()
+        # checkpoint images are no longer needed, their layers belong to the image now.
+        # NOTE: if the transfer fails they are kept, so that the next attempt can resume from them
+        for checkpoint in checkpoints:
+            try:
+                destination.api.remove_image(checkpoint)
+            except APIError:
+                pass
+        monitor.done()
+
+
+class _TransferMonitor:
+    def __init__(self, total: int, progress: bool):
+        self._total = max(1, total)
+        self._done = 0
+        self._skipped = 0
+        self._sent = 0
+        self._lock = threading.Lock()
+        self._pbar = ProgressBar() if progress else None
+
+    def skipped(self, diff_id: str):
+        with self._lock:
+            self._skipped += 1
+        self._update()
+
+    def sent(self, nbytes: int):
+        with self._lock:
+            self._sent += nbytes
+        self._update()
+
+    def _update(self):
+        if self._pbar is None:
+            return
+        with self._lock:
+            self._pbar.set_header(
+                f"Sent {human_size(self._sent, precision=1)}, {self._skipped} layer(s) skipped"
+            )
+            self._pbar.update(min(99, 100 * self._sent / self._total))
+
+    def done(self):
+        if self._pbar is not None:
+            self._pbar.done()
+        dtslogger.info(
+            f"Transfer complete: {human_size(self._sent)} sent, "
+            f"{self._skipped} layer(s) already present at the destination."
+        )
+
+
+class _ImageSpool(threading.Thread):
+    """
+    Reads an image archive from a Docker endpoint and stores its members on disk.
+    Layers are identified by the SHA256 digest of their (uncompressed) content, which
+    is their diff ID. Layers that are not needed (i.e., already at the destination) are
+    not stored; in OCI archives they are recognized by name (they are still read off the
+    stream, but not hashed). `needed` counts the positions of the image needing each layer,
+    a layer is removed from disk when all of them were sent (see `release`). Reading stops
+    while more than `max_stored` bytes of layers are stored, unless the consumer is waiting.
+    """
+
+    def __init__(self, client, image: str, diff_ids: set, needed: collections.Counter, workdir: str,
+                 max_stored: Optional[int] = None):
+        super(_ImageSpool, self).__init__(daemon=True)
+        self._client = client
+        self._image = image
+        self._diff_ids = diff_ids
+        self._needed = collections.Counter(needed)
+        self._workdir = workdir
+        self._max_stored = max_stored
+        self._members: List[tarfile.TarInfo] = []
+        self._paths: Dict[str, str] = {}
+        self._layers: Dict[str, str] = {}
+        # {member_name: diff_id} of the layers found in the archive
+        self._layer_names: Dict[str, str] = {}
+        # bytes of layers currently stored, and number of consumers waiting for the spool
+        self._stored = 0
+        self._waiting = 0
+        self._finished = False
+        self._stopped = False
+        self._error = None
+        self._cond = threading.Condition()
+
+    @property
+    def members(self):
+        """
+        Returns the members of the archive (read so far) and the path to their content, None
+        for members with no content and for layers that are not stored.
+        """
+        with self._cond:
+            return [(m, self._paths.get(m.name)) for m in self._members]
+
+    def layer_members(self) -> Dict[str, str]:
+        """
+        Returns a dictionary {member_name: diff_id} of the layers found in the archive.
+        """
+        with self._cond:
+            return dict(self._layer_names)
+
+    def run(self):
+        try:
+            stream = _IterReader(self._client.api.get_image(self._image, chunk_size=CHUNK_SIZE))
+            with tarfile.open(fileobj=stream, mode="r|") as tar:
+                for member in tar:
+                    if self._stopped:
+                        return
+                    path, digest = None, _blob_digest(member.name)
+                    if member.isfile():
+                        if digest in self._diff_ids and self._needed[digest] <= 0:
+                            # known layer, already at the destination
+                            pass
+                        else:
+                            self._wait_room()
+                            if self._stopped:
+                                return
+                            path = os.path.join(self._workdir, str(len(self._members)))
+                            digest = _spool_file(tar.extractfile(member), path)
+                            if digest in self._diff_ids and self._needed[digest] <= 0:
+                                os.remove(path)
+                                path = None
+                    with self._cond:
+                        self._members.append(member)
+                        if digest in self._diff_ids and member.isfile():
+                            self._layer_names[member.name] = digest
+                        if path is not None:
+                            self._paths[member.name] = path
+                            if digest in self._diff_ids and digest not in self._layers:
+                                self._layers[digest] = path
+                                self._stored += member.size
+                        self._cond.notify_all()
+        except BaseException as e:
+            self._error = e
+        finally:
+            with self._cond:
+                self._finished = True
+                self._cond.notify_all()
+
+    def _wait_room(self):
+        # backpressure, do not read too far ahead of the consumer (unless it is waiting for us)
+        if self._max_stored is None:
+            return
+        with self._cond:
+            self._cond.wait_for(lambda: self._stopped or self._waiting or self._stored < self._max_stored)
+
+    def release(self, diff_ids: List[str]):
+        """
+        Marks the given layers (one per position in the image) as sent. Layers that are not
+        needed by other positions are removed from disk, they will not be sent with the image.
+        """
+        with self._cond:
+            self._needed.subtract(diff_ids)
+            for name, diff_id in self._layer_names.items():
+                if diff_id in diff_ids and self._needed[diff_id] <= 0 and name in self._paths:
+                    path = self._paths.pop(name)
+                    if self._layers.get(diff_id) == path:
+                        del self._layers[diff_id]
+                        self._stored -= os.path.getsize(path)
+                    os.remove(path)
+            self._cond.notify_all()
+
+    def wait_layer(self, diff_id: str) -> Optional[str]:
+        with self._cond:
+            self._waiting += 1
+            self._cond.notify_all()
+            try:
+                self._cond.wait_for(lambda: diff_id in self._layers or self._finished)
+            finally:
+                self._waiting -= 1
+            self._raise()
+            return self._layers.get(diff_id, None)
+
+    def wait_done(self):
+        with self._cond:
+            self._waiting += 1
+            self._cond.notify_all()
+            try:
+                self._cond.wait_for(lambda: self._finished)
+            finally:
+                self._waiting -= 1
+            self._raise()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def _raise(self):
+        if self._error is not None:
+            raise TransferError(f"Error while reading the image from the origin: {str(self._error)}")
+
+
+def _load_checkpoint(client, spool, info, prefix, batch, compress, monitor) -> str:
+    """
+    Loads an untagged image made of the given layers (diff IDs) into the destination.
+    Only the layers in `batch` are sent, the others are expected to be there already.
+    """
+    config = json.dumps(
+        {
+            "architecture": info.get("Architecture", ""),
+            "os": info.get("Os", "linux"),
+            "config": {},
+            "rootfs": {"type": "layers", "diff_ids": prefix},
+            "history": [],
+        }
+    ).encode("utf-8")
+    layers = [f"{diff_id.split(':')[-1]}/layer.tar" for diff_id in prefix]
+    manifest = json.dumps([{"Config": "config.json", "RepoTags": None, "Layers": layers}]).encode("utf-8")
+
+    def _members():
+        yield _bytes_member("config.json", config), io.BytesIO(config)
+        yield _bytes_member("manifest.json", manifest), io.BytesIO(manifest)
+        # a layer appearing more than once in the batch is sent once
+        for diff_id in dict.fromkeys(batch):
+            path = spool.wait_layer(diff_id)
+            member = tarfile.TarInfo(f"{diff_id.split(':')[-1]}/layer.tar")
+            member.size = os.path.getsize(path)
+            yield member, open(path, "rb")
+
+    _load(client, _members(), compress, monitor)
+    return "sha256:" + hashlib.sha256(config).hexdigest()
+
+
+def _load_image(client, spool, diff_ids, chains, compress, monitor):
+    available = _available_chain_ids(client)
+    layers = spool.layer_members()
+    # layers whose chain is available at the destination are not needed
+    skip = set(
+        name
+        for name, diff_id in layers.items()
+        if all(chain in available for d, chain in zip(diff_ids, chains) if d == diff_id)
+    )
+
+    members = [(member, path) for member, path in spool.members if member.name not in skip]
+    # fail before sending anything if a layer the destination does not have is not on disk
+    missing = sorted(set(layers.get(m.name, m.name) for m, path in members if m.isfile() and path is None))
+    if missing:
+        raise TransferError(f"Layer(s) {', '.join(missing)} needed but not stored")
+
+    def _members():
+        for member, path in members:
+            yield member, (open(path, "rb") if path is not None else None)
+
+    _load(client, _members(), compress, monitor)
+
+
+def _load(client, members, compress: bool, monitor):
+    codec = _compression_codec() if compress else None
+    if codec is not None:
+        proc = subprocess.Popen(codec, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        sink, source = proc.stdin, proc.stdout
+    else:
+        proc = None
+        rfd, wfd = os.pipe()
+        sink, source = os.fdopen(wfd, "wb"), os.fdopen(rfd, "rb")
+    errors = []
+
+    def _feed():
+        try:
+            with tarfile.open(fileobj=_CountingWriter(sink, monitor), mode="w|") as tar:
+                for member, fileobj in members:
+                    try:
+                        tar.addfile(member, fileobj)
+                    finally:
+                        if fileobj is not None:
+                            fileobj.close()
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            try:
+                sink.close()
+            except OSError:
+                pass
+
+    def _data():
+        while True:
+            chunk = source.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+    feeder = threading.Thread(target=_feed, daemon=True)
+    feeder.start()
+    try:
+        res = client.api.load_image(_data())
+        for line in res or []:
+            if isinstance(line, dict) and "error" in line:
+                raise TransferError(line["error"])
+    finally:
+        source.close()
+        feeder.join()
+        if proc is not None:
+            proc.wait()
+    if errors:
+        raise errors[0]
+
+
+def _retry(fn, retries: int):
+    for trial in range(retries + 1):
+        try:
+            return fn()
+        except (requests.exceptions.RequestException, APIError, TransferError, OSError) as e:
+            if isinstance(e, TransferError) and str(e).startswith("Error while reading"):
+                raise e
+            if trial >= retries:
+                raise e
+            dtslogger.warning(f"Transfer interrupted ({str(e)}), resuming (trial={trial + 2})...")
+            time.sleep(min(30, 2 ** trial))
+
+
+def _chain_ids(diff_ids: List[str]) -> List[str]:
+    chains = []
+    for diff_id in diff_ids:
+        if not chains:
+            chains.append(diff_id)
+            continue
+        chains.append("sha256:" + hashlib.sha256(f"{chains[-1]} {diff_id}".encode("utf-8")).hexdigest())
+    return chains
+
+
+def _available_chain_ids(client) -> set:
+    available = set()
+    for image in client.images.list(all=True):
+        available.update(_chain_ids(image.attrs.get("RootFS", {}).get("Layers", [])))
+    return available
+
+
+def _compression_codec():
+    for codec in COMPRESSION_CODECS:
+        if which(codec[0]):
+            return codec
+    return None
+
+
+def _blob_digest(name: str) -> Optional[str]:
+    # blobs of OCI archives are named after their digest (for uncompressed layers, the diff ID)
+    parts = name.split("/")
+    if len(parts) == 3 and parts[0] == "blobs":
+        return f"{parts[1]}:{parts[2]}"
+    return None
+
+
+def _spool_file(fileobj, path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, "wb") as fout:
+        while True:
+            chunk = fileobj.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            sha.update(chunk)
+            fout.write(chunk)
+    return "sha256:" + sha.hexdigest()
+
+
+def _bytes_member(name: str, data: bytes) -> tarfile.TarInfo:
+    member = tarfile.TarInfo(name)
+    member.size = len(data)
+    member.mtime = int(time.time())
+    return member
+
+
+class _IterReader(io.RawIOBase):
+    """
+    File-like object reading from an iterator of bytes.
+    """
+
+    def __init__(self, iterator):
+        self._iterator = iter(iterator)
+        self._buffer = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer:
+            try:
+                self._buffer = next(self._iterator)
+            except StopIteration:
+                return 0
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+
+class _CountingWriter:
+    def __init__(self, sink, monitor):
+        self._sink = sink
+        self._monitor = monitor
+
+    def write(self, data):
+        self._sink.write(data)
+        self._monitor.sent(len(data))
+        return len(data)